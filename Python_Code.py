@@ -1,166 +1,173 @@
-# Importing necessary libraries for the application
+# Tk front end of the ticket booking system; the booking logic itself lives in the GUI-free booking package
 import tkinter as tk
 from tkinter import simpledialog, messagebox, Listbox, Scrollbar
-import pickle
 import os
-from datetime import datetime
-import re
-
-# Ticket class definition: Stores details of a ticket
-class Ticket:
-    def __init__(self, name, description, price, validity, discount, terms):
-        # Initialize ticket attributes
-        self.name = name
-        self.description = description
-        self.price = price
-        self.validity = validity
-        self.discount = discount
-        self.terms = terms
-        self.sold_count = 0  # Track number of tickets sold
-
-    def __str__(self):
-        # Define how to represent a ticket as a string
-        return f"{self.name} - {self.price} USD (Sold: {self.sold_count})"
-
-# User class definition: Stores user information and their purchase history
-class User:
-    def __init__(self, username, password, email, phone_number, dob):
-        # Initialize user attributes
-        self.username = username
-        self.password = password
-        self.email = email
-        self.phone_number = phone_number
-        self.dob = dob
-        self.purchase_history = []  # List to track the user's ticket purchases
-
-    def add_purchase(self, ticket):
-        # Add a purchased ticket to the user's purchase history
-        self.purchase_history.append(ticket)
-
-    def update_details(self, email=None, phone_number=None, dob=None):
-        # Update the user's details if provided
-        if email:
-            self.email = email
-        if phone_number:
-            self.phone_number = phone_number
-        if dob:
-            self.dob = dob
-
-# Main class for managing the ticket booking system
-class TicketBookingSystem:
-    def __init__(self):
-        # Initialize file names and load users and tickets data
-        self.users_file = "users.pkl"  # File to store user data
-        self.tickets_file = "tickets.pkl"  # File to store ticket data
-        self.users = self.load_users()  # Load existing users from file
-        self.tickets = self.load_tickets()  # Load existing tickets from file
-
-    # Load user data from the file if it exists
-    def load_users(self):
-        if os.path.exists(self.users_file):
-            with open(self.users_file, "rb") as file:
-                return pickle.load(file)
-        return {}  # Return an empty dictionary if no user data exists
-
-    # Save user data to the file
-    def save_users(self):
-        with open(self.users_file, "wb") as file:
-            pickle.dump(self.users, file)
-
-    # Load ticket data from the file if it exists
-    def load_tickets(self):
-        if os.path.exists(self.tickets_file):
-            with open(self.tickets_file, "rb") as file:
-                return pickle.load(file)
-        # Default set of tickets if no file exists
-        return [
-            Ticket("Single Day Pass", "Access to the park for one day", 275, "1 day", "None", "Valid only on selected date"),
-            Ticket("Two-Day Pass", "Access to the park for two consecutive days", 480, "2 days", "10% discount for online purchase", "Cannot be split over multiple trips"),
-            Ticket("Annual Membership", "Unlimited access for one year", 1840, "1 year", "15% discount on renewal", "Must be used by the same person"),
-            Ticket("Child Ticket", "Discounted ticket for children (ages 3-12)", 185, "1 day", "None", "Valid only on selected date, must be accompanied by an adult"),
-            Ticket("Group Ticket (10+)", "Special rate for groups of 10 or more", 220, "1 day", "20% off for groups of 20 or more", "Must be booked in advance"),
-            Ticket("VIP Experience Pass", "Includes expedited access and reserved seating for shows", 550, "1 day", "None", "Limited availability, must be purchased in advance")
-        ]
-
-    # Save ticket data to the file
-    def save_tickets(self):
-        with open(self.tickets_file, "wb") as file:
-            pickle.dump(self.tickets, file)
-
-    # Register a new user if the username does not already exist
-    def register_user(self, username, password, email, phone_number, dob):
-        if username in self.users:
-            return False  # Return False if the username is already taken
-        user = User(username, password, email, phone_number, dob)  # Create a new user
-        self.users[username] = user  # Store the user in the dictionary
-        self.save_users()  # Save users to file
-        return True  # Return True indicating successful registration
-
-    # Login a user by validating the username and password
-    def login_user(self, username, password):
-        user = self.users.get(username)  # Retrieve user by username
-        if user and user.password == password:
-            return user  # Return the user object if login is successful
-        return None  # Return None if the login fails
-
-    # Add a purchased ticket to the user's purchase history
-    def add_purchase_to_user(self, username, ticket):
-        user = self.users.get(username)  # Retrieve the user by username
-        if user:
-            user.add_purchase(ticket)  # Add the ticket to the user's history
-            self.save_users()  # Save the updated user data to file
-
-    # Modify the user's details (email, phone number, date of birth)
-    def modify_user_details(self, username, email=None, phone_number=None, dob=None):
-        user = self.users.get(username)  # Retrieve the user by username
-        if user:
-            user.update_details(email, phone_number, dob)  # Update the user's details
-            self.save_users()  # Save the updated user data to file
-            return True  # Return True indicating successful update
-        return False  # Return False if the user is not found
-
-    # Purchase a ticket by the user, applying relevant discounts
-    def purchase_ticket(self, username, ticket_choice, num_persons=None, visit_date=None, payment_method=None):
-        ticket = self.tickets[ticket_choice]  # Get the selected ticket
-        discount = 0  # Initialize discount variable
-
-        # Apply discounts based on ticket type
-        if ticket.name == "Single Day Pass":
-            discount = 0  # No discount for Single Day Pass
-        elif ticket.name == "Two-Day Pass":
-            discount = 0.10  # 10% discount for Two-Day Pass
-        elif ticket.name == "Annual Membership":
-            discount = 0.15  # 15% discount for Annual Membership
-        elif ticket.name == "Child Ticket":
-            discount = 0  # No discount for Child Ticket
-        elif ticket.name == "Group Ticket (10+)":
-            # Ensure that group size is a valid integer
-            if not isinstance(num_persons, int) or num_persons < 1:
-                raise ValueError("Group size must be a positive integer.")
-            total_price = ticket.price * num_persons  # Calculate total price for group
-            if num_persons > 10:
-                discount = 0.20  # 20% discount for groups larger than 10
-            final_price = total_price * (1 - discount)  # Calculate final price with discount
-            ticket_record = f"{ticket.name} ({num_persons} people) - ${final_price:.2f} USD (Discount Applied: {int(discount * 100)}%)"
-            self.add_purchase_to_user(username, ticket_record)  # Add purchase record to the user
-            ticket.sold_count += num_persons  # Update ticket's sold count
-            return final_price, ticket_record  # Return final price and ticket record
-
-        # Standard pricing for single ticket purchase
-        final_price = ticket.price * (1 - discount)  # Calculate final price after discount
-        ticket_record = f"{ticket.name} - ${final_price:.2f} USD (Discount Applied: {int(discount * 100)}%)"
-        self.add_purchase_to_user(username, ticket_record)  # Add purchase record to the user
-        
-        ticket.sold_count += 1  # Increment sold count by 1 for each ticket purchased
-        return final_price, ticket_record  # Return final price and ticket record
- 
+import queue
+import sys
+from datetime import date
+from concurrent.futures import ThreadPoolExecutor
+
+from booking.core import (
+    TicketBookingSystem, SQLiteStorage, SoldOutError, DuplicateEmailError, AGE_BANDS, PAYMENT_METHODS,
+    registration_error, convert_state_files, migrate_pickles_to_sqlite,
+)
+
+# BackgroundTasks class definition: Runs blocking system calls off the Tk thread and hands the results back to it
+class BackgroundTasks:
+    def __init__(self, root, workers=2, poll_ms=25):
+        self.root = root  # Tk window whose event loop runs the completion callbacks
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="gui-task")
+        self.finished = queue.Queue()  # (future, on_done, on_error) for finished calls; Tk may only be used from its own thread
+        self.pending = 0  # Calls whose callbacks have not run yet
+        self.poll_ms = poll_ms  # How often the Tk thread looks for finished calls while any are pending
+
+    # Run func(*args) on a worker thread, then on_done(result) or on_error(error) on the Tk thread
+    def run(self, func, *args, on_done=None, on_error=None):
+        future = self.executor.submit(func, *args)
+        self.pending += 1
+        if self.pending == 1:
+            self.root.after(self.poll_ms, self.poll)
+        future.add_done_callback(lambda future: self.finished.put((future, on_done, on_error)))
+
+    # Run the callbacks of finished calls (on the Tk thread)
+    def poll(self):
+        try:
+            while True:
+                try:
+                    future, on_done, on_error = self.finished.get_nowait()
+                except queue.Empty:
+                    break
+                self.pending -= 1
+                self.complete(future, on_done, on_error)
+        finally:
+            if self.pending:
+                self.root.after(self.poll_ms, self.poll)
+
+    def complete(self, future, on_done, on_error):
+        try:
+            error = future.exception()
+            if error is None:
+                if on_done:
+                    on_done(future.result())
+            elif on_error:
+                on_error(error)
+            else:
+                messagebox.showerror("Error", str(error))
+        except tk.TclError:
+            pass  # The window the callback updates was closed while the call ran
+
+    # Wait for every running call to finish, so its changes reach the storage writer before shutdown
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+# VirtualListbox class definition: A listbox that only ever holds the rows in view, fetched a page at a time
+class VirtualListbox(tk.Frame):
+    def __init__(self, parent, fetch, height=15, **listbox_options):
+        super().__init__(parent)
+        self.fetch = fetch  # fetch(offset, limit) returns (rows, total number of rows)
+        self.height = height  # Number of rows in view
+        self.top = 0  # Offset of the first row in view
+        self.total = 0  # Number of rows in the whole list
+        self.rows = []  # The rows in view
+        self.selected = None  # Offset of the selected row in the whole list
+
+        self.listbox = Listbox(self, height=height, exportselection=False, **listbox_options)
+        self.listbox.pack(side="left", fill="both", expand=True)
+        self.scrollbar = Scrollbar(self, command=self.on_scroll)
+        self.scrollbar.pack(side="right", fill="y")
+
+        # The listbox never scrolls by itself, so wheel and keys move the page instead
+        self.listbox.bind("<<ListboxSelect>>", self.on_select)
+        self.listbox.bind("<MouseWheel>", lambda event: self.scroll_rows(-3 if event.delta > 0 else 3))
+        self.listbox.bind("<Button-4>", lambda event: self.scroll_rows(-3))  # Wheel up on X11
+        self.listbox.bind("<Button-5>", lambda event: self.scroll_rows(3))  # Wheel down on X11
+        self.listbox.bind("<Up>", lambda event: self.move_selection(-1))
+        self.listbox.bind("<Down>", lambda event: self.move_selection(1))
+        self.listbox.bind("<Prior>", lambda event: self.move_selection(-self.height))
+        self.listbox.bind("<Next>", lambda event: self.move_selection(self.height))
+        self.listbox.bind("<Home>", lambda event: self.move_selection(-self.total))
+        self.listbox.bind("<End>", lambda event: self.move_selection(self.total))
+
+    # Fetch and show the page starting at top (the current one by default)
+    def refresh(self, top=None):
+        if top is not None:
+            self.top = top
+        self.rows, self.total = self.fetch(self.top, self.height)
+        if not self.rows and self.top > 0:  # Rows were removed from under the page; show the last page instead
+            self.top = max(self.total - self.height, 0)
+            self.rows, self.total = self.fetch(self.top, self.height)
+        if self.selected is not None and self.selected >= self.total:
+            self.selected = None
+        self.listbox.delete(0, tk.END)
+        self.listbox.insert(tk.END, *self.rows)
+        if self.selected is not None and self.top <= self.selected < self.top + len(self.rows):
+            self.listbox.selection_set(self.selected - self.top)
+            self.listbox.activate(self.selected - self.top)
+        if self.total:
+            self.scrollbar.set(self.top / self.total, min(self.top + self.height, self.total) / self.total)
+        else:
+            self.scrollbar.set(0, 1)
+
+    # Start again from the first row, e.g. after the filter changed
+    def reset(self):
+        self.selected = None
+        self.refresh(0)
+
+    # Show the page starting at top, kept within the list
+    def scroll_to(self, top):
+        top = max(min(top, self.total - self.height), 0)
+        if top != self.top:
+            self.refresh(top)
+
+    def scroll_rows(self, count):
+        self.scroll_to(self.top + count)
+        return "break"
+
+    # Scrollbar callback: ("moveto", fraction) or ("scroll", count, "units" or "pages")
+    def on_scroll(self, action, amount, unit=None):
+        if action == "moveto":
+            self.scroll_to(int(float(amount) * self.total))
+        elif action == "scroll":
+            self.scroll_rows(int(amount) * (self.height if unit == "pages" else 1))
+
+    def on_select(self, event=None):
+        selection = self.listbox.curselection()
+        if selection:
+            self.selected = self.top + selection[0]
+
+    # Move the selection by count rows, scrolling to keep it in view
+    def move_selection(self, count):
+        if not self.total:
+            return "break"
+        current = self.selected if self.selected is not None else self.top - 1 if count > 0 else self.top + 1
+        self.selected = max(min(current + count, self.total - 1), 0)
+        if self.selected < self.top:
+            self.refresh(self.selected)
+        elif self.selected >= self.top + self.height:
+            self.refresh(self.selected - self.height + 1)
+        else:
+            self.refresh()
+        return "break"
+
+    # The selected row, or None
+    def selection(self):
+        if self.selected is None:
+            return None
+        if self.top <= self.selected < self.top + len(self.rows):
+            return self.rows[self.selected - self.top]
+        rows, _ = self.fetch(self.selected, 1)
+        return rows[0] if rows else None
+
 # Main application class, inherits from Tkinter's Tk class
 class Application(tk.Tk):
-    def __init__(self, system):
+    def __init__(self, system, reports=None):
         # Initialize the main application window
         super().__init__()
         self.system = system  # The ticket booking system instance
+        self.reports = reports or system  # Where the admin reports and user listings are read from, e.g. read replicas
+        self.tasks = BackgroundTasks(self)  # Runs system calls that may block off the Tk thread
         self.title("Main Menu")  # Set the window title
+        self.protocol("WM_DELETE_WINDOW", self.quit)  # Closing the window exits like the Exit button, flushing changes
         self.geometry("700x600")  # Set window size
         self.resizable(False, False)  # Disable window resizing
         self.config(bg="#FEFEBE")  # Set the background color
@@ -191,7 +198,7 @@ class Application(tk.Tk):
 
     # Method to open the admin window
     def open_admin(self):
-        AdminWindow(self, self.system)
+        AdminWindow(self, self.system, self.reports)
 
 # Registration window class, inherits from Toplevel for creating a new window
 class RegisterWindow(tk.Toplevel):
@@ -199,6 +206,7 @@ class RegisterWindow(tk.Toplevel):
         # Initialize the registration window
         super().__init__(parent)
         self.system = system  # The ticket booking system instance
+        self.tasks = parent.tasks  # Background calls shared with the main window
         self.title("Register")  # Set the window title
         self.geometry("700x700")  # Set window size
         self.config(bg="#FEFEBE")  # Set the background color
@@ -243,34 +251,30 @@ class RegisterWindow(tk.Toplevel):
         phone_number = self.phone_entry.get().strip()
         dob = self.dob_entry.get().strip()
 
-        # Check if all fields are filled
-        if not username or not password or not email or not phone_number or not dob:
-            messagebox.showerror("Input Error", "All fields are required!")
+        # Check that every field is filled in and well formed
+        error = registration_error(username, password, email, phone_number, dob)
+        if error:
+            messagebox.showerror("Input Error", error)
             return
 
-        # Validate email format
-        if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
-            messagebox.showerror("Input Error", "Invalid email format!")
-            return
-
-        # Validate phone number format (basic format validation)
-        if not re.match(r"^\+?1?\d{9,15}$", phone_number):
-            messagebox.showerror("Input Error", "Invalid phone number format!")
-            return
+        # Proceed with registration if all inputs are valid; hashing the password runs off the Tk thread
+        def registered(success):
+            self.register_button.config(state="normal")
+            if success:
+                messagebox.showinfo("Success", "Registration successful!")
+                self.destroy()  # Close the registration window
+            else:
+                messagebox.showerror("Error", "Username already exists!")  # Show error if username is taken
 
-        # Validate date of birth format (YYYY-MM-DD)
-        try:
-            datetime.strptime(dob, "%Y-%m-%d")
-        except ValueError:
-            messagebox.showerror("Input Error", "Invalid date of birth format. Use YYYY-MM-DD.")
-            return
+        def failed(error):
+            self.register_button.config(state="normal")
+            if isinstance(error, DuplicateEmailError):
+                messagebox.showerror("Input Error", str(error))  # Show error if the email belongs to another user
+            else:
+                messagebox.showerror("Error", str(error))
 
-        # Proceed with registration if all inputs are valid
-        if self.system.register_user(username, password, email, phone_number, dob):
-            messagebox.showinfo("Success", "Registration successful!")
-            self.destroy()  # Close the registration window
-        else:
-            messagebox.showerror("Error", "Username already exists!")  # Show error if username is taken
+        self.register_button.config(state="disabled")  # One registration at a time
+        self.tasks.run(self.system.register_user, username, password, email, phone_number, dob, on_done=registered, on_error=failed)
 
 # Login window class, inherits from Toplevel for creating a new window
 class LoginWindow(tk.Toplevel):
@@ -278,6 +282,7 @@ class LoginWindow(tk.Toplevel):
         # Initialize the login window
         super().__init__(parent)
         self.system = system  # The ticket booking system instance
+        self.tasks = parent.tasks  # Background calls shared with the main window
         self.title("Login")  # Set the window title
         self.geometry("700x600")  # Set window size
         self.config(bg="#FEFEBE")  # Set the background color
@@ -309,14 +314,23 @@ class LoginWindow(tk.Toplevel):
             messagebox.showerror("Input Error", "Both fields are required!")
             return
         
-        # Attempt to login the user with the provided credentials
-        user = self.system.login_user(username, password)
-        if user:
-            messagebox.showinfo("Success", "Login successful!")  # Show success message
-            self.destroy()  # Close the login window
-            UserMenu(self.master, user, self.system)  # Open the user menu
-        else:
-            messagebox.showerror("Error", "Invalid credentials!")  # Show error if login fails
+        # Attempt to login the user with the provided credentials, checking the password off the Tk thread
+        def logged_in(user):
+            self.login_button.config(state="normal")
+            if user:
+                messagebox.showinfo("Success", "Login successful!")  # Show success message
+                parent = self.master
+                self.destroy()  # Close the login window
+                UserMenu(parent, user, self.system)  # Open the user menu
+            else:
+                messagebox.showerror("Error", "Invalid credentials!")  # Show error if login fails
+
+        def failed(error):
+            self.login_button.config(state="normal")
+            messagebox.showerror("Error", str(error))
+
+        self.login_button.config(state="disabled")  # One login attempt at a time
+        self.tasks.run(self.system.login_user, username, password, on_done=logged_in, on_error=failed)
 
 # UserMenu class represents the main interface for the regular user
 class UserMenu(tk.Toplevel):
@@ -324,6 +338,7 @@ class UserMenu(tk.Toplevel):
         super().__init__(parent)
         self.user = user  # Store the user object
         self.system = system  # Store the system object
+        self.tasks = parent.tasks  # Background calls shared with the main window
         self.title(f"Welcome {user.username}")  # Set the window title with the username
         self.geometry("700x700")  # Set window size
         self.config(bg="#FEFEBE")  # Set background color
@@ -375,15 +390,20 @@ class UserMenu(tk.Toplevel):
                 return  # Exit if no payment method is provided
             # Ask for the number of persons
             num_persons = simpledialog.askinteger("Group Size", "Enter the number of persons:", minvalue=1)
-            if num_persons:
-                # If group size is specified, purchase the ticket for the group
-                price, ticket_details = self.system.purchase_ticket(self.user.username, selected_idx, num_persons, visit_date, payment_method)
-                messagebox.showinfo("Ticket Purchase", f"Ticket Purchased: {ticket_details}\nTotal: ${price:.2f}")
-            else:
-                # If no group size is provided, purchase for a single person
-                price, ticket_details = self.system.purchase_ticket(self.user.username, selected_idx, visit_date=visit_date, payment_method=payment_method)
+
+            def purchased(result):
+                price, ticket_details = result
                 messagebox.showinfo("Ticket Purchase", f"Ticket Purchased: {ticket_details}\nTotal: ${price:.2f}")
 
+            def failed(error):
+                if isinstance(error, SoldOutError):
+                    messagebox.showerror("Sold Out", str(error))  # Show error if no seats are left
+                else:
+                    messagebox.showerror("Error", str(error))
+
+            # Purchase for the group if a size is given, otherwise for a single person, off the Tk thread
+            self.tasks.run(self.system.purchase_ticket, self.user.username, selected_idx, num_persons or None, visit_date, payment_method, on_done=purchased, on_error=failed)
+
         # Bind the double-click event to select a ticket
         ticket_listbox.bind("<Double-1>", on_select_ticket)
 
@@ -395,13 +415,11 @@ class UserMenu(tk.Toplevel):
 
         tk.Label(history_window, text="Purchase History", font=("Arial", 16, "bold")).pack(pady=10)
 
-        # Listbox to display the user's purchase history
-        history_listbox = Listbox(history_window, font=("Arial", 12), width=50, height=10)
+        # Listbox showing one page of the user's purchase history at a time
+        history_listbox = VirtualListbox(history_window, lambda offset, limit: self.system.purchase_page(self.user.username, offset, limit), height=10, font=("Arial", 12), width=50)
         history_listbox.pack(pady=20)
-
-        # Populate the listbox with purchase history data
-        for history_item in self.user.purchase_history:
-            history_listbox.insert(tk.END, history_item)
+        history_listbox.refresh()
+        history_listbox.listbox.focus_set()
 
     # Function to manage user account details
     def account_management(self):
@@ -448,25 +466,36 @@ class UserMenu(tk.Toplevel):
             new_phone = phone_entry.get().strip()
             new_dob = dob_entry.get().strip()
 
-            # Update the system with new details
-            if self.system.modify_user_details(self.user.username, new_email, new_phone, new_dob):
-                messagebox.showinfo("Success", "Account details updated successfully!")
-                self.user.email = new_email
-                self.user.phone_number = new_phone
-                self.user.dob = new_dob
-                modify_window.destroy()
-            else:
-                messagebox.showerror("Error", "Failed to update details!")
+            # Show the outcome once the system has the new details, keeping the user as the system now has it
+            def saved(user):
+                if user:
+                    self.user = user
+                    messagebox.showinfo("Success", "Account details updated successfully!")
+                    modify_window.destroy()
+                else:
+                    messagebox.showerror("Error", "Failed to update details!")
+
+            # Update the system with new details, off the Tk thread; a DuplicateEmailError is shown as an error
+            self.tasks.run(self.update_details, new_email, new_phone, new_dob, on_done=saved)
 
         # Button to save the changes
         save_button = tk.Button(modify_window, text="Save Changes", font=("Arial", 14), command=save_changes)
         save_button.pack(pady=20)
 
+    # Change the user's details through the system, which keeps its index and the saved data in step, and read the
+    # user back from it; blank fields are left as they were. Returns None if the user no longer exists.
+    def update_details(self, email, phone_number, dob):
+        if not self.system.modify_user_details(self.user.username, email, phone_number, dob):
+            return None
+        return self.system.users.get(self.user.username)
+
 # AdminWindow class represents the admin interface
 class AdminWindow(tk.Toplevel):
-    def __init__(self, parent, system):
+    def __init__(self, parent, system, reports=None):
         super().__init__(parent)
         self.system = system  # Store the system object
+        self.reports = reports or system  # Answers the sales totals and user listings
+        self.tasks = parent.tasks  # Background calls shared with the main window
         self.title("Admin Menu")
         self.geometry("800x600")  # Set window size
         self.resizable(True, True)  # Allow resizing
@@ -495,30 +524,59 @@ class AdminWindow(tk.Toplevel):
         user_management_window.geometry("600x400")  # Larger window for user management
         user_management_window.resizable(True, True)
 
-        # Scrollbar and listbox to show users
-        scrollbar = Scrollbar(user_management_window)
-        scrollbar.pack(side="right", fill="y")
+        # Search field: an email address, a phone number, or the start of a username; results follow as you type
+        search_frame = tk.Frame(user_management_window)
+        search_frame.pack(pady=5)
+        search_entry = tk.Entry(search_frame, font=("Arial", 14), width=30)
+        search_entry.grid(row=0, column=0, padx=5)
 
-        user_listbox = Listbox(user_management_window, font=("Arial", 14), width=50, height=15, yscrollcommand=scrollbar.set)
-        user_listbox.pack(pady=20)
+        # Fetch one page of matching users, or a placeholder while the user index is still being built
+        def fetch_users(offset, limit):
+            if not self.reports.index_ready():
+                return ["Loading users..."], 0
+            return self.reports.user_page(search_entry.get(), offset, limit)
 
-        # Insert users into the listbox
-        for username in self.system.users.keys():
-            user_listbox.insert(tk.END, username)
+        user_listbox = VirtualListbox(user_management_window, fetch_users, height=15, font=("Arial", 14), width=50)
+        user_listbox.pack(pady=20)
 
-        # Link the scrollbar to the listbox
-        scrollbar.config(command=user_listbox.yview)
+        # Show the first page for the current search text
+        searched_text = [None]
+        def search_users(event=None):
+            searched_text[0] = search_entry.get()
+            user_listbox.reset()
+            if not self.reports.index_ready():
+                user_management_window.after(250, search_users)  # Try again once the index is ready
+                return
+            user_management_window.title(f"User Management - {user_listbox.total} users")
+
+        # Search shortly after the last keystroke, so fast typing doesn't fetch a page per key
+        pending_search = [None]
+        def search_soon(event=None):
+            if search_entry.get() == searched_text[0]:
+                return  # Arrow keys, Return and the like leave the text as it was
+            if pending_search[0] is not None:
+                user_management_window.after_cancel(pending_search[0])
+            pending_search[0] = user_management_window.after(150, run_search)
+        def run_search():
+            pending_search[0] = None
+            search_users()
+
+        tk.Button(search_frame, text="Search", font=("Arial", 12), command=search_users).grid(row=0, column=1, padx=5)
+        search_entry.bind("<Return>", search_users)
+        search_entry.bind("<KeyRelease>", search_soon)
+        search_users()  # Show the first page of users
 
         # Function to delete a selected user
         def delete_user():
-            selected_user = user_listbox.get(tk.ACTIVE)  # Get the selected user
+            selected_user = user_listbox.selection() if user_listbox.total else None  # Get the selected user
             if selected_user:
                 confirm_delete = messagebox.askyesno("Confirm Deletion", f"Are you sure you want to delete user: {selected_user}?")
                 if confirm_delete:
-                    del self.system.users[selected_user]  # Delete user from the system
-                    self.system.save_users()  # Save the updated user list
-                    user_listbox.delete(user_listbox.curselection())  # Remove the user from the listbox
-                    messagebox.showinfo("Success", "User deleted successfully!")
+                    def deleted(result):
+                        user_listbox.selected = None
+                        user_listbox.refresh()  # Fetch the page again without the user
+                        messagebox.showinfo("Success", "User deleted successfully!")
+                    self.tasks.run(self.system.delete_user, selected_user, on_done=deleted)  # Delete user from the system
             else:
                 messagebox.showerror("Error", "No user selected!")
 
@@ -581,11 +639,11 @@ class AdminWindow(tk.Toplevel):
                 messagebox.showerror("Error", "Invalid price entered!")
                 return
 
-            ticket.price = new_price  # Update ticket price
-            self.system.save_tickets()  # Save the updated ticket list
-            ticket_listbox.delete(selected[0])  # Remove the old ticket entry
-            ticket_listbox.insert(selected[0], f"{ticket.name} - ${new_price}")  # Add updated ticket
-            messagebox.showinfo("Success", f"{ticket.name} updated successfully!")
+            def updated(result):
+                ticket_listbox.delete(selected[0])  # Remove the old ticket entry
+                ticket_listbox.insert(selected[0], f"{ticket.name} - ${new_price}")  # Add updated ticket
+                messagebox.showinfo("Success", f"{ticket.name} updated successfully!")
+            self.tasks.run(self.system.update_ticket_price, self.system.tickets.index(ticket), new_price, on_done=updated)  # Update and save the ticket price
 
         # Button to update the selected ticket
         tk.Button(ticket_updation_window, text="Update Ticket", font=("Arial", 14), command=update_ticket).pack(pady=10)
@@ -597,25 +655,77 @@ class AdminWindow(tk.Toplevel):
     def total_tickets_sold(self):
         total_window = tk.Toplevel(self)
         total_window.title("Total Tickets Sold")
-        total_window.geometry("500x400")
+        total_window.geometry("700x400")
 
         # Label for total tickets sold title
         tk.Label(total_window, text="Total Tickets Sold", font=("Arial", 16, "bold")).pack(pady=10)
 
         # Listbox to show ticket sales data
-        listbox = Listbox(total_window, font=("Arial", 12), width=50, height=10)
+        listbox = Listbox(total_window, font=("Arial", 12), width=70, height=10)
         listbox.pack(pady=20)
 
-        # Populate the listbox with sales data
-        for ticket in self.system.tickets:
-            listbox.insert(tk.END, f"{ticket.name} - Sold: {ticket.sold_count} tickets")
+        # Populate the listbox from the running sales totals, so no purchase history is read
+        sales = self.reports.sales_report("ticket")
+        for ticket_id, ticket in enumerate(self.system.tickets):
+            units, revenue_cents, discount_cents, _ = sales.get(ticket_id, (0, 0, 0, 0))
+            listbox.insert(tk.END, f"{ticket.name} - Sold: {units} tickets, ${revenue_cents / 100:,.2f} (discounts ${discount_cents / 100:,.2f})")
+        for code, (units, revenue_cents, _, orders) in sorted(self.reports.sales_report("payment").items()):
+            listbox.insert(tk.END, f"Paid by {PAYMENT_METHODS[code]} - {orders} orders, ${revenue_cents / 100:,.2f}")
+        for band, (units, revenue_cents, _, orders) in sorted(self.reports.sales_report("age").items()):
+            listbox.insert(tk.END, f"Age {AGE_BANDS[band]} - {units} tickets, ${revenue_cents / 100:,.2f}")
+
+        # Add the weekly and per ticket and date breakdowns once they are worked out, off the Tk thread
+        def show_breakdowns(lines):
+            for line in lines:
+                listbox.insert(tk.END, line)
+        self.tasks.run(self.sales_breakdowns, on_done=show_breakdowns)
 
         # Close button to exit the window
         close_button = tk.Button(total_window, text="Close", font=("Arial", 12), width=20, height=2, command=total_window.destroy)
         close_button.pack(pady=10)
 
+    # Lines of sales per week and per ticket and visit date, worked out with NumPy from every purchase record; without
+    # NumPy, the running totals per visit date are shown instead
+    def sales_breakdowns(self):
+        try:
+            from booking import analytics  # Needs NumPy, which the rest of the app does not
+        except ImportError:
+            return [
+                f"{date.fromordinal(ordinal).isoformat()} - {units} tickets, ${revenue_cents / 100:,.2f}"
+                for ordinal, (units, revenue_cents, _, _) in sorted(self.reports.sales_report("day").items()) if ordinal
+            ]
+        lines = []
+        for kind in ("week", "ticket-day"):
+            for label, _, units, revenue, discounts, _ in analytics.breakdown_rows(self.system, kind):  # The primary holds every purchase record
+                lines.append(f"{label} - {units} tickets, ${revenue:,.2f} (discounts ${discounts:,.2f})")
+        return lines
+
 # Main application code to initialize the system and run the app
 if __name__ == "__main__":
-    system = TicketBookingSystem()  # Initialize the ticket booking system
-    app = Application(system)  # Create the application instance with the system
-    app.mainloop()  # Start the main event loop
\ No newline at end of file
+    if len(sys.argv) == 2 and sys.argv[1] == "--convert":
+        # One-shot rewrite of users.pkl, tickets.pkl and older user data files in the binary formats
+        user_count, ticket_count = convert_state_files()
+        print(f"Converted {user_count} users and {ticket_count} tickets")
+        sys.exit(0)
+    if len(sys.argv) == 3 and sys.argv[1] == "--migrate-sqlite":
+        # One-shot copy of users.pkl and tickets.pkl into an SQLite database
+        count = migrate_pickles_to_sqlite(sys.argv[2])
+        print(f"Migrated {count} users to {sys.argv[2]}")
+        sys.exit(0)
+    if os.environ.get("BOOKING_METRICS"):
+        from booking import metrics
+        metrics.enable_from_environment(gui=sys.modules[__name__])  # Opt-in instrumentation of the core and of this module's windows
+    storage = None  # Use the pickle files unless a database is given
+    if len(sys.argv) == 3 and sys.argv[1] == "--db":
+        storage = SQLiteStorage(sys.argv[2])
+    system = TicketBookingSystem(storage=storage)  # Initialize the ticket booking system
+    replicas = None  # Admin reports read the system itself unless BOOKING_REPLICAS asks for read replica processes
+    if os.environ.get("BOOKING_REPLICAS"):
+        from booking.replication import ReadReplicas
+        replicas = ReadReplicas(system, int(os.environ["BOOKING_REPLICAS"]))  # Started before Tk, so the processes don't inherit it
+    app = Application(system, replicas)  # Create the application instance with the system
+    app.mainloop()  # Start the main event loop; it returns once any window's Exit button quits it
+    app.tasks.shutdown()  # Let calls still running hand their changes to the storage writer
+    if replicas is not None:
+        replicas.close()
+    system.close()  # Flush outstanding changes before exiting
\ No newline at end of file
@@ -0,0 +1,192 @@
+# Benchmarks for the booking core on synthetic data at several scales, with regression checks against a baseline
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import date
+
+from booking.core import TicketBookingSystem, MappedStorage, SQLiteStorage, PasswordHasher, Purchase, PAYMENT_METHODS
+
+SCALES = {"1k": 1000, "100k": 100000, "1m": 1000000}  # Users per scale
+PURCHASES_PER_USER = 3  # Average purchase history length of the synthetic users
+STARTUP_RUNS = 5  # Times the stored data is opened to time startup
+PASSWORD = "benchmark-password"  # Every synthetic user's password
+FIRST_VISIT = date(2026, 1, 1).toordinal()  # Synthetic visit dates fall in 2026
+TAIL_SAMPLES = 20  # Samples needed before a metric's p90 is compared with the baseline
+NOISE_FLOORS = {"_ms": 0.1, "_s": 0.01, "_bytes": 0}  # Smallest change per metric unit that can count as a regression
+
+# Latency statistics in milliseconds for a list of durations in seconds
+def latency_stats(durations):
+    ordered = sorted(durations)
+    pick = lambda fraction: ordered[min(int(fraction * len(ordered)), len(ordered) - 1)] * 1000
+    return {"count": len(ordered), "p50": pick(0.50), "p90": pick(0.90), "p99": pick(0.99), "max": ordered[-1] * 1000, "ops_per_s": len(ordered) / sum(ordered)}
+
+# Run func(arg) for each argument and return its latency statistics
+def measure(func, args):
+    durations = []
+    for arg in args:
+        start = time.perf_counter()
+        func(arg)
+        durations.append(time.perf_counter() - start)
+    return latency_stats(durations)
+
+# Storage backend for a benchmark directory
+def open_storage(kind, directory):
+    if kind == "sqlite":
+        return SQLiteStorage(os.path.join(directory, "booking.db"))
+    return MappedStorage(os.path.join(directory, "users.pkl"), os.path.join(directory, "tickets.pkl"))
+
+# Bytes of state files in a benchmark directory
+def state_bytes(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory) if not name.endswith(".tmp"))
+
+# Fill a system with count synthetic users and their purchase histories, a chunk at a time
+def populate(system, count, rng, chunk_size=10000):
+    password_hash = PasswordHasher(0).hash(PASSWORD)  # One real hash, so logins check a password like any other
+    ticket_count = len(system.tickets)
+    for first in range(0, count, chunk_size):
+        names = range(first, min(first + chunk_size, count))
+        system.import_users([
+            (f"user{i:07d}", password_hash, f"user{i:07d}@example.com", f"555{i:07d}", f"{rng.randint(1940, 2015)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}")
+            for i in names
+        ])
+        system.import_purchases([
+            (f"user{i:07d}", Purchase(rng.randrange(ticket_count), rng.randint(1, 4), rng.randint(1000, 60000), rng.choice((0, 1000, 1500)), FIRST_VISIT + rng.randrange(365), rng.randrange(len(PAYMENT_METHODS))))
+            for i in names for _ in range(rng.randint(0, 2 * PURCHASES_PER_USER))
+        ])
+    system.flush()
+
+# Benchmark one scale in a fresh directory; returns {metric: value or latency statistics}
+def run_scale(count, storage_kind, rng, operations):
+    directory = tempfile.mkdtemp(prefix="booking-benchmark-")
+    try:
+        results = {}
+        system = TicketBookingSystem(storage=open_storage(storage_kind, directory))
+        start = time.perf_counter()
+        populate(system, count, rng)
+        results["populate_s"] = time.perf_counter() - start
+
+        # Persistence: a full snapshot, then purchases that wait until they are on disk
+        start = time.perf_counter()
+        system.save_users()
+        results["snapshot_s"] = time.perf_counter() - start
+        results["state_bytes"] = state_bytes(directory)
+        usernames = [f"user{rng.randrange(count):07d}" for _ in range(operations)]
+        results["durable_purchase_ms"] = measure(lambda username: (system.purchase_ticket(username, 0, 2, "2026-06-01", "Cash"), system.flush()), usernames[:operations // 4])
+        system.close()
+
+        # Startup: open the stored data, then wait for the background user index
+        opened, ready = [], []
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            system = TicketBookingSystem(storage=open_storage(storage_kind, directory))
+            opened.append(time.perf_counter() - start)
+            system.index.ready.wait()
+            ready.append(time.perf_counter() - start)
+            system.close()
+        results["startup_ms"] = latency_stats(opened)
+        results["index_ready_ms"] = latency_stats(ready)
+
+        system = TicketBookingSystem(storage=open_storage(storage_kind, directory))
+        system.index.ready.wait()
+        try:
+            results["purchase_ms"] = measure(
+                lambda username: system.purchase_ticket(username, rng.randrange(5), rng.randint(1, 4), date.fromordinal(FIRST_VISIT + rng.randrange(365)).isoformat(), "Credit/Debit Card"),
+                usernames,
+            )
+            # Password checks are deliberately slow, so fewer of them are timed; the first one starts the hashing processes
+            system.login_user(usernames[0], PASSWORD)
+            results["login_ms"] = measure(lambda username: system.login_user(username, PASSWORD), usernames[:max(operations // 50, 5)])
+            results["register_ms"] = measure(
+                lambda i: system.register_user(f"new{i:07d}", PASSWORD, f"new{i:07d}@example.com", f"444{i:07d}", "1990-01-01"),
+                range(max(operations // 50, 5)),
+            )
+            # Admin listings: one page of users by prefix, one page of a purchase history, the sales totals
+            results["user_page_ms"] = measure(lambda prefix: system.user_page(prefix, 0, 50), [f"user{rng.randrange(10):d}{rng.randrange(10):d}" for _ in range(operations)])
+            results["purchase_page_ms"] = measure(lambda username: system.purchase_page(username, 0, 50), usernames)
+            results["sales_report_ms"] = measure(system.sales_report, ["ticket", "day", "payment", "age"] * (operations // 4))
+            start = time.perf_counter()
+            system.flush()
+            results["final_flush_s"] = time.perf_counter() - start
+        finally:
+            system.close()
+        return results
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+# Compare results with a baseline; returns a list of (scale, metric, baseline value, current value) that got slower
+# or bigger by more than the tolerance and the metric's noise floor. Throughput and the tail are too noisy to compare.
+def regressions(results, baseline, tolerance):
+    found = []
+    for scale, metrics in results["scales"].items():
+        for metric, value in metrics.items():
+            old = baseline.get("scales", {}).get(scale, {}).get(metric)
+            if old is None:
+                continue
+            floor = next(floor for suffix, floor in NOISE_FLOORS.items() if metric.endswith(suffix))
+            if isinstance(value, dict):
+                stats = ("p50", "p90") if value["count"] >= TAIL_SAMPLES else ("p50",)  # p90 of a handful of runs is their worst
+                pairs = [(f"{metric}.{stat}", old[stat], value[stat]) for stat in stats]
+            else:
+                pairs = [(metric, old, value)]
+            for name, old_value, new_value in pairs:
+                if new_value > old_value * (1 + tolerance) and new_value - old_value > floor:
+                    found.append((scale, name, old_value, new_value))
+    return found
+
+# Print one line per metric for a human reader
+def print_results(results, file=sys.stderr):
+    for scale, metrics in results["scales"].items():
+        print(f"[{scale}]", file=file)
+        for metric, value in metrics.items():
+            if isinstance(value, dict):
+                print(f"  {metric:20} p50 {value['p50']:9.3f}  p90 {value['p90']:9.3f}  p99 {value['p99']:9.3f}  max {value['max']:9.3f}  ({value['ops_per_s']:,.0f}/s)", file=file)
+            else:
+                print(f"  {metric:20} {value:,.3f}", file=file)
+
+# Run the benchmarks: python benchmark.py [--scales 1k,100k,1m] [--storage mapped|sqlite] [--output results.json]
+#                                         [--baseline benchmark_baseline.json] [--save-baseline] [--tolerance 0.5]
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the booking core on synthetic data")
+    parser.add_argument("--scales", default="1k,100k", help="comma-separated scales from " + ", ".join(SCALES))
+    parser.add_argument("--storage", choices=("mapped", "sqlite"), default="mapped")
+    parser.add_argument("--operations", type=int, default=2000, help="timed calls per fast operation")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="results to compare against")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="allowed slowdown before a metric counts as a regression")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "storage": args.storage, "seed": args.seed, "operations": args.operations, "python": platform.python_version(),
+            "machine": platform.machine(), "cpus": os.cpu_count(), "when": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "scales": {},
+    }
+    for scale in args.scales.split(","):
+        print(f"Running {scale} ({SCALES[scale]:,} users)...", file=sys.stderr)
+        rng = random.Random(f"{args.seed}-{scale}")  # Same data and calls for a scale whichever other scales run with it
+        results["scales"][scale] = run_scale(SCALES[scale], args.storage, rng, args.operations)
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(results, file, indent=2)
+        print(f"Saved baseline to {args.baseline}", file=sys.stderr)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        slower = regressions(results, baseline, args.tolerance)
+        for scale, name, old_value, new_value in slower:
+            print(f"REGRESSION [{scale}] {name}: {old_value:,.3f} -> {new_value:,.3f} ({new_value / old_value - 1:+.0%})", file=sys.stderr)
+        print(f"{len(slower)} regressions against {args.baseline}", file=sys.stderr)
+        sys.exit(1 if slower else 0)
@@ -0,0 +1,16 @@
+# Ticket booking system without the GUI. The core is booking.core; the optional subsystems (the HTTP service,
+# sharding, bulk import and export, NumPy analytics, metrics, read replicas and the CLI) are modules of their own, imported only
+# when first used, so `import booking` costs nothing and headless tools never load Tk.
+import importlib
+
+SUBSYSTEMS = ("core", "service", "sharding", "bulk", "analytics", "metrics", "replication", "cli")
+
+# Import a subsystem, or look up a core name such as booking.TicketBookingSystem, on first use
+def __getattr__(name):
+    if name in SUBSYSTEMS:
+        return importlib.import_module(f"{__name__}.{name}")
+    core = importlib.import_module(f"{__name__}.core")
+    try:
+        return getattr(core, name)
+    except AttributeError:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}") from None
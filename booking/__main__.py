@@ -0,0 +1,6 @@
+# python -m booking: the batch command line
+import sys
+
+from booking.cli import main
+
+sys.exit(main())
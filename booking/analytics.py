@@ -0,0 +1,125 @@
+# Sales analytics for the ticket booking system, computed with NumPy over every purchase record
+from datetime import date
+
+import numpy as np
+
+# Layout of one packed purchase record, matching PurchaseHistory.RECORD ("<HHIHiB")
+PURCHASE_DTYPE = np.dtype([
+    ("ticket_id", "<u2"),
+    ("quantity", "<u2"),
+    ("price_cents", "<u4"),
+    ("discount_bps", "<u2"),
+    ("visit_ordinal", "<i4"),
+    ("payment_code", "u1"),
+])
+
+# PurchaseTable class definition: Every purchase as NumPy columns, plus the user each one belongs to
+class PurchaseTable:
+    def __init__(self, records, user_ids, usernames):
+        self.records = records  # Structured array of purchases
+        self.user_ids = user_ids  # Index into usernames for each purchase
+        self.usernames = usernames  # Usernames in the order they were loaded
+        self.money = None  # (paid, discount cost) in dollars, worked out on first use
+
+    def __len__(self):
+        return len(self.records)
+
+    # Column views, for convenience
+    def __getitem__(self, column):
+        return self.records[column]
+
+    # Amount paid and amount given away as discount for each purchase, in dollars
+    def money_columns(self):
+        if self.money is None:
+            paid = self.records["price_cents"].astype(np.float64)
+            discount = self.records["discount_bps"].astype(np.float64) / 10000
+            list_price = np.divide(paid, 1 - discount, out=paid.copy(), where=discount < 1)  # Price before the discount
+            self.money = (paid / 100, (list_price - paid) / 100)
+        return self.money
+
+# Load every purchase from the system into NumPy columns
+def load_purchases(system):
+    buffers = system.purchase_buffers()
+    usernames = [username for username, _ in buffers]
+    counts = np.fromiter((len(data) // PURCHASE_DTYPE.itemsize for _, data in buffers), dtype=np.int64, count=len(buffers))
+    records = np.frombuffer(b"".join(data for _, data in buffers), dtype=PURCHASE_DTYPE)
+    user_ids = np.repeat(np.arange(len(buffers), dtype=np.int32), counts)
+    return PurchaseTable(records, user_ids, usernames)
+
+# Sum units, revenue, discount cost and order count for each group id in [0, size)
+def grouped_totals(table, group_ids, size):
+    paid, discount_cost = table.money_columns()
+    return {
+        "units": np.bincount(group_ids, weights=table["quantity"], minlength=size).astype(np.int64),
+        "revenue": np.bincount(group_ids, weights=paid, minlength=size),
+        "discount_cost": np.bincount(group_ids, weights=discount_cost, minlength=size),
+        "orders": np.bincount(group_ids, minlength=size),
+    }
+
+# Ticket id of each purchase, with ids outside the catalog (e.g. UNKNOWN_TICKET from legacy records) mapped to ticket_count
+def ticket_groups(table, ticket_count):
+    return np.minimum(table["ticket_id"].astype(np.intp), ticket_count)
+
+# Totals per ticket id: units, revenue, discount cost and number of orders; the extra last entry is for unknown tickets
+def sales_by_ticket(table, ticket_count):
+    return grouped_totals(table, ticket_groups(table, ticket_count), ticket_count + 1)
+
+# Totals per period of visit dates, keyed by the ordinal of each period's first day; undated purchases are left out
+def sales_by_period(table, period_days, first_weekday=None):
+    ordinals = table["visit_ordinal"].astype(np.int64)
+    dated = ordinals > 0
+    if not dated.any():
+        return {"start": np.zeros(0, dtype=np.int64), **{name: values[:0] for name, values in grouped_totals(table, np.zeros(len(table), dtype=np.intp), 1).items()}}
+    first = ordinals[dated].min()
+    if first_weekday is not None:
+        first -= (first - 1 - first_weekday) % 7  # Align periods to start on the given weekday
+    # Group 0 collects undated purchases; group k covers the k-th period from the first visit date
+    group_ids = np.where(dated, (ordinals - first) // period_days + 1, 0)
+    size = int(group_ids.max()) + 1
+    totals = grouped_totals(table, group_ids, size)
+    keep = totals["orders"][1:] > 0  # Only periods with sales
+    totals = {name: values[1:][keep] for name, values in totals.items()}
+    totals["start"] = first + np.arange(size - 1, dtype=np.int64)[keep] * period_days
+    return totals
+
+# Totals per visit date; "start" holds each day's ordinal (see datetime.date.fromordinal)
+def sales_by_day(table):
+    return sales_by_period(table, 1)
+
+# Totals per week from Monday to Sunday; "start" holds the ordinal of each week's Monday
+def sales_by_week(table):
+    return sales_by_period(table, 7, first_weekday=0)
+
+# Totals per (ticket, visit date) as 2-D arrays indexed [ticket id, day index]; "start" holds the day ordinals.
+# The extra last row is for unknown tickets.
+def sales_by_ticket_and_day(table, ticket_count):
+    ordinals = table["visit_ordinal"].astype(np.int64)
+    dated = ordinals > 0
+    first = ordinals[dated].min() if dated.any() else 1
+    days = int(ordinals.max() - first) + 1 if dated.any() else 0
+    # The extra column collects undated purchases and is dropped afterwards
+    group_ids = ticket_groups(table, ticket_count) * (days + 1) + np.where(dated, ordinals - first, days)
+    totals = grouped_totals(table, group_ids, (ticket_count + 1) * (days + 1))
+    totals = {name: values.reshape(ticket_count + 1, days + 1)[:, :days] for name, values in totals.items()}
+    totals["start"] = first + np.arange(days, dtype=np.int64)
+    return totals
+
+# Breakdowns shown by the admin view and the week and ticket-day reports: sales per Monday-to-Sunday week of visit dates
+# ("week"), or per ticket and visit date with sales ("ticket-day"). Yields (label, fields naming the row, units, revenue,
+# discount cost, orders) as plain Python values.
+def breakdown_rows(system, kind):
+    table = load_purchases(system)
+    if kind == "week":
+        totals = sales_by_week(table)
+        weeks = [date.fromordinal(int(start)).isoformat() for start in totals["start"]]
+        cells = [(f"Week of {week}", {"week": week}, index) for index, week in enumerate(weeks)]
+    else:
+        totals = sales_by_ticket_and_day(table, len(system.tickets))
+        cells = []
+        for ticket_id, day in zip(*totals["orders"].nonzero()):  # Only the (ticket, date) pairs with sales
+            name = system.tickets[ticket_id].name if ticket_id < len(system.tickets) else "Unknown ticket"
+            visit_date = date.fromordinal(int(totals["start"][day])).isoformat()
+            cells.append((f"{visit_date} {name}", {"date": visit_date, "ticket": int(ticket_id), "name": name}, (ticket_id, day)))
+    for label, fields, index in cells:
+        units, revenue, discounts, orders = (totals[name][index] for name in ("units", "revenue", "discount_cost", "orders"))
+        yield label, fields, int(units), round(float(revenue), 2), round(float(discounts), 2), int(orders)
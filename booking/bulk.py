@@ -0,0 +1,242 @@
+# Streaming import and export of users, tickets and purchase history as CSV or JSON Lines
+import csv
+import functools
+import itertools
+import json
+import sys
+import time
+from collections import namedtuple
+from datetime import date
+
+from booking.core import TicketBookingSystem, SQLiteStorage, Ticket, Purchase, PAYMENT_METHODS
+from booking.core import registration_error, purchase_error, visit_date_ordinal, payment_method_code
+
+# Columns of each kind of record, in file order
+USER_FIELDS = ("username", "password", "email", "phone_number", "dob")
+TICKET_FIELDS = ("ticket_id", "name", "description", "price", "validity", "discount", "terms", "capacity")
+PURCHASE_FIELDS = ("username", "ticket_id", "quantity", "price_cents", "discount_bps", "visit_date", "payment_method")
+
+CHUNK_SIZE = 10000  # Records validated and applied together
+MAX_ERRORS = 100  # Rejected records reported in detail; the rest are only counted
+
+# Outcome of an import; errors holds (line number, message) for the first MAX_ERRORS rejected records
+ImportResult = namedtuple("ImportResult", "records imported rejected errors")
+
+# Whether a file holds JSON Lines rather than CSV, by its extension
+def is_jsonl(path):
+    return path.lower().endswith((".jsonl", ".ndjson"))
+
+# Split an iterable into lists of up to size items
+def chunked(items, size):
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, size))
+        if not chunk:
+            return
+        yield chunk
+
+# Yield (line number, values in field order as text) for every record of a CSV or JSON Lines file; missing fields are "".
+# A JSON line that cannot be read as an object yields (line number, error message) instead.
+def read_records(path, fields):
+    with open(path, newline="", encoding="utf-8") as file:
+        if is_jsonl(path):
+            for line_number, line in enumerate(file, 1):
+                if line.strip():
+                    try:
+                        record = json.loads(line)
+                        values = tuple(text(record.get(field)) for field in fields)
+                    except (ValueError, AttributeError, TypeError):
+                        yield line_number, "Each line must be a JSON object"
+                    else:
+                        yield line_number, values
+        else:
+            reader = csv.reader(file)
+            header = next(reader, [])
+            positions = [header.index(field) if field in header else None for field in fields]
+            if positions == list(range(len(fields))):
+                # Columns in the usual order, so rows are used as they are unless they are short
+                for row in reader:
+                    if len(row) >= len(fields):
+                        yield reader.line_num, row
+                    elif row:
+                        yield reader.line_num, row + [""] * (len(fields) - len(row))
+                return
+            for row in reader:
+                if row:
+                    yield reader.line_num, tuple(row[position] if position is not None and position < len(row) else "" for position in positions)
+
+# Write rows (tuples in field order) to a CSV or JSON Lines file, calling progress(count) after every chunk
+def write_records(path, fields, rows, progress=None):
+    count = 0
+    with open(path, "w", newline="", encoding="utf-8") as file:
+        if is_jsonl(path):
+            for chunk in chunked(rows, CHUNK_SIZE):
+                file.writelines(json.dumps(dict(zip(fields, row))) + "\n" for row in chunk)
+                count += len(chunk)
+                if progress:
+                    progress(count)
+        else:
+            writer = csv.writer(file)
+            writer.writerow(fields)
+            for chunk in chunked(rows, CHUNK_SIZE):
+                writer.writerows(chunk)
+                count += len(chunk)
+                if progress:
+                    progress(count)
+    return count
+
+# Text of a field read from JSON
+def text(value):
+    return "" if value is None else str(value)
+
+# Visit date ordinals; the same few dates come up again and again, so each is parsed once
+cached_visit_ordinal = functools.lru_cache(maxsize=1 << 16)(visit_date_ordinal)
+
+# Check one user record; returns (username, password, email, phone number, dob) or an error message
+def parse_user(values):
+    username, password, email, phone_number, dob = (value.strip() for value in values[:5])
+    error = registration_error(username, password, email, phone_number, dob)  # The same rules as the register window
+    return error or (username, password, email, phone_number, dob)
+
+# Check one ticket record; returns (ticket id, Ticket) or an error message
+def parse_ticket(values):
+    ticket_id, name, description, price, validity, discount, terms, capacity = (value.strip() for value in values[:8])
+    try:
+        ticket_id, price = int(ticket_id), float(price)
+        capacity = int(capacity) if capacity else None
+    except ValueError:
+        return "Ticket id, price and capacity must be numbers"
+    if ticket_id < 0 or not name or price <= 0 or (capacity is not None and capacity < 0):
+        return "A ticket needs an id, a name, a positive price and no negative capacity"
+    return ticket_id, Ticket(name, description, price, validity, discount, terms, capacity)
+
+# Check one purchase record; returns (username, Purchase) or an error message
+def parse_purchase(values):
+    username, ticket_id, quantity, price_cents, discount_bps, visit_date, payment_method = values[:7]
+    username, visit_date, payment_method = username.strip(), visit_date.strip(), payment_method.strip()
+    try:
+        ticket_id, quantity, price_cents, discount_bps = int(ticket_id), int(quantity), int(price_cents), int(discount_bps)
+    except ValueError:
+        return "Ticket id, quantity, price and discount must be whole numbers"
+    if not username:
+        return "Username is required"
+    visit_ordinal = cached_visit_ordinal(visit_date) if visit_date else 0
+    if visit_date and not visit_ordinal:
+        return "Invalid visit date format. Use YYYY-MM-DD."
+    payment_code = PAYMENT_METHODS.index(payment_method) if payment_method in PAYMENT_METHODS else payment_method_code(payment_method)
+    purchase = Purchase(ticket_id, quantity, price_cents, discount_bps, visit_ordinal, payment_code)
+    return purchase_error(purchase) or (username, purchase)
+
+# Read a file in chunks, check each record with parse and hand the good ones to apply, which returns (index, error) pairs
+def import_records(path, fields, parse, apply, progress=None):
+    records = imported = rejected = 0
+    errors = []
+    for chunk in chunked(read_records(path, fields), CHUNK_SIZE):
+        rows, line_numbers = [], []
+        for line_number, values in chunk:
+            row = values if isinstance(values, str) else parse(values)  # A line that could not be read is an error already
+            if isinstance(row, str):
+                rejected += 1
+                if len(errors) < MAX_ERRORS:
+                    errors.append((line_number, row))
+            else:
+                rows.append(row)
+                line_numbers.append(line_number)
+        skipped = apply(rows) if rows else []
+        for index, message in skipped:
+            if len(errors) < MAX_ERRORS:
+                errors.append((line_numbers[index], message))
+        rejected += len(skipped)
+        imported += len(rows) - len(skipped)
+        records += len(chunk)
+        if progress:
+            progress(records)
+    return ImportResult(records, imported, rejected, sorted(errors))
+
+# Import users; passwords may be hashes exported by export_users, or plain text, which is hashed on each user's first login
+def import_users(system, path, progress=None):
+    result = import_records(path, USER_FIELDS, parse_user, system.import_users, progress)
+    system.flush()
+    return result
+
+# Import tickets; existing ticket ids are updated in place and new ones are added to the end of the catalog
+def import_tickets(system, path, progress=None):
+    result = import_records(path, TICKET_FIELDS, parse_ticket, system.import_tickets, progress)
+    system.flush()
+    return result
+
+# Import purchase history for users that already exist
+def import_purchases(system, path, progress=None):
+    result = import_records(path, PURCHASE_FIELDS, parse_purchase, system.import_purchases, progress)
+    system.flush()
+    return result
+
+# Users as rows of USER_FIELDS; passwords are exported as stored, which is a hash for every user that has logged in since
+def user_rows(system):
+    system.flush()  # Storage that reads from disk must see every queued change
+    for user in system.storage.iter_users(system.users):
+        yield user.username, user.password, user.email, user.phone_number, user.dob
+
+# Tickets as rows of TICKET_FIELDS
+def ticket_rows(system):
+    for ticket_id, ticket in enumerate(system.tickets):
+        yield ticket_id, ticket.name, ticket.description, ticket.price, ticket.validity, ticket.discount, ticket.terms, "" if ticket.capacity is None else ticket.capacity
+
+# Every purchase as rows of PURCHASE_FIELDS, one user at a time
+def purchase_rows(system):
+    system.flush()
+    dates = {0: ""}  # Each visit date is formatted once
+    for user in system.storage.iter_users(system.users):
+        for purchase in user.purchase_history:
+            visit_date = dates.get(purchase.visit_ordinal)
+            if visit_date is None:
+                visit_date = dates[purchase.visit_ordinal] = date.fromordinal(purchase.visit_ordinal).isoformat()
+            payment_method = PAYMENT_METHODS[purchase.payment_code] if purchase.payment_code < len(PAYMENT_METHODS) else ""
+            yield user.username, purchase.ticket_id, purchase.quantity, purchase.price_cents, purchase.discount_bps, visit_date, payment_method
+
+# Write every user, ticket or purchase to a file; each returns the number of records written
+def export_users(system, path, progress=None):
+    return write_records(path, USER_FIELDS, user_rows(system), progress)
+
+def export_tickets(system, path, progress=None):
+    return write_records(path, TICKET_FIELDS, ticket_rows(system), progress)
+
+def export_purchases(system, path, progress=None):
+    return write_records(path, PURCHASE_FIELDS, purchase_rows(system), progress)
+
+IMPORTERS = {"users": import_users, "tickets": import_tickets, "purchases": import_purchases}
+EXPORTERS = {"users": export_users, "tickets": export_tickets, "purchases": export_purchases}
+
+# Progress callback that keeps one status line on stderr up to date
+def progress_printer(label):
+    start = time.perf_counter()
+
+    def progress(count):
+        elapsed = time.perf_counter() - start
+        print(f"\r{label}: {count:,} records, {count / elapsed if elapsed else 0:,.0f}/s", end="", file=sys.stderr, flush=True)
+
+    return progress
+
+# Run an import or export: python -m booking.bulk import|export users|tickets|purchases FILE [--db booking.db]
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    storage = None  # Use the pickle files unless a database is given
+    if len(args) >= 2 and args[-2] == "--db":
+        storage = SQLiteStorage(args[-1])
+        args = args[:-2]
+    if len(args) != 3 or args[0] not in ("import", "export") or args[1] not in IMPORTERS:
+        print("usage: python -m booking.bulk import|export users|tickets|purchases FILE [--db booking.db]", file=sys.stderr)
+        sys.exit(2)
+    action, kind, path = args
+    system = TicketBookingSystem(storage=storage)
+    try:
+        if action == "export":
+            count = EXPORTERS[kind](system, path, progress_printer(f"Exporting {kind}"))
+            print(f"\nExported {count:,} {kind} to {path}", file=sys.stderr)
+        else:
+            result = IMPORTERS[kind](system, path, progress_printer(f"Importing {kind}"))
+            print(f"\nImported {result.imported:,} of {result.records:,} {kind} from {path}; {result.rejected:,} rejected", file=sys.stderr)
+            for line_number, message in result.errors:
+                print(f"  line {line_number}: {message}", file=sys.stderr)
+    finally:
+        system.close()
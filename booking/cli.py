@@ -0,0 +1,197 @@
+# Command line for batch jobs against the booking core, without the GUI:
+#   python -m booking [--db booking.db] register USERNAME EMAIL PHONE DOB [--password-stdin]
+#   python -m booking [--db booking.db] purchase USERNAME TICKET [--persons N] [--date YYYY-MM-DD] [--payment METHOD]
+#   python -m booking [--db booking.db] report tickets|ticket|day|payment|age|attendance|week|ticket-day [--from YYYY-MM-DD] [--days N] [--json]
+#   python -m booking convert | migrate-sqlite DB
+# Each command opens the stored data, does one thing, flushes it to storage and exits with 0, or 1 after printing why it failed.
+import sys
+from datetime import date
+
+from booking.core import (
+    TicketBookingSystem, SQLiteStorage, SalesTotals, AGE_BANDS, PAYMENT_METHODS,
+    registration_error, convert_state_files, migrate_pickles_to_sqlite,
+)
+
+ANALYTICS_REPORTS = ("week", "ticket-day")  # Reports worked out from every purchase record with NumPy (booking.analytics)
+REPORTS = ("tickets", *SalesTotals.DIMENSIONS, "attendance", *ANALYTICS_REPORTS)  # Kinds of report the report command prints
+# Arguments are parsed by hand rather than with argparse, whose import and setup alone would double the cold start.
+# Command -> (positional arguments, {option: (argument name, value type, default)}); a type of None marks a flag.
+ARGUMENTS = {
+    "register": (("username", "email", "phone_number", "dob"), {"--password-stdin": ("password_stdin", None, False)}),
+    "purchase": (("username", "ticket"), {"--persons": ("persons", int, None), "--date": ("date", str, None), "--payment": ("payment", str, None)}),
+    "report": (("kind",), {"--from": ("first_date", str, None), "--days": ("days", int, 30), "--json": ("json", None, False)}),
+    "convert": ((), {}),
+    "migrate-sqlite": (("database",), {}),
+}
+USAGE = """usage: python -m booking [--db booking.db] COMMAND ...
+  register USERNAME EMAIL PHONE DOB [--password-stdin]   register a user; the password is prompted for, or read from stdin
+  purchase USERNAME TICKET [--persons N] [--date YYYY-MM-DD] [--payment METHOD]
+                                                         purchase a ticket; TICKET is a number from `report tickets`
+  report {kinds} [--from YYYY-MM-DD] [--days N] [--json]
+                                                         print the ticket list, sales totals, attendance, or (with
+                                                         NumPy) sales per week or per ticket and visit date
+  convert                                                rewrite users.pkl, tickets.pkl and older data files in the binary formats
+  migrate-sqlite DB                                      copy users.pkl and tickets.pkl into an SQLite database
+""".replace("{kinds}", "|".join(REPORTS))
+
+# UsageError class definition: Raised for a command line that cannot be parsed
+class UsageError(Exception):
+    pass
+
+# Arguments class definition: A parsed command line, with the command, --db and one attribute per argument of the command
+class Arguments:
+    def __init__(self, argv):
+        argv = list(argv)
+        self.db = None  # SQLite database to use instead of the state files
+        if argv[:1] == ["--db"]:
+            if len(argv) < 2:
+                raise UsageError("--db needs a database file")
+            self.db, argv = argv[1], argv[2:]
+        if not argv or argv[0] not in ARGUMENTS:
+            raise UsageError("a command is required" if not argv else f"unknown command {argv[0]}")
+        self.command = argv[0]
+        names, options = ARGUMENTS[self.command]
+        for name, _, default in options.values():
+            setattr(self, name, default)
+        positional = []
+        words = iter(argv[1:])
+        for word in words:
+            if word not in options:
+                if word.startswith("--"):
+                    raise UsageError(f"unknown option {word} for {self.command}")
+                positional.append(word)
+                continue
+            name, kind, _ = options[word]
+            if kind is None:
+                setattr(self, name, True)
+                continue
+            value = next(words, None)
+            if value is None:
+                raise UsageError(f"{word} needs a value")
+            setattr(self, name, self.convert(word, value, kind))
+        if len(positional) != len(names):
+            raise UsageError(f"{self.command} takes {' '.join(name.upper() for name in names) or 'no arguments'}")
+        for name, value in zip(names, positional):
+            setattr(self, name, value)
+        if self.command == "purchase":
+            self.ticket = self.convert("TICKET", self.ticket, int)
+        if self.command == "report" and self.kind not in REPORTS:
+            raise UsageError(f"unknown report {self.kind}")
+
+    # A value converted to its type, e.g. a whole number
+    @staticmethod
+    def convert(name, value, kind):
+        try:
+            return kind(value)
+        except ValueError:
+            raise UsageError(f"{name} must be a whole number") from None
+
+# Register one user; the password is prompted for, or read from stdin for scripts
+def register(system, args):
+    if args.password_stdin:
+        password = sys.stdin.readline().rstrip("\r\n")
+    else:
+        from getpass import getpass  # Only needed when a terminal is prompting
+        password = getpass("Password: ")
+    error = registration_error(args.username, password, args.email, args.phone_number, args.dob)
+    if error:
+        raise ValueError(error)
+    if not system.register_user(args.username, password, args.email, args.phone_number, args.dob):
+        raise ValueError("Username already exists!")
+    print(f"Registered {args.username}")
+
+# Purchase one ticket for a user
+def purchase(system, args):
+    if not 0 <= args.ticket < len(system.tickets):
+        raise ValueError(f"Unknown ticket {args.ticket}; see `report tickets` for the ticket numbers.")
+    if args.username not in system.users:
+        raise ValueError(f"User {args.username} not found.")
+    price, ticket_record = system.purchase_ticket(args.username, args.ticket, args.persons, args.date, args.payment)
+    print(f"Ticket Purchased: {ticket_record}\nTotal: ${price:.2f}")
+
+# Rows of a report as (text line, JSON object)
+def report_rows(system, args):
+    if args.kind == "tickets":
+        for ticket_id, ticket in enumerate(system.tickets):
+            capacity = "unlimited" if ticket.capacity is None else f"{ticket.capacity} per day"
+            yield f"{ticket_id}. {ticket.name} - ${ticket.price:,.2f}, {capacity}, sold {ticket.sold_count}", {
+                "id": ticket_id, "name": ticket.name, "price": ticket.price, "capacity": ticket.capacity, "sold_count": ticket.sold_count,
+            }
+    elif args.kind == "attendance":
+        if not 0 < args.days <= 3660:
+            raise ValueError("days must be between 1 and 3660")
+        for visit_date, tickets, visitors in system.attendance(args.first_date, args.days):
+            seats = ", ".join(f"{system.tickets[ticket_id].name} {count}" for ticket_id, count in tickets.items())
+            yield f"{visit_date} - {sum(tickets.values())} seats ({seats}), {visitors} visitors", {
+                "date": visit_date, "tickets": {str(ticket_id): count for ticket_id, count in tickets.items()}, "visitors": visitors,
+            }
+    elif args.kind in ANALYTICS_REPORTS:
+        yield from analytics_rows(system, args.kind)
+    else:
+        names = {
+            "ticket": lambda ticket_id: system.tickets[ticket_id].name if ticket_id < len(system.tickets) else "Unknown ticket",
+            "day": lambda ordinal: date.fromordinal(ordinal).isoformat() if ordinal else "No visit date",
+            "payment": lambda code: PAYMENT_METHODS[code],
+            "age": lambda band: f"Age {AGE_BANDS[band]}",
+        }[args.kind]
+        for key, (units, revenue_cents, discount_cents, orders) in sorted(system.sales_report(args.kind).items()):
+            yield f"{names(key)} - {units} tickets, {orders} orders, ${revenue_cents / 100:,.2f} (discounts ${discount_cents / 100:,.2f})", {
+                "key": key, "name": names(key), "units": units, "revenue": revenue_cents / 100, "discounts": discount_cents / 100, "orders": orders,
+            }
+
+# Rows of a report worked out from every purchase record: sales per week, or per ticket and visit date
+def analytics_rows(system, kind):
+    try:
+        from booking import analytics  # Needs NumPy, which the other commands do not
+    except ImportError:
+        raise ValueError(f"The {kind} report needs NumPy; install it or use the day report") from None
+    for label, fields, units, revenue, discounts, orders in analytics.breakdown_rows(system, kind):
+        yield f"{label} - {units} tickets, {orders} orders, ${revenue:,.2f} (discounts ${discounts:,.2f})", {
+            **fields, "units": units, "revenue": revenue, "discounts": discounts, "orders": orders,
+        }
+
+# Print a report as text lines or a JSON list
+def report(system, args):
+    rows = list(report_rows(system, args))
+    if args.json:
+        import json  # Only needed for JSON output
+        json.dump([row for _, row in rows], sys.stdout, indent=2)
+        print()
+    else:
+        for line, _ in rows:
+            print(line)
+
+COMMANDS = {"register": register, "purchase": purchase, "report": report}  # Commands that run against an open system
+
+# Run one command; returns the process exit status
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] in (["-h"], ["--help"]):
+        print(USAGE, end="")
+        return 0
+    try:
+        args = Arguments(argv)
+    except UsageError as error:
+        print(f"{USAGE}error: {error}", file=sys.stderr)
+        return 2
+    if args.command == "convert":
+        user_count, ticket_count = convert_state_files()
+        print(f"Converted {user_count} users and {ticket_count} tickets")
+        return 0
+    if args.command == "migrate-sqlite":
+        print(f"Migrated {migrate_pickles_to_sqlite(args.database)} users to {args.database}")
+        return 0
+    # Passwords are hashed on this thread: starting hashing processes would cost more than the one hash they save.
+    # The user index and visit calendar are only built if the command reads them (register, report attendance).
+    system = TicketBookingSystem(storage=SQLiteStorage(args.db) if args.db else None, kdf_workers=0, background_builds=False)
+    try:
+        COMMANDS[args.command](system, args)
+    except ValueError as error:  # Bad input, a taken username or email, a sold-out date
+        print(f"Error: {error}", file=sys.stderr)
+        return 1
+    finally:
+        system.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2724 @@
+# GUI-free booking core: tickets, users, storage backends, pricing, inventory and the TicketBookingSystem itself.
+# Nothing here needs Tk or a display, so services, batch jobs and the CLI import this module and never the GUI.
+import pickle
+import copy
+import os
+import io
+import mmap
+import struct
+import hashlib
+import bisect
+import sys
+import queue
+import atexit
+import threading
+import time
+import heapq
+import itertools
+import hmac
+import secrets
+from contextlib import contextmanager, ExitStack
+from collections import namedtuple, OrderedDict, deque
+from collections.abc import MutableMapping
+from datetime import date
+import re
+
+# Restore attributes pickled either as an instance dictionary or as slots
+def restore_slots(obj, state):
+    if isinstance(state, tuple):  # (dict state, slot state) as written by default pickling
+        state = {**(state[0] or {}), **(state[1] or {})}
+    for name, value in state.items():
+        setattr(obj, name, value)
+
+# Ticket class definition: Stores details of a ticket
+class Ticket:
+    __slots__ = ("name", "description", "price", "validity", "discount", "terms", "sold_count", "capacity")
+
+    def __init__(self, name, description, price, validity, discount, terms, capacity=None):
+        # Initialize ticket attributes
+        self.name = name
+        self.description = description
+        self.price = price
+        self.validity = validity
+        self.discount = discount
+        self.terms = terms
+        self.sold_count = 0  # Track number of tickets sold
+        self.capacity = capacity  # Tickets available per visit date, or None for unlimited
+
+    def __str__(self):
+        # Define how to represent a ticket as a string
+        return f"{self.name} - {self.price} USD (Sold: {self.sold_count})"
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        self.sold_count = 0  # Older ticket files may not have a sold count
+        restore_slots(self, state)
+        if not hasattr(self, "capacity"):
+            self.capacity = DEFAULT_CAPACITIES.get(self.name)  # Saved before tickets had a capacity
+
+# Tickets available per visit date for limited default tickets
+DEFAULT_CAPACITIES = {"VIP Experience Pass": 50}
+
+# Discount texts saved by earlier versions that misstate the discount applied, and their corrections
+DISCOUNT_TEXT_FIXES = {"20% off for groups of 20 or more": "20% off for groups of more than 10"}
+
+# Names of the default tickets, used to read purchase records saved as text
+DEFAULT_TICKET_NAMES = ("Single Day Pass", "Two-Day Pass", "Annual Membership", "Child Ticket", "Group Ticket (10+)", "VIP Experience Pass")
+
+# Payment methods stored by code in purchase records
+PAYMENT_METHODS = ("Other", "Credit/Debit Card", "Cash", "Bank Transfer", "Digital Wallet")
+PAYMENT_KEYWORDS = (("card", 1), ("credit", 1), ("debit", 1), ("cash", 2), ("bank", 3), ("transfer", 3), ("wallet", 4), ("pay", 4))
+
+# Map a payment method entered by the user to its code
+def payment_method_code(payment_method):
+    text = (payment_method or "").lower()
+    for keyword, code in PAYMENT_KEYWORDS:
+        if keyword in text:
+            return code
+    return 0  # Other
+
+# Dates are entered as YYYY-MM-DD; matching them with a compiled pattern is much faster than strptime
+DATE_FORMAT = re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})")
+
+# Parse a YYYY-MM-DD date, or return None if it is missing or invalid
+def parse_date(text):
+    match = DATE_FORMAT.fullmatch(text) if isinstance(text, str) else None
+    if match is None:
+        return None
+    try:
+        return date(int(match[1]), int(match[2]), int(match[3]))
+    except ValueError:
+        return None  # No such day, e.g. 2026-02-30
+
+# Convert a visit date (YYYY-MM-DD) to a day ordinal, or 0 if it is missing or invalid
+def visit_date_ordinal(visit_date):
+    day = parse_date(visit_date)
+    return day.toordinal() if day else 0
+
+# Day ordinal of a visit date given with a quote or purchase: 0 if none is given, ValueError if it is not a real date
+def checked_visit_ordinal(visit_date):
+    if not visit_date:
+        return 0
+    day = parse_date(visit_date.strip() if isinstance(visit_date, str) else visit_date)
+    if day is None:
+        raise ValueError("Invalid visit date format. Use YYYY-MM-DD.")
+    return day.toordinal()
+
+# Formats accepted for new users' contact details
+EMAIL_FORMAT = re.compile(r"[^@]+@[^@]+\.[^@]+")
+PHONE_FORMAT = re.compile(r"^\+?1?\d{9,15}$")
+
+# Check the details of a new user; returns an error message, or None if they are valid
+def registration_error(username, password, email, phone_number, dob):
+    if not username or not password or not email or not phone_number or not dob:
+        return "All fields are required!"
+    if not EMAIL_FORMAT.match(email):
+        return "Invalid email format!"
+    if not PHONE_FORMAT.match(phone_number):
+        return "Invalid phone number format!"
+    if parse_date(dob) is None:
+        return "Invalid date of birth format. Use YYYY-MM-DD."
+    return None
+
+# Cost parameters for new password hashes; stored hashes keep the parameters they were made with
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2 ** 14, 8, 1
+
+# Derive a password key with scrypt (runs in the password hashing processes)
+def derive_key(password, salt, n, r, p):
+    return hashlib.scrypt(password.encode("utf-8"), salt=salt, n=n, r=r, p=p, maxmem=2 * 128 * r * n, dklen=32)
+
+# Check whether a stored password is a hash rather than plain text saved by earlier versions
+def is_password_hash(stored):
+    return isinstance(stored, str) and stored.startswith("scrypt$")
+
+# PasswordHasher class definition: Salted scrypt hashing, done in a process pool so it never holds up other threads
+class PasswordHasher:
+    def __init__(self, workers=None):
+        self.workers = workers  # Pool size; 0 hashes on the calling thread
+        self.pool = None  # Created on first use
+        self.lock = threading.Lock()
+
+    # The hashing processes, started on first use
+    def executor(self):
+        with self.lock:
+            if self.pool is None:
+                from concurrent.futures import ProcessPoolExecutor  # Imported here: it loads multiprocessing, which tools that never hash skip
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self.pool
+
+    # Run a key derivation in the pool and wait for its result
+    def run(self, *args):
+        if self.workers == 0:
+            return derive_key(*args)
+        return self.executor().submit(derive_key, *args).result()
+
+    # Hash a password as scrypt$n$r$p$salt$key
+    def hash(self, password):
+        salt = os.urandom(16)
+        key = self.run(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)
+        return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt.hex()}${key.hex()}"
+
+    # Check a password against a stored hash, or against plain text saved by earlier versions
+    def verify(self, password, stored):
+        if not is_password_hash(stored):
+            return hmac.compare_digest(password.encode("utf-8"), str(stored).encode("utf-8"))
+        _, n, r, p, salt, key = stored.split("$")
+        return hmac.compare_digest(self.run(password, bytes.fromhex(salt), int(n), int(r), int(p)), bytes.fromhex(key))
+
+    # Stop the hashing processes
+    def close(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+
+# SessionCache class definition: Session tokens issued at login, dropped when unused for ttl seconds or least recently used
+class SessionCache:
+    def __init__(self, max_sessions=100000, ttl=1800):
+        self.max_sessions = max_sessions  # Most sessions kept; the least recently used go first
+        self.ttl = ttl  # Seconds a session stays valid after its last use
+        self.sessions = OrderedDict()  # Token -> (username, expiry time), least recently used first
+        self.lock = threading.Lock()
+
+    # Open a session for a user whose password has been checked and return its token
+    def open(self, username):
+        token = secrets.token_urlsafe(32)
+        now = time.monotonic()
+        with self.lock:
+            # Every use pushes the expiry back by the same ttl, so the oldest entries are also the first to expire
+            while self.sessions and (len(self.sessions) >= self.max_sessions or next(iter(self.sessions.values()))[1] <= now):
+                self.sessions.popitem(last=False)
+            self.sessions[token] = (username, now + self.ttl)
+        return token
+
+    # Username of a live session, or None; using a session keeps it alive
+    def user(self, token):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.get(token)
+            if entry is None:
+                return None
+            if entry[1] <= now:
+                del self.sessions[token]
+                return None
+            self.sessions[token] = (entry[0], now + self.ttl)
+            self.sessions.move_to_end(token)
+            return entry[0]
+
+    # End one session
+    def close(self, token):
+        with self.lock:
+            self.sessions.pop(token, None)
+
+    # End every session of a user
+    def close_user(self, username):
+        with self.lock:
+            for token in [token for token, (owner, _) in self.sessions.items() if owner == username]:
+                del self.sessions[token]
+
+# Raised when a new or changed email address already belongs to another user
+class DuplicateEmailError(ValueError):
+    pass
+
+# Form of an email address used for lookups and the uniqueness check
+def normalize_email(email):
+    return (email or "").strip().lower()
+
+# BuildEvent class definition: Set once a background build is done. A build left for first use is started by the
+# first caller that waits for it or asks whether it is done, so one-shot commands never build what they do not read.
+class BuildEvent(threading.Event):
+    def __init__(self):
+        super().__init__()
+        self.starter = None  # Starts the build, while it is left for first use
+        self.starter_lock = threading.Lock()
+
+    # Start the build if it was left for first use and nobody has started it yet
+    def start(self):
+        with self.starter_lock:
+            starter, self.starter = self.starter, None
+        if starter is not None:
+            starter()
+
+    def is_set(self):
+        self.start()
+        return super().is_set()
+
+    def wait(self, timeout=None):
+        self.start()
+        return super().wait(timeout)
+
+# UserIndex class definition: Secondary indexes for finding users by email, phone number or username prefix
+class UserIndex:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.emails = {}  # Normalized email -> username, or a tuple of usernames for emails saved before they were unique
+        self.phones = {}  # Phone number -> username, or a tuple of usernames sharing it
+        self.names = []  # Every username, sorted, for prefix searches
+        self.touched = set()  # Usernames changed while the index is being built; None once it is ready
+        self.ready = BuildEvent()  # Set once the existing users have been indexed
+
+    # Add a username under a key of a hash index
+    @staticmethod
+    def add_key(index, key, username):
+        if not key:
+            return
+        owners = index.get(key)
+        if owners is None:
+            index[key] = username
+        elif owners != username and username not in (owners if isinstance(owners, tuple) else (owners,)):
+            index[key] = (owners if isinstance(owners, tuple) else (owners,)) + (username,)
+
+    # Remove a username from under a key of a hash index
+    @staticmethod
+    def remove_key(index, key, username):
+        owners = index.get(key)
+        if owners == username:
+            del index[key]
+        elif isinstance(owners, tuple) and username in owners:
+            owners = tuple(owner for owner in owners if owner != username)
+            index[key] = owners[0] if len(owners) == 1 else owners
+
+    # Usernames under a key of a hash index
+    @staticmethod
+    def owners(index, key):
+        owners = index.get(key, ())
+        return list(owners) if isinstance(owners, tuple) else [owners]
+
+    # Index the existing users, given as (username, email, phone number) (runs on a background thread)
+    def build(self, contacts):
+        contacts = list(contacts)
+        with self.lock:
+            names = set(self.names)  # Users added while the build was running
+            for username, email, phone_number in contacts:
+                if username in self.touched:
+                    continue  # Indexed as it changed, with newer details than the snapshot
+                self.add_key(self.emails, normalize_email(email), username)
+                self.add_key(self.phones, phone_number, username)
+                names.add(username)
+            self.names = sorted(names)
+            self.touched = None
+        self.ready.set()
+
+    # Index a new user
+    def add(self, username, email, phone_number):
+        with self.lock:
+            self.add_key(self.emails, normalize_email(email), username)
+            self.add_key(self.phones, phone_number, username)
+            position = bisect.bisect_left(self.names, username)
+            if position == len(self.names) or self.names[position] != username:
+                self.names.insert(position, username)
+            if self.touched is not None:
+                self.touched.add(username)
+
+    # Re-index a user whose email or phone number changed
+    def change(self, username, old_email, old_phone, email, phone_number):
+        with self.lock:
+            self.remove_key(self.emails, normalize_email(old_email), username)
+            self.remove_key(self.phones, old_phone, username)
+            self.add_key(self.emails, normalize_email(email), username)
+            self.add_key(self.phones, phone_number, username)
+            if self.touched is not None:
+                self.touched.add(username)
+
+    # Drop a deleted user
+    def remove(self, username, email, phone_number):
+        with self.lock:
+            self.remove_key(self.emails, normalize_email(email), username)
+            self.remove_key(self.phones, phone_number, username)
+            position = bisect.bisect_left(self.names, username)
+            if position < len(self.names) and self.names[position] == username:
+                del self.names[position]
+            if self.touched is not None:
+                self.touched.add(username)
+
+    # Check whether an email address belongs to a user other than the given one
+    def email_taken(self, email, username=None):
+        self.ready.wait()
+        with self.lock:
+            return any(owner != username for owner in self.owners(self.emails, normalize_email(email)))
+
+    # One page of usernames matching an email, a phone number or a username prefix, and the number of matches
+    def search(self, prefix="", email=None, phone_number=None, offset=0, limit=50):
+        self.ready.wait()
+        with self.lock:
+            if email is not None:
+                matches = sorted(self.owners(self.emails, normalize_email(email)))
+            elif phone_number is not None:
+                matches = sorted(self.owners(self.phones, phone_number.strip()))
+            else:
+                start = bisect.bisect_left(self.names, prefix)
+                end = bisect.bisect_left(self.names, prefix + "\U0010ffff") if prefix else len(self.names)
+                return self.names[start + offset:min(start + offset + limit, end)], end - start
+        return matches[offset:offset + limit], len(matches)
+
+# Age bands used in sales reports; band 0 is for buyers without a usable date of birth
+AGE_BANDS = ("Unknown", "Under 13", "13-17", "18-24", "25-34", "35-49", "50-64", "65+")
+AGE_BAND_LIMITS = (0, 13, 18, 25, 35, 50, 65)  # Lowest age in each band after "Unknown"
+
+# Age band of a buyer born on dob (YYYY-MM-DD) on the visit date, or today for undated visits
+def age_band(dob, visit_ordinal=0):
+    born = parse_date(dob)
+    if born is None:
+        return 0
+    on = date.fromordinal(visit_ordinal) if visit_ordinal > 0 else date.today()
+    age = on.year - born.year - ((on.month, on.day) < (born.month, born.day))
+    return bisect.bisect_right(AGE_BAND_LIMITS, age) if age >= 0 else 0
+
+# Split the purchase fields of a change record into the stored purchase and the buyer's age band
+def split_purchase(fields):
+    return fields[:6], (fields[6] if len(fields) > 6 else 0)  # Records written before age bands count as "Unknown"
+
+# A single purchase as stored in a user's history
+Purchase = namedtuple("Purchase", "ticket_id quantity price_cents discount_bps visit_ordinal payment_code")
+
+# Purchase records saved as text by earlier versions of the app
+LEGACY_PURCHASE = re.compile(r"^(?P<name>.*?)(?: \((?P<quantity>\d+) people\))? - \$(?P<price>[\d.]+) USD \(Discount Applied: (?P<discount>\d+)%\)$")
+UNKNOWN_TICKET = 0xFFFF  # Ticket id for records that name no known ticket
+
+# Check a purchase against the ranges its packed record can hold; returns an error message, or None if it fits
+def purchase_error(purchase):
+    if not 0 <= purchase.ticket_id <= UNKNOWN_TICKET:
+        return "Ticket id out of range!"
+    if not 0 < purchase.quantity <= 0xFFFF:
+        return "Quantity must be between 1 and 65535!"
+    if not 0 <= purchase.price_cents < 2 ** 32:
+        return "The total price is too large for one purchase; split it into smaller orders."
+    if not 0 <= purchase.discount_bps <= 10000:
+        return "Discount must be between 0% and 100%!"
+    return None
+
+# Render a purchase the way it is shown to the user
+def render_purchase(purchase, tickets):
+    name = tickets[purchase.ticket_id].name if purchase.ticket_id < len(tickets) else "Unknown Ticket"
+    people = f" ({purchase.quantity} people)" if purchase.quantity > 1 else ""
+    return f"{name}{people} - ${purchase.price_cents / 100:.2f} USD (Discount Applied: {purchase.discount_bps // 100}%)"
+
+# PurchaseHistory class definition: Packed fixed-width purchase records, rendered as text only for display
+class PurchaseHistory:
+    __slots__ = ("data",)
+    # Ticket id, quantity, price in cents, discount in basis points, visit date ordinal, payment method code
+    RECORD = struct.Struct("<HHIHiB")
+
+    def __init__(self, data=b""):
+        self.data = bytearray(data)  # One packed record per purchase
+
+    def append(self, ticket_id, quantity, price_cents, discount_bps, visit_ordinal=0, payment_code=0):
+        self.data += self.RECORD.pack(ticket_id, quantity, price_cents, discount_bps, visit_ordinal, payment_code)
+
+    # Add a purchase record saved as text by earlier versions of the app
+    def append_legacy(self, ticket_record):
+        match = LEGACY_PURCHASE.match(ticket_record)
+        if not match:
+            return  # Not a purchase record
+        ticket_id = UNKNOWN_TICKET
+        names = [name for name in DEFAULT_TICKET_NAMES if match["name"].startswith(name)]
+        if names:
+            ticket_id = DEFAULT_TICKET_NAMES.index(max(names, key=len))
+        self.append(ticket_id, int(match["quantity"] or 1), round(float(match["price"]) * 100), int(match["discount"]) * 100)
+
+    def __len__(self):
+        return len(self.data) // self.RECORD.size
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("purchase index out of range")
+        return Purchase(*self.RECORD.unpack_from(self.data, idx * self.RECORD.size))
+
+    def __iter__(self):
+        return (Purchase(*fields) for fields in self.RECORD.iter_unpack(self.data))
+
+    # Render every purchase as display text
+    def render(self, tickets):
+        return [render_purchase(purchase, tickets) for purchase in self]
+
+    # Up to limit purchases starting at offset, unpacked from just their slice of the records
+    def page(self, offset, limit):
+        start = max(offset, 0) * self.RECORD.size
+        end = min(start + max(limit, 0) * self.RECORD.size, len(self.data))
+        return [Purchase(*fields) for fields in self.RECORD.iter_unpack(self.data[start:max(start, end)])]
+
+    def __getstate__(self):
+        return bytes(self.data)
+
+    def __setstate__(self, state):
+        self.data = bytearray(state)
+
+# User class definition: Stores user information and their purchase history
+class User:
+    __slots__ = ("username", "password", "email", "phone_number", "dob", "purchase_history")
+
+    def __init__(self, username, password, email, phone_number, dob):
+        # Initialize user attributes
+        self.username = username
+        self.password = password
+        self.email = email
+        self.phone_number = phone_number
+        self.dob = dob
+        self.purchase_history = PurchaseHistory()  # Packed records of the user's ticket purchases
+
+    def add_purchase(self, ticket_id, quantity, price_cents, discount_bps, visit_ordinal=0, payment_code=0):
+        # Add a purchased ticket to the user's purchase history
+        self.purchase_history.append(ticket_id, quantity, price_cents, discount_bps, visit_ordinal, payment_code)
+
+    def update_details(self, email=None, phone_number=None, dob=None):
+        # Update the user's details if provided
+        if email:
+            self.email = email
+        if phone_number:
+            self.phone_number = phone_number
+        if dob:
+            self.dob = dob
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state):
+        restore_slots(self, state)
+        if isinstance(self.purchase_history, list):
+            # Convert text purchase records saved by earlier versions
+            history = PurchaseHistory()
+            for ticket_record in self.purchase_history:
+                history.append_legacy(ticket_record)
+            self.purchase_history = history
+
+# SalesTotals class definition: Running sales totals per ticket, visit date, payment method and age band
+class SalesTotals:
+    DIMENSIONS = ("ticket", "day", "payment", "age")  # Keyed by ticket id, visit date ordinal, payment code and age band
+
+    def __init__(self, totals=None):
+        self.lock = threading.Lock()  # Purchases of different tickets update the same totals
+        # dimension -> key -> [units, revenue in cents, discount in cents, orders]
+        self.totals = {dimension: {} for dimension in self.DIMENSIONS}
+        for dimension, rows in (totals or {}).items():
+            self.totals[dimension] = {key: list(row) for key, row in rows.items()}
+
+    # Rows of (dimension, key, units, revenue cents, discount cents, orders) that one purchase adds
+    @classmethod
+    def rows(cls, purchase, band):
+        ticket_id, quantity, price_cents, discount_bps, visit_ordinal, payment_code = purchase
+        discount_cents = round(price_cents * discount_bps / (10000 - discount_bps)) if discount_bps < 10000 else 0
+        keys = (ticket_id, visit_ordinal, payment_code, band)
+        return [(dimension, key, quantity, price_cents, discount_cents, 1) for dimension, key in zip(cls.DIMENSIONS, keys)]
+
+    # Add one purchase to every total
+    def add(self, purchase, band):
+        rows = self.rows(purchase, band)
+        with self.lock:
+            for dimension, key, *amounts in rows:
+                totals = self.totals[dimension].get(key)
+                if totals is None:
+                    totals = self.totals[dimension][key] = [0, 0, 0, 0]
+                for idx, amount in enumerate(amounts):
+                    totals[idx] += amount
+
+    # Add many (purchase, age band) pairs at once, taking the lock once
+    def add_many(self, purchases):
+        tables = [self.totals[dimension] for dimension in self.DIMENSIONS]
+        with self.lock:
+            for (ticket_id, quantity, price_cents, discount_bps, visit_ordinal, payment_code), band in purchases:
+                discount_cents = round(price_cents * discount_bps / (10000 - discount_bps)) if discount_bps < 10000 else 0
+                for table, key in zip(tables, (ticket_id, visit_ordinal, payment_code, band)):
+                    totals = table.get(key)
+                    if totals is None:
+                        totals = table[key] = [0, 0, 0, 0]
+                    totals[0] += quantity
+                    totals[1] += price_cents
+                    totals[2] += discount_cents
+                    totals[3] += 1
+
+    # Totals for one dimension as key -> (units, revenue cents, discount cents, orders)
+    def report(self, dimension):
+        with self.lock:
+            return {key: tuple(totals) for key, totals in self.totals[dimension].items()}
+
+    # Plain copy of every total, for storage
+    def state(self):
+        return {dimension: self.report(dimension) for dimension in self.DIMENSIONS}
+
+    # Recompute the totals from scratch from the purchase histories of the given users. If seats is given, it is also
+    # filled with the seats bought per (ticket id, visit date ordinal), from the same pass over the histories.
+    @classmethod
+    def from_users(cls, users, seats=None):
+        sales = cls()
+        for user in users:
+            bands = {}  # Age band per visit date, so the date of birth is parsed once per date
+            for purchase in user.purchase_history:
+                if purchase.visit_ordinal not in bands:
+                    bands[purchase.visit_ordinal] = age_band(user.dob, purchase.visit_ordinal)
+                sales.add(purchase, bands[purchase.visit_ordinal])
+                if seats is not None:
+                    key = (purchase.ticket_id, purchase.visit_ordinal)
+                    seats[key] = seats.get(key, 0) + purchase.quantity
+        return sales
+
+# VisitCalendar class definition: Who visits on each date, as one bitmap per visit date over numbered users
+class VisitCalendar:
+    NONZERO = re.compile(rb"[^\x00]")  # Bytes of a bitmap with any bit set
+    BUILD_BATCH = 1000  # Users indexed per lock acquisition while building
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.visitors = {}  # Visit date ordinal -> bytearray whose bit n is set if user number n visits that day
+        self.counts = {}  # Visit date ordinal -> bits set in its bitmap
+        self.numbers = {}  # Username -> user number
+        self.usernames = []  # User number -> username, or None once deleted; numbers are never reused
+        self.removed = set()  # Users deleted while the calendar is being built; None once it is ready
+        self.ready = BuildEvent()  # Set once the stored purchases have been indexed
+
+    # Number of a user, given out on first sight (caller holds the lock)
+    def number(self, username):
+        number = self.numbers.get(username)
+        if number is None:
+            number = self.numbers[username] = len(self.usernames)
+            self.usernames.append(username)
+        return number
+
+    # Set the bits of user numbers on each date, given as date ordinal -> user numbers (caller holds the lock);
+    # setting a bit twice changes nothing
+    def mark(self, numbers_by_ordinal):
+        for ordinal, numbers in numbers_by_ordinal.items():
+            bits = self.visitors.get(ordinal)
+            if bits is None:
+                bits = self.visitors[ordinal] = bytearray()
+            size = (max(numbers) >> 3) + 1
+            if size > len(bits):
+                bits.extend(bytes(size - len(bits)))
+            added = 0
+            for number in numbers:
+                byte, mask = number >> 3, 1 << (number & 7)
+                if not bits[byte] & mask:
+                    bits[byte] |= mask
+                    added += 1
+            self.counts[ordinal] = self.counts.get(ordinal, 0) + added
+
+    # Clear a user's bit on each of the given dates (caller holds the lock)
+    def unmark(self, number, ordinals):
+        byte, mask = number >> 3, 1 << (number & 7)
+        for ordinal in ordinals:
+            bits = self.visitors.get(ordinal)
+            if bits is not None and byte < len(bits) and bits[byte] & mask:
+                bits[byte] ^= mask
+                self.counts[ordinal] -= 1
+
+    # Record that a user visits on the given date ordinals; undated purchases are not in the calendar
+    def add(self, username, ordinals):
+        if any(ordinals):
+            with self.lock:
+                number = self.number(username)
+                self.mark({ordinal: (number,) for ordinal in ordinals if ordinal})
+
+    # Record the visits of many users, given as username -> date ordinals
+    def add_many(self, visits):
+        numbers_by_ordinal = {}
+        with self.lock:
+            for username, ordinals in visits.items():
+                if any(ordinals):
+                    number = self.number(username)
+                    for ordinal in ordinals:
+                        if ordinal:
+                            numbers_by_ordinal.setdefault(ordinal, []).append(number)
+            self.mark(numbers_by_ordinal)
+
+    # Drop a deleted user, given the dates of their purchases
+    def remove(self, username, ordinals):
+        with self.lock:
+            number = self.numbers.pop(username, None)
+            if number is not None:
+                self.unmark(number, ordinals)
+                self.usernames[number] = None
+            if self.removed is not None:
+                self.removed.add(username)  # The build may still come across the user in its snapshot
+
+    # Index the stored purchases, given as (username, packed purchase records) (runs on a background thread). Visits
+    # recorded meanwhile are just marked again; users deleted meanwhile are dropped once exists(username) says so.
+    def build(self, buffers, exists):
+        unpack = PurchaseHistory.RECORD.iter_unpack
+        buffers = iter(buffers)
+        while True:
+            batch = [(username, {fields[4] for fields in unpack(data)}) for username, data in itertools.islice(buffers, self.BUILD_BATCH)]
+            if not batch:
+                break
+            self.add_many(dict(batch))
+        with self.lock:
+            for username in self.removed:
+                number = self.numbers.get(username)
+                if number is not None and not exists(username):
+                    del self.numbers[username]
+                    self.unmark(number, list(self.visitors))
+                    self.usernames[number] = None
+            self.removed = None
+        self.ready.set()
+
+    # Distinct visitors on each of the given date ordinals
+    def visitor_counts(self, ordinals):
+        self.ready.wait()
+        with self.lock:
+            return {ordinal: self.counts.get(ordinal, 0) for ordinal in ordinals}
+
+    # One page of the users visiting on a date, in the order they were first seen, and the number of visitors
+    def visitors_on(self, ordinal, offset=0, limit=50):
+        self.ready.wait()
+        page = []
+        with self.lock:
+            bits = self.visitors.get(ordinal, b"")
+            for match in self.NONZERO.finditer(bits):
+                if len(page) >= limit:
+                    break
+                byte = match.start()
+                value = bits[byte]
+                visitors = bin(value).count("1")
+                if offset >= visitors:
+                    offset -= visitors  # Whole byte before the page
+                    continue
+                for bit in range(8):
+                    if value >> bit & 1 and len(page) < limit:
+                        if offset:
+                            offset -= 1
+                        else:
+                            page.append(self.usernames[byte * 8 + bit])
+            return page, self.counts.get(ordinal, 0)
+
+# Write a file through a temporary file that replaces it only once it is complete and on disk
+@contextmanager
+def replace_atomically(path):
+    temp_file = f"{path}.{os.getpid()}.tmp"  # Per process, as shard processes share the tickets file
+    with open(temp_file, "wb") as file:
+        yield file
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp_file, path)  # Readers see either the old file or the new one, never half of one
+
+# UserJournal class definition: Append-only log of user changes made since the last snapshot
+class UserJournal:
+    def __init__(self, path, sync_every=32):
+        # Initialize the journal file and the fsync batching state
+        self.path = path  # File to store journal records
+        self.sync_every = sync_every  # Number of records written between fsync calls
+        self.unsynced = 0  # Records written since the last fsync
+        self.record_count = 0  # Records in the journal since the last snapshot
+        self.file = None  # Open append handle, created on first write
+
+    # Identify a snapshot file so a journal can tell which snapshot it belongs to
+    @staticmethod
+    def snapshot_token(snapshot_file):
+        if not os.path.exists(snapshot_file):
+            return None  # No snapshot written yet
+        stat = os.stat(snapshot_file)
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    # Read the journal and return its records, and whether they still need to be applied to the given snapshot
+    def replay(self, snapshot_token):
+        if not os.path.exists(self.path):
+            return [], False  # Nothing to recover
+        records = []
+        good_offset = 0  # Offset just after the last complete record
+        with open(self.path, "rb") as file:
+            try:
+                header = StateUnpickler(file).load()
+                good_offset = file.tell()
+                while True:
+                    records.append(StateUnpickler(file).load())
+                    good_offset = file.tell()
+            except EOFError:
+                pass  # Reached the end of the journal
+            except (pickle.UnpicklingError, ValueError, AttributeError, IndexError):
+                pass  # Torn record left behind by a crash
+        if good_offset == 0 or header != ("journal", snapshot_token):
+            # The snapshot was rewritten after this journal was started, so its records are already in it
+            return records, False
+        if good_offset < os.path.getsize(self.path):
+            # Drop the partially written record at the end of the file
+            with open(self.path, "r+b") as file:
+                file.truncate(good_offset)
+        self.record_count = len(records)
+        return records, True
+
+    # Append one record to the journal
+    def append(self, record):
+        if self.file is None:
+            self.file = open(self.path, "ab")
+        pickle.dump(record, self.file)
+        self.file.flush()  # Hand the record to the OS so a process crash cannot lose it
+        self.record_count += 1
+        self.unsynced += 1
+        if self.unsynced >= self.sync_every:
+            self.sync()
+
+    # Force journal records to disk
+    def sync(self):
+        if self.file is not None and self.unsynced:
+            os.fsync(self.file.fileno())
+            self.unsynced = 0
+
+    # Start a new journal for a freshly written snapshot, beginning with records carried over from the old one
+    def reset(self, snapshot_token, carried=()):
+        self.close()
+        with replace_atomically(self.path) as file:  # Never leave a half-written journal behind
+            pickle.dump(("journal", snapshot_token), file)
+            for record in carried:
+                pickle.dump(record, file)
+        self.record_count = 0
+
+    # Flush and close the journal file
+    def close(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+# Default set of tickets used when no ticket data has been saved yet
+def default_tickets():
+    return [
+        Ticket("Single Day Pass", "Access to the park for one day", 275, "1 day", "None", "Valid only on selected date"),
+        Ticket("Two-Day Pass", "Access to the park for two consecutive days", 480, "2 days", "10% discount for online purchase", "Cannot be split over multiple trips"),
+        Ticket("Annual Membership", "Unlimited access for one year", 1840, "1 year", "15% discount on renewal", "Must be used by the same person"),
+        Ticket("Child Ticket", "Discounted ticket for children (ages 3-12)", 185, "1 day", "None", "Valid only on selected date, must be accompanied by an adult"),
+        Ticket("Group Ticket (10+)", "Special rate for groups of 10 or more", 220, "1 day", "20% off for groups of more than 10", "Must be booked in advance"),
+        Ticket("VIP Experience Pass", "Includes expedited access and reserved seating for shows", 550, "1 day", "None", "Limited availability, must be purchased in advance", DEFAULT_CAPACITIES["VIP Experience Pass"])
+    ]
+
+# Apply a single change record to a dictionary of users
+def apply_user_change(users, record):
+    action = record[0]
+    if action == "register":
+        user = record[1] if isinstance(record[1], User) else User(*record[1:6])  # Older journals hold the user object
+        users[user.username] = user
+    elif action == "users":
+        for details in record[1]:
+            users[details[0]] = User(*details)
+    elif action == "purchase":
+        user = users.get(record[1])
+        if user and isinstance(record[2], str):
+            user.purchase_history.append_legacy(record[2])  # Journal written by an earlier version
+        elif user:
+            user.add_purchase(*split_purchase(record[2:])[0])
+    elif action == "update":
+        user = users.get(record[1])
+        if user:
+            user.update_details(*record[2:5])
+    elif action == "password":
+        user = users.get(record[1])
+        if user:
+            user.password = record[2]
+    elif action == "purchases":
+        for username, *purchase in record[1]:
+            user = users.get(username)
+            if user:
+                user.add_purchase(*split_purchase(purchase)[0])
+    elif action == "delete":
+        users.pop(record[1], None)
+
+# Unpickler for pickled state files and journals. It maps classes saved by the app when run as a script, or from
+# Python_Code before the core moved into this package, back to this module and refuses every other class, so a
+# tampered file cannot make loading it run arbitrary code.
+class StateUnpickler(pickle.Unpickler):
+    STATE_CLASSES = ("User", "Ticket", "PurchaseHistory")
+    STATE_MODULES = ("__main__", "Python_Code", __name__)
+    SAFE_GLOBALS = {("builtins", "bytearray"), ("builtins", "set"), ("builtins", "frozenset"), ("builtins", "object"), ("copyreg", "_reconstructor")}
+
+    def find_class(self, module, name):
+        if module in self.STATE_MODULES and name in self.STATE_CLASSES:
+            return globals()[name]
+        if (module, name) in self.SAFE_GLOBALS:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError(f"Refusing to load {module}.{name} from a state file")
+
+# Read a field value written as ASCII text by RecordSchema
+def parse_number(data):
+    text = str(data, "ascii")
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+# RecordSchema class definition: Binary layout of one kind of record in the state files. A record is a field count
+# byte, a 32-bit length per field, then the fields. Readers ignore fields added after their time and give fields
+# missing from older records their defaults, so fields can be added at the end without changing the file format.
+class RecordSchema:
+    ENCODERS = {
+        "text": lambda value: value.encode("utf-8"),
+        "bytes": bytes,
+        "number": lambda value: repr(value).encode("ascii"),
+        "optional number": lambda value: b"" if value is None else repr(value).encode("ascii"),
+    }
+    DECODERS = {
+        "text": bytes.decode,
+        "bytes": None,  # Slicing the buffer already gives bytes
+        "number": parse_number,
+        "optional number": lambda data: parse_number(data) if data else None,
+    }
+
+    def __init__(self, *fields):
+        self.fields = fields  # (name, kind, default) in record order
+        self.encoders = [self.ENCODERS[kind] for _, kind, _ in fields]
+        self.decoders = [self.DECODERS[kind] for _, kind, _ in fields]
+        self.defaults = [default for _, _, default in fields]
+        self.headers = {}  # Field count -> struct of the field lengths
+
+    def header(self, count):
+        header = self.headers.get(count)
+        if header is None:
+            header = self.headers[count] = struct.Struct(f"<{count}I")
+        return header
+
+    # Encode field values, given in schema order
+    def encode(self, values):
+        parts = [encode(value) for encode, value in zip(self.encoders, values)]
+        return bytes((len(parts),)) + self.header(len(parts)).pack(*map(len, parts)) + b"".join(parts)
+
+    # Decode the first limit fields (all by default) of the record at start, slicing each field straight from the buffer
+    def decode(self, buffer, start=0, limit=None):
+        header = self.header(buffer[start])
+        bounds = list(itertools.accumulate(header.unpack_from(buffer, start + 1), initial=start + 1 + header.size))
+        values = [
+            buffer[begin:end] if decode is None else decode(buffer[begin:end])
+            for decode, begin, end in zip(self.decoders[:limit], bounds, bounds[1:])
+        ]  # Fields added after this schema was written are left out
+        values.extend(self.defaults[len(values):limit])  # Fields the record was written without
+        return values
+
+    # Raw bytes of a single field of the record at start, without decoding the fields before it
+    def field(self, buffer, start, position):
+        count = buffer[start]
+        if position >= count:
+            return self.defaults[position]  # Field added after the record was written
+        header = self.header(count)
+        lengths = header.unpack_from(buffer, start + 1)
+        begin = start + 1 + header.size + sum(lengths[:position])
+        return buffer[begin:begin + lengths[position]]
+
+# Fields of a user record; the username is stored in the record header. New fields go at the end.
+USER_SCHEMA = RecordSchema(
+    ("email", "text", ""),
+    ("phone_number", "text", ""),
+    ("dob", "text", ""),
+    ("password", "text", ""),
+    ("purchase_history", "bytes", b""),
+)
+
+# Fields of a ticket record, in Ticket() argument order. New fields go at the end.
+TICKET_SCHEMA = RecordSchema(
+    ("name", "text", ""),
+    ("description", "text", ""),
+    ("price", "number", 0),
+    ("validity", "text", ""),
+    ("discount", "text", ""),
+    ("terms", "text", ""),
+    ("capacity", "optional number", None),
+)
+
+# PickleStorage class definition: Stores users and tickets in pickle files with a change journal
+class PickleStorage:
+    def __init__(self, users_file="users.pkl", tickets_file="tickets.pkl", compact_every=1000):
+        # Initialize file names and the journal of changes since the last snapshot
+        self.users_file = users_file  # File to store user data
+        self.tickets_file = tickets_file  # File to store ticket data
+        self.journal = UserJournal(os.path.splitext(users_file)[0] + ".journal")  # Journal of changes since the last save
+        self.compact_every = compact_every  # Journal records kept before users are saved to a new snapshot
+        self.sold_counts = {}  # Tickets sold per (ticket id, visit date ordinal), carried from journal to journal
+        self.sales = None  # Running sales totals, carried the same way; None until they have been built
+
+    # Load user data from the file and replay journaled changes on top of it
+    def load_users(self):
+        users = {}  # Start with an empty dictionary if no user data exists
+        if os.path.exists(self.users_file):
+            with open(self.users_file, "rb") as file:
+                users = StateUnpickler(file).load()
+        self.replay_journal(users, self.users_file)
+        return users
+
+    # Apply journaled changes made after the snapshot and rebuild the sold counts and sales totals
+    def replay_journal(self, users, snapshot_file):
+        snapshot_token = UserJournal.snapshot_token(snapshot_file)
+        records, current = self.journal.replay(snapshot_token)
+        self.sold_counts = {}
+        self.sales = None
+        for record in records:
+            if record[0] == "inventory":
+                self.sold_counts = dict(record[1])
+            else:
+                self.count_sale(record)
+                if current:
+                    apply_user_change(users, record)
+        if not current:
+            self.journal.reset(snapshot_token, self.carried_records())
+
+    # Add the tickets in a purchase record to the sold counts and sales totals
+    def count_sale(self, record):
+        if record[0] == "purchase" and not isinstance(record[2], str):
+            purchases = [split_purchase(record[2:])]
+        elif record[0] == "purchases":
+            purchases = [split_purchase(entry[1:]) for entry in record[1]]
+        elif record[0] == "seats":
+            for ticket_id, visit_ordinal, quantity in record[1]:
+                self.sold_counts[(ticket_id, visit_ordinal)] = self.sold_counts.get((ticket_id, visit_ordinal), 0) + quantity
+            return
+        else:
+            if record[0] == "sales":
+                self.sales = SalesTotals(record[1])  # Totals rebuilt from scratch replace the running ones
+            return
+        for purchase, band in purchases:
+            key = (purchase[0], purchase[4])  # Ticket id and visit date ordinal
+            self.sold_counts[key] = self.sold_counts.get(key, 0) + purchase[1]
+            if self.sales is not None:
+                self.sales.add(purchase, band)
+
+    # Records that start every new journal, so state not kept in the users snapshot survives compaction
+    def carried_records(self):
+        records = [("inventory", dict(self.sold_counts))]
+        if self.sales is not None:
+            records.append(("sales", self.sales.state()))
+        return records
+
+    # Tickets sold per (ticket id, visit date ordinal)
+    def load_inventory(self):
+        return dict(self.sold_counts)
+
+    # Running sales totals, or None if they have never been built and must be rebuilt from the users
+    def load_sales(self):
+        return self.sales.state() if self.sales is not None else None
+
+    # Yield every user, for work that reads all of them once
+    def iter_users(self, users):
+        return iter(list(users.values()))
+
+    # (username, email, phone number) of every user, for building the user index
+    def user_contacts(self, users):
+        return [(user.username, user.email, user.phone_number) for user in self.iter_users(users)]
+
+    # List (username, packed purchase records) for every user
+    def purchase_buffers(self, users):
+        return [(user.username, bytes(user.purchase_history.data)) for user in self.iter_users(users)]
+
+    # Save user data to the file and start a new, empty journal
+    def save_users(self, users):
+        with replace_atomically(self.users_file) as file:
+            pickle.dump(users, file)
+        self.journal.reset(UserJournal.snapshot_token(self.users_file), self.carried_records())
+
+    # Append a batch of changes to the journal and sync it once for the whole batch
+    def record_changes(self, records, users):
+        for record in records:
+            self.journal.append(record)
+            self.count_sale(record)
+        self.journal.sync()
+
+    # Check whether the journal has grown enough to be compacted into a new snapshot
+    def needs_compaction(self):
+        return self.journal.record_count >= self.compact_every
+
+    # Load ticket data from the file if it exists
+    def load_tickets(self):
+        if os.path.exists(self.tickets_file):
+            with open(self.tickets_file, "rb") as file:
+                return StateUnpickler(file).load()
+        return None  # No ticket data saved yet
+
+    # Save ticket data to the file
+    def save_tickets(self, tickets):
+        with replace_atomically(self.tickets_file) as file:
+            pickle.dump(tickets, file)
+
+    # Flush outstanding journal records to disk
+    def close(self):
+        self.journal.close()
+
+# Stable 64-bit hash of a username used by the on-disk user index
+def username_hash(username):
+    return int.from_bytes(hashlib.blake2b(username.encode("utf-8"), digest_size=8).digest(), "little")
+
+# MappedUserMap class definition: Dictionary-like view of a user data file that decodes users on demand
+class MappedUserMap(MutableMapping):
+    # Layout of users.dat: records, then a sorted (hash, offset) index, then a footer
+    RECORD_HEADER = struct.Struct("<IH")  # User data length, username length
+    INDEX_ENTRY = struct.Struct("<QQ")  # Username hash, record offset
+    FOOTER = struct.Struct("<4sIQQ")  # Magic, format version, user count, index offset
+    MAGIC = b"UDAT"
+    VERSION = 2  # User data in USER_SCHEMA records; version 1 files hold pickled users and are still read
+
+    def __init__(self, data_file):
+        self.data_file = data_file  # File holding the user records and index
+        self.cache = {}  # Users decoded from the file or changed since the last snapshot
+        self.lock = threading.RLock()  # Guards the map while a new snapshot is swapped in
+        self.file = None
+        self.map = None
+        self.reopen()
+
+    # Map the current data file and forget changes that are now part of it
+    def reopen(self):
+        with self.lock:
+            self.close()
+            self.open_map()
+
+    def open_map(self):
+        self.file = open(self.data_file, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.version, self.count, self.index_offset = self.FOOTER.unpack_from(self.map, len(self.map) - self.FOOTER.size)
+        if magic != self.MAGIC or self.version not in (1, self.VERSION):
+            raise ValueError(f"{self.data_file} is not a user data file")
+        self.deleted = set()  # Usernames in the file that have since been deleted
+        self.added = set()  # Usernames added since the file was written
+
+    # Find the offset of a user's record in the file
+    def find_offset(self, username):
+        target = username_hash(username)
+        low, high = 0, self.count
+        while low < high:  # Binary search for the first entry with this hash
+            mid = (low + high) // 2
+            if self.INDEX_ENTRY.unpack_from(self.map, self.index_offset + mid * self.INDEX_ENTRY.size)[0] < target:
+                low = mid + 1
+            else:
+                high = mid
+        while low < self.count:  # Check every entry sharing the hash
+            entry_hash, offset = self.INDEX_ENTRY.unpack_from(self.map, self.index_offset + low * self.INDEX_ENTRY.size)
+            if entry_hash != target:
+                break
+            if self.record_username(offset) == username:
+                return offset
+            low += 1
+        return None
+
+    # Read the username stored in a record
+    def record_username(self, offset):
+        _, name_length = self.RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + self.RECORD_HEADER.size
+        return self.map[start:start + name_length].decode("utf-8")
+
+    # Size of a record in bytes, header included
+    def record_size(self, offset):
+        data_length, name_length = self.RECORD_HEADER.unpack_from(self.map, offset)
+        return self.RECORD_HEADER.size + name_length + data_length
+
+    # User data of a record in the current format
+    @staticmethod
+    def encode(user):
+        return USER_SCHEMA.encode((user.email, user.phone_number, user.dob, user.password, user.purchase_history.data))
+
+    # Decode the user stored in a record
+    def decode(self, offset):
+        data_length, name_length = self.RECORD_HEADER.unpack_from(self.map, offset)
+        start = offset + self.RECORD_HEADER.size
+        if self.version == 1:
+            return StateUnpickler(io.BytesIO(self.map[start + name_length:start + name_length + data_length])).load()
+        email, phone_number, dob, password, history = USER_SCHEMA.decode(self.map, start + name_length)
+        user = User(self.map[start:start + name_length].decode("utf-8"), password, email, phone_number, dob)
+        user.purchase_history = PurchaseHistory(history)
+        return user
+
+    # Yield (username, offset) for every record in the file
+    def records(self):
+        offset = 0
+        while offset < self.index_offset:
+            data_length, name_length = self.RECORD_HEADER.unpack_from(self.map, offset)
+            yield self.record_username(offset), offset
+            offset += self.RECORD_HEADER.size + name_length + data_length
+
+    # Yield (username, values) for every user, read from a private map of the data file so the map lock is only held
+    # while the snapshot is taken, not while every record is decoded. pick(user) gives the values of a user object;
+    # read(data, start) gives them straight from a record's USER_SCHEMA data.
+    def snapshot(self, pick, read):
+        with self.lock:
+            file = open(self.data_file, "rb")  # The current snapshot, even if compaction replaces the file later
+            changed = {username: pick(user) for username, user in self.cache.items()}
+            skipped = self.deleted | changed.keys()
+            index_offset = self.index_offset
+            version = self.version
+        with file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            offset = 0
+            while offset < index_offset:
+                data_length, name_length = self.RECORD_HEADER.unpack_from(data, offset)
+                start = offset + self.RECORD_HEADER.size
+                username = data[start:start + name_length].decode("utf-8")
+                if username not in skipped and version == 1:
+                    yield username, pick(StateUnpickler(io.BytesIO(data[start + name_length:start + name_length + data_length])).load())
+                elif username not in skipped:
+                    yield username, read(data, start + name_length)
+                offset = start + name_length + data_length
+        yield from changed.items()
+
+    # (username, email, phone number) of every user
+    def contacts(self):
+        for username, (email, phone_number) in self.snapshot(
+            lambda user: (user.email, user.phone_number),
+            lambda data, start: USER_SCHEMA.decode(data, start, limit=2),  # Only the contact fields
+        ):
+            yield username, email, phone_number
+
+    # (username, packed purchase records) of every user, slicing only the history field of each record
+    def histories(self):
+        position = [name for name, _, _ in USER_SCHEMA.fields].index("purchase_history")
+        return self.snapshot(lambda user: bytes(user.purchase_history.data), lambda data, start: USER_SCHEMA.field(data, start, position))
+
+    # Yield every user without caching the decoded users
+    def iter_uncached(self):
+        with self.lock:
+            for username, offset in self.records():
+                if username not in self.deleted:
+                    yield self.cache.get(username) or self.decode(offset)
+            for username in list(self.added):
+                yield self.cache[username]
+
+    def in_file(self, username):
+        return username not in self.deleted and username not in self.added and self.find_offset(username) is not None
+
+    def __getitem__(self, username):
+        user = self.cache.get(username)
+        if user is None:
+            with self.lock:
+                user = self.cache.get(username)
+                if user is None:
+                    offset = self.find_offset(username) if username not in self.deleted else None
+                    if offset is None:
+                        raise KeyError(username)
+                    user = self.cache[username] = self.decode(offset)
+        return user
+
+    def __setitem__(self, username, user):
+        with self.lock:
+            if username in self.deleted:
+                self.deleted.discard(username)  # Registered again after a deletion: the cached user replaces the file's record
+            elif username not in self.cache and not self.in_file(username):
+                self.added.add(username)
+            self.cache[username] = user
+
+    def __delitem__(self, username):
+        with self.lock:
+            if username in self.added:
+                self.added.discard(username)
+            elif username not in self.deleted and self.find_offset(username) is not None:
+                self.deleted.add(username)
+            else:
+                raise KeyError(username)
+            self.cache.pop(username, None)
+
+    def __contains__(self, username):
+        if username in self.cache:
+            return True
+        with self.lock:
+            return self.in_file(username)
+
+    def __iter__(self):
+        with self.lock:
+            usernames = [username for username, _ in self.records() if username not in self.deleted]
+            usernames.extend(self.added)
+        return iter(usernames)
+
+    def __len__(self):
+        with self.lock:
+            return self.count - len(self.deleted) + len(self.added)
+
+    # Release the memory map
+    def close(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.close()
+                self.file.close()
+                self.map = None
+
+# MappedStorage class definition: Stores users in a memory-mapped data file so startup does not decode them, and
+# tickets in a small binary file; neither is a pickle
+class MappedStorage(PickleStorage):
+    # Layout of tickets.dat: a header, then each ticket as a length and a TICKET_SCHEMA record
+    TICKETS_HEADER = struct.Struct("<4sII")  # Magic, format version, ticket count
+    TICKET_LENGTH = struct.Struct("<I")
+    TICKETS_MAGIC = b"TDAT"
+    TICKETS_VERSION = 1
+
+    def __init__(self, users_file="users.pkl", tickets_file="tickets.pkl", compact_every=1000):
+        # Initialize file names; users_file and tickets_file are only read to convert existing pickles
+        super().__init__(users_file, tickets_file, compact_every)
+        self.data_file = os.path.splitext(users_file)[0] + ".dat"  # File to store user records and their index
+        self.tickets_data_file = os.path.splitext(tickets_file)[0] + ".dat"  # File to store the ticket catalog
+        self.users = None
+
+    # Open the user data file and replay journaled changes on top of it
+    def load_users(self):
+        if not os.path.exists(self.data_file):
+            self.save_users(super().load_users())  # One-time conversion from the pickle file
+        self.users = MappedUserMap(self.data_file)
+        self.replay_journal(self.users, self.data_file)
+        return self.users
+
+    # Copy unchanged records from the current data file in contiguous runs and return their index entries
+    def copy_unchanged(self, users, file):
+        changed = (users.cache.keys() - users.added) | users.deleted
+        skipped = sorted(offset for offset in map(users.find_offset, changed) if offset is not None)
+        position = 0  # Old offset up to which records have been copied
+        dropped = [0]  # Bytes dropped before each skipped record and after the last one
+        for offset in skipped:
+            file.write(users.map[position:offset])
+            position = offset + users.record_size(offset)
+            dropped.append(dropped[-1] + position - offset)
+        # Index entries stay in hash order; each offset moves back by the bytes dropped before it
+        index = users.map[users.index_offset:users.index_offset + users.count * MappedUserMap.INDEX_ENTRY.size]
+        skipped_set = set(skipped)
+        entries = [
+            (entry_hash, offset - dropped[bisect.bisect_left(skipped, offset)])
+            for entry_hash, offset in MappedUserMap.INDEX_ENTRY.iter_unpack(index)
+            if offset not in skipped_set
+        ]
+        file.write(users.map[position:users.index_offset])
+        return entries
+
+    # Write every user to a new data file and start a new, empty journal
+    def save_users(self, users):
+        with replace_atomically(self.data_file) as file:
+            if isinstance(users, MappedUserMap) and users.version == MappedUserMap.VERSION:
+                entries = self.copy_unchanged(users, file)
+                changed = users.cache.items()  # Decoded users are written again in full
+            elif isinstance(users, MappedUserMap):
+                entries = []  # (hash, offset) pairs for the index
+                changed = ((user.username, user) for user in users.iter_uncached())  # Older format: every user is written again
+            else:
+                entries = []
+                changed = users.items()
+            for username, user in changed:
+                name = username.encode("utf-8")
+                data = MappedUserMap.encode(user)
+                entries.append((username_hash(username), file.tell()))
+                file.write(MappedUserMap.RECORD_HEADER.pack(len(data), len(name)))
+                file.write(name)
+                file.write(data)
+            entries.sort()
+            index_offset = file.tell()
+            file.write(b"".join(MappedUserMap.INDEX_ENTRY.pack(*entry) for entry in entries))
+            file.write(MappedUserMap.FOOTER.pack(MappedUserMap.MAGIC, MappedUserMap.VERSION, len(entries), index_offset))
+        self.journal.reset(UserJournal.snapshot_token(self.data_file), self.carried_records())
+        if isinstance(users, MappedUserMap):
+            users.reopen()
+
+    # Yield every user, decoding users in the data file without caching them
+    def iter_users(self, users):
+        if isinstance(users, MappedUserMap):
+            return users.iter_uncached()
+        return super().iter_users(users)
+
+    # (username, email, phone number) of every user, decoded from a snapshot of the data file
+    def user_contacts(self, users):
+        if isinstance(users, MappedUserMap):
+            return users.contacts()
+        return super().user_contacts(users)
+
+    # (username, packed purchase records) of every user, read from a snapshot of the data file without decoding users
+    def purchase_buffers(self, users):
+        if isinstance(users, MappedUserMap):
+            return list(users.histories())
+        return super().purchase_buffers(users)
+
+    # Load the ticket catalog, converting the tickets pickle the first time
+    def load_tickets(self):
+        if not os.path.exists(self.tickets_data_file):
+            tickets = super().load_tickets()
+            if tickets:
+                self.save_tickets(tickets)  # One-time conversion from the pickle file
+            return tickets
+        with open(self.tickets_data_file, "rb") as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, count = self.TICKETS_HEADER.unpack_from(data)
+            if magic != self.TICKETS_MAGIC or version != self.TICKETS_VERSION:
+                raise ValueError(f"{self.tickets_data_file} is not a ticket data file")
+            tickets = []
+            offset = self.TICKETS_HEADER.size
+            for _ in range(count):
+                length, = self.TICKET_LENGTH.unpack_from(data, offset)
+                tickets.append(Ticket(*TICKET_SCHEMA.decode(data, offset + self.TICKET_LENGTH.size)))
+                offset += self.TICKET_LENGTH.size + length
+        return tickets
+
+    # Save the ticket catalog; sold counts are not stored, as they are rebuilt from the inventory
+    def save_tickets(self, tickets):
+        with replace_atomically(self.tickets_data_file) as file:
+            file.write(self.TICKETS_HEADER.pack(self.TICKETS_MAGIC, self.TICKETS_VERSION, len(tickets)))
+            for ticket in tickets:
+                data = TICKET_SCHEMA.encode((ticket.name, ticket.description, ticket.price, ticket.validity, ticket.discount, ticket.terms, ticket.capacity))
+                file.write(self.TICKET_LENGTH.pack(len(data)))
+                file.write(data)
+
+    # Flush outstanding journal records and release the memory map
+    def close(self):
+        super().close()
+        if self.users is not None:
+            self.users.close()
+
+# SQLiteUserMap class definition: Dictionary-like view of the users table that loads users on demand
+class SQLiteUserMap(MutableMapping):
+    def __init__(self, storage):
+        self.storage = storage  # Storage that owns the database connection
+        self.cache = {}  # Users already loaded from the database
+
+    def __getitem__(self, username):
+        user = self.cache.get(username)
+        if user is None:
+            user = self.storage.fetch_user(username)
+            if user is None:
+                raise KeyError(username)
+            self.cache[username] = user
+        return user
+
+    def __setitem__(self, username, user):
+        self.cache[username] = user  # Written to the database by record_change
+
+    def __delitem__(self, username):
+        if username not in self:
+            raise KeyError(username)
+        self.cache.pop(username, None)  # Removed from the database by record_change
+
+    def __contains__(self, username):
+        return username in self.cache or self.storage.has_user(username)
+
+    def __iter__(self):
+        return iter(self.storage.usernames())
+
+    def __len__(self):
+        return self.storage.user_count()
+
+# SQLiteStorage class definition: Stores users, tickets and purchases in an SQLite database
+class SQLiteStorage:
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            username TEXT PRIMARY KEY,
+            password TEXT NOT NULL,
+            email TEXT,
+            phone_number TEXT,
+            dob TEXT
+        );
+        CREATE TABLE IF NOT EXISTS tickets (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            description TEXT,
+            price REAL NOT NULL,
+            validity TEXT,
+            discount TEXT,
+            terms TEXT,
+            sold_count INTEGER NOT NULL DEFAULT 0,
+            capacity INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS purchases (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT NOT NULL REFERENCES users(username) ON DELETE CASCADE,
+            ticket_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            price_cents INTEGER NOT NULL,
+            discount_bps INTEGER NOT NULL,
+            visit_date INTEGER NOT NULL,
+            payment_code INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS inventory (
+            ticket_id INTEGER NOT NULL,
+            visit_date INTEGER NOT NULL,
+            sold INTEGER NOT NULL,
+            PRIMARY KEY (ticket_id, visit_date)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS sales (
+            dimension TEXT NOT NULL,
+            key INTEGER NOT NULL,
+            units INTEGER NOT NULL,
+            revenue_cents INTEGER NOT NULL,
+            discount_cents INTEGER NOT NULL,
+            orders INTEGER NOT NULL,
+            PRIMARY KEY (dimension, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS purchases_username ON purchases(username);
+        CREATE INDEX IF NOT EXISTS purchases_ticket ON purchases(ticket_id);
+    """
+    # Statements are kept as constants so the connection's statement cache reuses them
+    SELECT_USER = "SELECT username, password, email, phone_number, dob FROM users WHERE username = ?"
+    SELECT_HISTORY = "SELECT ticket_id, quantity, price_cents, discount_bps, visit_date, payment_code FROM purchases WHERE username = ? ORDER BY id"
+    HAS_USER = "SELECT 1 FROM users WHERE username = ?"
+    INSERT_USER = "INSERT INTO users (username, password, email, phone_number, dob) VALUES (?, ?, ?, ?, ?)"
+    UPDATE_PASSWORD = "UPDATE users SET password = ? WHERE username = ?"
+    UPDATE_USER = "UPDATE users SET email = COALESCE(NULLIF(?, ''), email), phone_number = COALESCE(NULLIF(?, ''), phone_number), dob = COALESCE(NULLIF(?, ''), dob) WHERE username = ?"
+    DELETE_USER = "DELETE FROM users WHERE username = ?"
+    INSERT_PURCHASE = "INSERT INTO purchases (username, ticket_id, quantity, price_cents, discount_bps, visit_date, payment_code) VALUES (?, ?, ?, ?, ?, ?, ?)"
+    INSERT_TICKET = "INSERT INTO tickets (id, name, description, price, validity, discount, terms, sold_count, capacity) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"
+    COUNT_SALE = "INSERT INTO inventory (ticket_id, visit_date, sold) VALUES (?, ?, ?) ON CONFLICT (ticket_id, visit_date) DO UPDATE SET sold = sold + excluded.sold"
+    ADD_SALES = (
+        "INSERT INTO sales (dimension, key, units, revenue_cents, discount_cents, orders) VALUES (?, ?, ?, ?, ?, ?) "
+        "ON CONFLICT (dimension, key) DO UPDATE SET units = units + excluded.units, revenue_cents = revenue_cents + excluded.revenue_cents, "
+        "discount_cents = discount_cents + excluded.discount_cents, orders = orders + excluded.orders"
+    )
+
+    def __init__(self, db_file="booking.db"):
+        import sqlite3  # Imported here, as only this backend needs it
+        # Open the database in WAL mode so readers never block the writer
+        self.db_file = db_file  # File to store the database
+        self.connection = sqlite3.connect(db_file, check_same_thread=False, cached_statements=256)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")  # WAL stays consistent without an fsync per commit
+        self.connection.execute("PRAGMA foreign_keys=ON")
+        self.connection.executescript(self.SCHEMA)
+        self.lock = threading.RLock()  # The connection is shared by the writer thread and readers
+        self.users = SQLiteUserMap(self)
+
+    # Build a user object from its row and purchase history
+    def fetch_user(self, username):
+        with self.lock:
+            row = self.connection.execute(self.SELECT_USER, (username,)).fetchone()
+            if row is None:
+                return None
+            user = User(*row)
+            for purchase in self.connection.execute(self.SELECT_HISTORY, (username,)).fetchall():
+                user.add_purchase(*purchase)
+        return user
+
+    # Check whether a username is registered
+    def has_user(self, username):
+        with self.lock:
+            return self.connection.execute(self.HAS_USER, (username,)).fetchone() is not None
+
+    # List all registered usernames
+    def usernames(self):
+        with self.lock:
+            return [username for (username,) in self.connection.execute("SELECT username FROM users ORDER BY username")]
+
+    # Count registered users
+    def user_count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    # Users are read from the database on demand
+    def load_users(self):
+        return self.users
+
+    # Replace the users table with the given users
+    def save_users(self, users):
+        if users is self.users:
+            return  # Every change is already written by record_changes
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM users")
+            self.connection.executemany(self.INSERT_USER, ((user.username, user.password, user.email, user.phone_number, user.dob) for user in users.values()))
+            self.connection.executemany(self.INSERT_PURCHASE, (
+                (user.username, *purchase)
+                for user in users.values() for purchase in user.purchase_history
+            ))
+            self.connection.execute("DELETE FROM inventory")
+            self.connection.execute("INSERT INTO inventory SELECT ticket_id, visit_date, SUM(quantity) FROM purchases GROUP BY ticket_id, visit_date")
+            self.connection.execute("DELETE FROM sales")  # Rebuilt from the purchase histories on next start
+        self.users.cache.clear()
+
+    # Replace the stored seat counts and sales totals, e.g. with those kept by another backend. Sales totals of None are
+    # rebuilt from the purchase histories on next start.
+    def save_counts(self, sold_counts, sales):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM inventory")
+            self.connection.executemany(self.COUNT_SALE, ((ticket_id, visit_date, sold) for (ticket_id, visit_date), sold in sold_counts.items()))
+            self.connection.execute("DELETE FROM sales")
+            if sales is not None:
+                self.connection.executemany(self.ADD_SALES, (
+                    (dimension, key, *totals) for dimension, rows in sales.items() for key, totals in rows.items()
+                ))
+
+    # Write a batch of changes to the database in a single transaction
+    def record_changes(self, records, users):
+        with self.lock, self.connection:
+            for record in records:
+                action = record[0]
+                if action == "register":
+                    self.connection.execute(self.INSERT_USER, record[1:6])
+                elif action == "users":
+                    self.connection.executemany(self.INSERT_USER, record[1])
+                elif action == "purchase":
+                    purchase, band = split_purchase(record[2:])
+                    self.connection.execute(self.INSERT_PURCHASE, (record[1], *purchase))
+                    self.connection.execute(self.COUNT_SALE, (record[2], record[6], record[3]))
+                    self.connection.executemany(self.ADD_SALES, SalesTotals.rows(purchase, band))
+                elif action == "purchases":
+                    purchases = [(entry[0], *split_purchase(entry[1:])) for entry in record[1]]
+                    self.connection.executemany(self.INSERT_PURCHASE, ((username, *purchase) for username, purchase, _ in purchases))
+                    self.connection.executemany(self.COUNT_SALE, ((entry[1], entry[5], entry[2]) for entry in record[1]))
+                    self.connection.executemany(self.ADD_SALES, (row for _, purchase, band in purchases for row in SalesTotals.rows(purchase, band)))
+                elif action == "seats":
+                    self.connection.executemany(self.COUNT_SALE, record[1])
+                elif action == "sales":
+                    self.connection.execute("DELETE FROM sales")
+                    self.connection.executemany(self.ADD_SALES, (
+                        (dimension, key, *totals) for dimension, rows in record[1].items() for key, totals in rows.items()
+                    ))
+                elif action == "update":
+                    self.connection.execute(self.UPDATE_USER, (*record[2:5], record[1]))
+                elif action == "password":
+                    self.connection.execute(self.UPDATE_PASSWORD, (record[2], record[1]))
+                elif action == "delete":
+                    self.connection.execute(self.DELETE_USER, (record[1],))
+
+    # Every change is written in place, so there is no journal to compact
+    def needs_compaction(self):
+        return False
+
+    # Load ticket data from the database if any has been saved
+    def load_tickets(self):
+        with self.lock:
+            rows = self.connection.execute("SELECT name, description, price, validity, discount, terms, capacity, sold_count FROM tickets ORDER BY id").fetchall()
+        if not rows:
+            return None  # No ticket data saved yet
+        tickets = []
+        for row in rows:
+            ticket = Ticket(*row[:7])
+            ticket.sold_count = row[7]
+            tickets.append(ticket)
+        return tickets
+
+    # List (username, packed purchase records) for every user with purchases
+    def purchase_buffers(self, users):
+        buffers = {}
+        with self.lock:
+            rows = self.connection.execute("SELECT username, ticket_id, quantity, price_cents, discount_bps, visit_date, payment_code FROM purchases ORDER BY id").fetchall()
+        for username, *purchase in rows:
+            buffers.setdefault(username, bytearray()).extend(PurchaseHistory.RECORD.pack(*purchase))
+        return [(username, bytes(data)) for username, data in buffers.items()]
+
+    # Tickets sold per (ticket id, visit date ordinal)
+    def load_inventory(self):
+        with self.lock:
+            return {(ticket_id, visit_date): sold for ticket_id, visit_date, sold in self.connection.execute("SELECT ticket_id, visit_date, sold FROM inventory")}
+
+    # Running sales totals, or None if purchases were stored without them and they must be rebuilt
+    def load_sales(self):
+        totals = {dimension: {} for dimension in SalesTotals.DIMENSIONS}
+        with self.lock:
+            rows = self.connection.execute("SELECT dimension, key, units, revenue_cents, discount_cents, orders FROM sales").fetchall()
+            if not rows and self.connection.execute("SELECT EXISTS (SELECT 1 FROM purchases)").fetchone()[0]:
+                return None
+        for dimension, key, *amounts in rows:
+            totals[dimension][key] = tuple(amounts)
+        return totals
+
+    # Yield every user, read from the database without caching them
+    def iter_users(self, users):
+        return (user for user in map(self.fetch_user, self.usernames()) if user is not None)
+
+    # (username, email, phone number) of every user, for building the user index
+    def user_contacts(self, users):
+        with self.lock:
+            return self.connection.execute("SELECT username, email, phone_number FROM users").fetchall()
+
+    # Replace the tickets table with the given tickets
+    def save_tickets(self, tickets):
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM tickets")
+            self.connection.executemany(self.INSERT_TICKET, (
+                (idx, ticket.name, ticket.description, ticket.price, ticket.validity, ticket.discount, ticket.terms, ticket.sold_count, ticket.capacity)
+                for idx, ticket in enumerate(tickets)
+            ))
+
+    # Close the database connection
+    def close(self):
+        with self.lock:
+            self.connection.commit()
+            self.connection.close()
+
+# Copy the users, tickets, seat counts and sales totals saved in the pickle-based files into an SQLite database. The
+# counts are copied rather than summed from the histories, which no longer hold the purchases of deleted users.
+def migrate_pickles_to_sqlite(db_file, users_file="users.pkl", tickets_file="tickets.pkl"):
+    source = MappedStorage(users_file, tickets_file)
+    users = source.load_users()
+    tickets = source.load_tickets() or default_tickets()
+    target = SQLiteStorage(db_file)
+    target.save_tickets(tickets)
+    target.save_users(users)
+    target.save_counts(source.load_inventory(), source.load_sales())
+    target.close()
+    count = len(users)
+    source.close()
+    return count
+
+# Rewrite pickled state files in the binary formats of MappedStorage; returns (users, tickets) converted.
+# Loading converts pickles by itself; this also rewrites user data files of the older, pickled format.
+def convert_state_files(users_file="users.pkl", tickets_file="tickets.pkl"):
+    storage = MappedStorage(users_file, tickets_file)
+    users = storage.load_users()
+    tickets = storage.load_tickets() or default_tickets()
+    if users.version != MappedUserMap.VERSION:
+        storage.save_users(users)
+    storage.save_tickets(tickets)
+    count = len(users)
+    storage.close()
+    return count, len(tickets)
+
+# Discount rules per ticket name, so they stay with their ticket when the catalog is reordered or extended by an import.
+# Each rule gives a discount rate and the condition under which it applies:
+#   group:   the group has at least min_persons people (the ticket is then priced per person)
+#   online:  the ticket is bought online, which every sale through the app is
+#   renewal: the buyer is renewing; buyers count as renewing unless the quote says otherwise
+#   dates:   the visit falls between start and end (YYYY-MM-DD), optionally only on the given weekdays (0 = Monday)
+# When several rules apply, the largest discount is used.
+DEFAULT_PRICING_RULES = {
+    "Two-Day Pass": [{"kind": "online", "rate": 0.10}],
+    "Annual Membership": [{"kind": "renewal", "rate": 0.15}],
+    "Group Ticket (10+)": [{"kind": "group", "min_persons": 11, "rate": 0.20}],
+}
+
+# PricingEngine class definition: Compiles discount rules into one quote function per ticket
+class PricingEngine:
+    def __init__(self, tickets, rules=None):
+        self.tickets = tickets  # Ticket list, read for current prices
+        self.rules = DEFAULT_PRICING_RULES if rules is None else rules
+        self.table = [self.compile(ticket_id) for ticket_id in range(len(tickets))]  # Quote function per ticket id
+
+    # Turn one rule into a function of (num_persons, channel, renewal, visit_ordinal) returning its rate or 0
+    @staticmethod
+    def compile_rule(rule):
+        rate = rule["rate"]
+        kind = rule["kind"]
+        if kind == "group":
+            min_persons = rule["min_persons"]
+            return lambda num_persons, channel, renewal, visit_ordinal: rate if num_persons >= min_persons else 0
+        if kind == "online":
+            return lambda num_persons, channel, renewal, visit_ordinal: rate if channel == "online" else 0
+        if kind == "renewal":
+            return lambda num_persons, channel, renewal, visit_ordinal: rate if renewal else 0
+        if kind == "dates":
+            start, end = visit_date_ordinal(rule["start"]), visit_date_ordinal(rule["end"])
+            weekdays = frozenset(rule.get("weekdays", range(7)))
+            return lambda num_persons, channel, renewal, visit_ordinal: rate if start <= visit_ordinal <= end and (visit_ordinal - 1) % 7 in weekdays else 0
+        raise ValueError(f"Unknown pricing rule: {kind}")
+
+    # Build the quote function for a ticket, from the rules for its name
+    def compile(self, ticket_id):
+        ticket = self.tickets[ticket_id]
+        rules = self.rules.get(ticket.name, [])
+        per_person = any(rule["kind"] == "group" for rule in rules)
+        conditions = [self.compile_rule(rule) for rule in rules]
+
+        def quote(num_persons, channel, renewal, visit_ordinal):
+            if per_person:
+                # Ensure that group size is a valid integer
+                if not isinstance(num_persons, int) or num_persons < 1:
+                    raise ValueError("Group size must be a positive integer.")
+                quantity, total_price = num_persons, ticket.price * num_persons
+            else:
+                quantity, total_price = 1, ticket.price
+            discount = max((condition(num_persons, channel, renewal, visit_ordinal) for condition in conditions), default=0)
+            return quantity, total_price * (1 - discount), discount
+
+        return quote
+
+    # Price one ticket; returns (quantity, final price, discount)
+    def quote(self, ticket_id, num_persons=None, channel="online", renewal=True, visit_ordinal=0):
+        return self.table[ticket_id](num_persons, channel, renewal, visit_ordinal)
+
+    # Price many (ticket id, num_persons, visit_ordinal) requests, working out each distinct one once
+    def quote_many(self, requests, channel="online", renewal=True):
+        quotes = {}
+        results = []
+        for request in requests:
+            result = quotes.get(request)
+            if result is None:
+                ticket_id, num_persons, visit_ordinal = request
+                result = quotes[request] = self.table[ticket_id](num_persons, channel, renewal, visit_ordinal)
+            results.append(result)
+        return results
+
+# Raised when a limited ticket has no seats left for the requested visit date
+class SoldOutError(ValueError):
+    pass
+
+# Reservation class definition: Seats held for a buyer until they are confirmed or expire
+class Reservation:
+    __slots__ = ("id", "ticket_id", "visit_ordinal", "quantity", "expires")
+
+    def __init__(self, id, ticket_id, visit_ordinal, quantity, expires):
+        self.id = id
+        self.ticket_id = ticket_id
+        self.visit_ordinal = visit_ordinal
+        self.quantity = quantity
+        self.expires = expires  # time.monotonic() after which the seats are released
+
+# InventorySlot class definition: Sold and held seats for one ticket on one visit date
+class InventorySlot:
+    __slots__ = ("lock", "sold", "held", "holds", "expiry")
+
+    def __init__(self, sold=0):
+        self.lock = threading.Lock()  # Guards only this ticket and date
+        self.sold = sold  # Seats confirmed
+        self.held = 0  # Seats reserved but not yet confirmed
+        self.holds = {}  # Reservation id -> reservation
+        self.expiry = []  # Heap of (expires, reservation id)
+
+    # Release holds whose time has run out and return the seats released (caller holds the lock)
+    def expire(self, now):
+        released = 0
+        while self.expiry and self.expiry[0][0] <= now:
+            _, reservation_id = heapq.heappop(self.expiry)
+            reservation = self.holds.pop(reservation_id, None)
+            if reservation:
+                self.held -= reservation.quantity
+                released += reservation.quantity
+        return released
+
+# Inventory class definition: Per-ticket, per-visit-date seat counts with two-phase reservations
+class Inventory:
+    def __init__(self, tickets, sold_counts=None, hold_seconds=300):
+        self.tickets = tickets  # Ticket list, read for each ticket's capacity
+        self.hold_seconds = hold_seconds  # Default time a reservation is held
+        self.slots = {(ticket_id, visit_ordinal): InventorySlot(sold) for (ticket_id, visit_ordinal), sold in (sold_counts or {}).items()}
+        self.reservation_ids = itertools.count(1)
+        self.dates_lock = threading.Lock()  # Guards dates and ordinals
+        self.dates = {}  # Visit date ordinal -> ids of the tickets with a slot on that date
+        self.ordinals = []  # Every visit date ordinal with a slot, sorted, for date ranges
+        for ticket_id, visit_ordinal in sorted(self.slots):
+            self.add_date(ticket_id, visit_ordinal)
+
+    # Seats sold per ticket id across all visit dates
+    def sold_by_ticket(self):
+        totals = [0] * len(self.tickets)
+        for (ticket_id, _), slot in list(self.slots.items()):
+            if ticket_id < len(totals):
+                totals[ticket_id] += slot.sold
+        return totals
+
+    # Slot for a ticket and date, created on first use without a global lock
+    def slot(self, ticket_id, visit_ordinal):
+        key = (ticket_id, visit_ordinal)
+        slot = self.slots.get(key)
+        if slot is None:
+            created = InventorySlot()
+            slot = self.slots.setdefault(key, created)  # Atomic, so racing threads share one slot
+            if slot is created:
+                self.add_date(ticket_id, visit_ordinal)
+        return slot
+
+    # Add a new slot to the calendar of visit dates
+    def add_date(self, ticket_id, visit_ordinal):
+        with self.dates_lock:
+            ticket_ids = self.dates.get(visit_ordinal)
+            if ticket_ids is None:
+                self.dates[visit_ordinal] = [ticket_id]
+                bisect.insort(self.ordinals, visit_ordinal)
+            else:
+                ticket_ids.append(ticket_id)
+
+    # Seats sold per ticket on each visit date from first to last (ordinals, inclusive), as [(ordinal, {ticket id: seats})]
+    # for the dates with any seats sold
+    def attendance(self, first, last):
+        with self.dates_lock:
+            days = [(ordinal, list(self.dates[ordinal])) for ordinal in self.ordinals[bisect.bisect_left(self.ordinals, first):bisect.bisect_right(self.ordinals, last)]]
+        attendance = []
+        for ordinal, ticket_ids in days:
+            seats = {ticket_id: self.slots[(ticket_id, ordinal)].sold for ticket_id in sorted(ticket_ids)}
+            seats = {ticket_id: sold for ticket_id, sold in seats.items() if sold}  # Slots whose holds all lapsed
+            if seats:
+                attendance.append((ordinal, seats))
+        return attendance
+
+    # Seats sold or held for a ticket and date (caller holds the slot lock)
+    def seats_taken(self, slot, ticket_id, visit_ordinal):
+        return slot.sold + slot.held
+
+    # Check that quantity more seats fit within capacity and count them as taken (caller holds the slot lock)
+    def claim(self, slot, ticket_id, visit_ordinal, quantity, capacity):
+        return slot.sold + slot.held + quantity <= capacity
+
+    # Note that held seats were given back (caller holds the slot lock)
+    def returned(self, ticket_id, visit_ordinal, quantity):
+        pass  # Held seats are only counted in the slot
+
+    # Seats left for a ticket and date, or None if the ticket is unlimited
+    def available(self, ticket_id, visit_ordinal):
+        capacity = self.tickets[ticket_id].capacity
+        if capacity is None:
+            return None
+        slot = self.slot(ticket_id, visit_ordinal)
+        with slot.lock:
+            self.returned(ticket_id, visit_ordinal, slot.expire(time.monotonic()))
+            return max(capacity - self.seats_taken(slot, ticket_id, visit_ordinal), 0)
+
+    # Hold seats for a ticket and date; returns None if there are not enough left
+    def reserve(self, ticket_id, visit_ordinal, quantity, hold_seconds=None):
+        capacity = self.tickets[ticket_id].capacity
+        slot = self.slot(ticket_id, visit_ordinal)
+        now = time.monotonic()
+        with slot.lock:
+            self.returned(ticket_id, visit_ordinal, slot.expire(now))
+            if capacity is not None and not self.claim(slot, ticket_id, visit_ordinal, quantity, capacity):
+                return None
+            reservation = Reservation(next(self.reservation_ids), ticket_id, visit_ordinal, quantity, now + (hold_seconds or self.hold_seconds))
+            slot.holds[reservation.id] = reservation
+            slot.held += quantity
+            heapq.heappush(slot.expiry, (reservation.expires, reservation.id))
+        return reservation
+
+    # Turn held seats into sold seats; returns False if the reservation already expired
+    def confirm(self, reservation):
+        slot = self.slot(reservation.ticket_id, reservation.visit_ordinal)
+        with slot.lock:
+            self.returned(reservation.ticket_id, reservation.visit_ordinal, slot.expire(time.monotonic()))
+            if slot.holds.pop(reservation.id, None) is None:
+                return False
+            slot.held -= reservation.quantity
+            slot.sold += reservation.quantity
+        return True
+
+    # Count seats sold without a reservation, e.g. imported purchases; capacity is not checked
+    def add_sold(self, ticket_id, visit_ordinal, quantity):
+        slot = self.slot(ticket_id, visit_ordinal)
+        with slot.lock:
+            slot.sold += quantity
+
+    # Give held seats back before the reservation expires
+    def release(self, reservation):
+        slot = self.slot(reservation.ticket_id, reservation.visit_ordinal)
+        with slot.lock:
+            if slot.holds.pop(reservation.id, None) is not None:
+                slot.held -= reservation.quantity
+                self.returned(reservation.ticket_id, reservation.visit_ordinal, reservation.quantity)
+
+# WriterCall class definition: A function queued to run on the storage writer thread
+class WriterCall:
+    def __init__(self, func, detached=False):
+        self.func = func
+        self.detached = detached  # Nobody waits for the result, so errors are raised from the next flush instead
+        self.done = threading.Event()  # Set once the function has run
+        self.result = None
+        self.error = None
+
+    def run(self):
+        try:
+            self.result = self.func()
+        except Exception as error:
+            self.error = error
+        self.done.set()
+
+# StorageWriter class definition: Background thread that group-commits changes to storage
+class StorageWriter(threading.Thread):
+    STOP = object()  # Queued to stop the thread
+
+    def __init__(self, system, batch_size=512):
+        super().__init__(name="storage-writer", daemon=True)
+        self.system = system  # The ticket booking system whose changes are written
+        self.batch_size = batch_size  # Most changes written in one commit
+        self.queue = queue.Queue()  # Changes and calls waiting to be written, in order
+        self.error = None  # First storage error, raised again from flush
+
+    # Queue a change record to be written
+    def submit(self, record):
+        self.queue.put(record)
+
+    # Run a function on the writer thread and wait for its result
+    def call(self, func):
+        if threading.current_thread() is self:
+            return func()
+        writer_call = WriterCall(func)
+        self.queue.put(writer_call)
+        writer_call.done.wait()
+        if writer_call.error:
+            raise writer_call.error
+        return writer_call.result
+
+    # Queue a function to run on the writer thread without waiting for it
+    def post(self, func):
+        self.queue.put(WriterCall(func, detached=True))
+
+    # Take queued items without waiting, up to the batch size or the first queued call
+    def take_queued(self, batch, limit):
+        while len(batch) < limit and all(isinstance(item, tuple) for item in batch[-1:]):
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.take_queued([self.queue.get()], self.batch_size)
+            stop = self.process(batch)
+            for _ in batch:
+                self.queue.task_done()
+            if stop:
+                return
+
+    # Write the records in a batch, then run the call that may end it
+    def process(self, batch):
+        *records, last = batch
+        if isinstance(last, tuple):
+            records.append(last)
+        self.write(records)
+        if last is self.STOP:
+            return True
+        if isinstance(last, WriterCall):
+            last.run()  # Nothing queued after the call has been taken yet, so compaction can drain it
+            if last.detached and last.error:
+                self.error = self.error or last.error
+        if self.system.storage.needs_compaction():
+            self.system.compact()
+        return False
+
+    # Write records to storage in one commit
+    def write(self, records):
+        if not records:
+            return
+        try:
+            self.system.storage.record_changes(records, self.system.users)
+        except Exception as error:
+            self.error = self.error or error
+
+    # Write every queued change that is not yet part of the storage, while the caller holds all locks
+    def drain(self):
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        self.write([item for item in batch if isinstance(item, tuple)])
+        for item in batch:
+            if not isinstance(item, tuple):
+                self.queue.put(item)  # Calls and the stop marker are handled after the snapshot
+            self.queue.task_done()
+
+    # Wait until every queued change has been written
+    def flush(self):
+        self.queue.join()
+        if self.error:
+            error, self.error = self.error, None
+            raise error
+
+    # Write outstanding changes and stop the thread
+    def stop(self):
+        if self.is_alive():
+            self.queue.put(self.STOP)
+            self.join()
+
+# Main class for managing the ticket booking system
+class TicketBookingSystem:
+    # background_builds=False leaves the user index and the visit calendar to be built when first needed, rather than
+    # on background threads from the start; one-shot commands that never search or report visitors then skip them.
+    def __init__(self, users_file="users.pkl", tickets_file="tickets.pkl", compact_every=1000, storage=None, pricing_rules=None, kdf_workers=None, background_builds=True):
+        # Initialize the storage backend and load users and tickets data
+        self.users_file = users_file  # File to store user data
+        self.tickets_file = tickets_file  # File to store ticket data
+        self.storage = storage or MappedStorage(users_file, tickets_file, compact_every)  # Backend that persists the data
+        self.users = self.load_users()  # Load existing users from storage
+        self.tickets = self.load_tickets()  # Load existing tickets from storage
+        # Locks, always taken in this order: users_lock, then one or more user stripes in index order, then ticket locks
+        self.users_lock = threading.Lock()  # Guards adding and removing users
+        self.user_locks = [threading.Lock() for _ in range(64)]  # Lock stripes guarding individual users
+        self.ticket_locks = [threading.Lock() for _ in self.tickets]  # One lock per ticket for its sold count
+        self.tickets_lock = threading.Lock()  # Guards tickets_dirty
+        self.tickets_dirty = False  # Whether a save of the tickets is queued on the writer thread
+        self.inventory = self.create_inventory(self.storage.load_inventory())  # Seats sold and held per ticket and visit date
+        self.pricing = PricingEngine(self.tickets, pricing_rules)  # Discount rules compiled per ticket
+        self.hasher = PasswordHasher(kdf_workers)  # Password hashing, off the calling threads
+        self.sessions = SessionCache()  # Sessions opened at login, so later calls skip the password check
+        self.index = UserIndex()  # Users by email, phone number and username prefix
+        self.start_build(self.index.ready, self.build_index, "user-index", background_builds)
+        for ticket, sold in zip(self.tickets, self.inventory.sold_by_ticket()):
+            ticket.sold_count = sold  # Sold counts are rebuilt from the persisted inventory
+        sales = self.storage.load_sales()
+        self.sales = SalesTotals(sales)  # Running totals per ticket, visit date, payment method and age band
+        self.changes = None  # Publisher that numbers every change and streams it to read replicas, once one is attached
+        self.writer = StorageWriter(self)  # Single thread that persists every change
+        self.writer.start()
+        self.calendar = VisitCalendar()  # Users visiting on each date
+        self.start_build(self.calendar.ready, self.build_calendar, "visit-calendar", background_builds)
+        if sales is None:
+            self.rebuild_sales()  # Data saved before sales totals were kept
+        atexit.register(self.close)
+
+    # Inventory of seats, starting from the persisted sold counts
+    def create_inventory(self, sold_counts):
+        return Inventory(self.tickets, sold_counts)
+
+    # Index of the lock stripe guarding a user
+    def user_stripe(self, username):
+        return hash(username) % len(self.user_locks)
+
+    # Lock stripe guarding a user
+    def user_lock(self, username):
+        return self.user_locks[self.user_stripe(username)]
+
+    # Take every lock so no change is in progress while storage is snapshotted
+    @contextmanager
+    def exclusive(self):
+        with ExitStack() as stack:
+            stack.enter_context(self.users_lock)
+            for lock in self.user_locks:
+                stack.enter_context(lock)
+            yield
+
+    # Load user data from storage
+    def load_users(self):
+        return self.storage.load_users()
+
+    # Save all user data to storage
+    def save_users(self):
+        self.writer.call(self.compact)
+
+    # Write a new snapshot that includes every queued change (runs on the writer thread)
+    def compact(self):
+        with self.exclusive():
+            self.writer.drain()
+            self.storage.save_users(self.users)
+
+    # Queue a single change to user data for the writer thread, and for the read replicas if a publisher is attached.
+    # Callers hold the locks guarding the change, so each user's changes are numbered in the order they were made.
+    def log_change(self, record):
+        if self.changes is None:
+            self.writer.submit(record)
+        else:
+            self.changes.publish(record, self.writer.submit)  # Numbered and queued in one step, so replicas see the journal's order
+
+    # Send a change that storage keeps outside the change records (the tickets) to the read replicas only
+    def publish_change(self, record):
+        if self.changes is not None:
+            self.changes.publish(record)
+
+    # List (username, packed purchase records) for every user, for reporting
+    def purchase_buffers(self):
+        self.flush()  # Storage that reads from disk must see every queued purchase
+        return self.storage.purchase_buffers(self.users)
+
+    # Sales totals for one of SalesTotals.DIMENSIONS as key -> (units, revenue cents, discount cents, orders)
+    def sales_report(self, dimension):
+        return self.sales.report(dimension)
+
+    # Run a build on a background thread, now or once its event is first waited on or checked
+    @staticmethod
+    def start_build(event, build, name, now=True):
+        thread = threading.Thread(target=build, name=name, daemon=True)
+        event.starter = thread.start
+        if now:
+            event.start()
+
+    # Index the existing users by email, phone number and username (runs on a background thread)
+    def build_index(self):
+        self.index.build(self.storage.user_contacts(self.users))
+
+    # Index who visits on each date from the stored purchase histories (runs on a background thread)
+    def build_calendar(self):
+        self.calendar.build(self.purchase_buffers(), lambda username: username in self.users)
+
+    # Seats sold per ticket and distinct visitors for each of the given number of days from first_date (today if not
+    # given); returns [(visit date, {ticket id: seats}, visitors)] for the days with any sales
+    def attendance(self, first_date=None, days=30):
+        first = checked_visit_ordinal(first_date) or date.today().toordinal()
+        seats = self.inventory.attendance(first, first + days - 1)
+        visitors = self.calendar.visitor_counts([ordinal for ordinal, _ in seats])
+        return [(date.fromordinal(ordinal).isoformat(), tickets, visitors[ordinal]) for ordinal, tickets in seats]
+
+    # One page of the users visiting on a date (YYYY-MM-DD) and the number of visitors
+    def visitors_on(self, visit_date, offset=0, limit=50):
+        ordinal = checked_visit_ordinal(visit_date)
+        if not ordinal:
+            raise ValueError("A visit date is required.")
+        return self.calendar.visitors_on(ordinal, offset, limit)
+
+    # Number of users visiting on a date (YYYY-MM-DD)
+    def visitor_count(self, visit_date):
+        return self.visitors_on(visit_date, 0, 0)[1]
+
+    # Recompute the sales totals from every user's purchase history and persist them. The histories are the record of
+    # what was sold, so seats they hold that the inventory lacks (purchases saved before seats were counted) are added
+    # to the inventory too, and the sold counts agree with the totals. Seats of deleted users' purchases are kept.
+    def rebuild_sales(self):
+        seats = {}  # Seats bought per (ticket id, visit date ordinal), according to the histories
+        with self.exclusive():
+            self.sales = SalesTotals.from_users(self.storage.iter_users(self.users), seats)
+            missing = []
+            for (ticket_id, visit_ordinal), quantity in sorted(seats.items()):
+                slot = self.inventory.slots.get((ticket_id, visit_ordinal))
+                quantity -= slot.sold if slot else 0
+                if quantity > 0 and ticket_id < len(self.tickets):
+                    self.inventory.add_sold(ticket_id, visit_ordinal, quantity)
+                    missing.append((ticket_id, visit_ordinal, quantity))
+            if missing:
+                self.log_change(("seats", missing))  # Added to the stored sold counts
+            self.log_change(("sales", self.sales.state()))  # Replaces the stored totals
+        for ticket_id, _, quantity in missing:
+            with self.ticket_locks[ticket_id]:
+                self.tickets[ticket_id].sold_count += quantity
+        return self.sales
+
+    # Wait until every change has been written to storage
+    def flush(self):
+        self.writer.flush()
+
+    # Flush outstanding changes and release the storage backend
+    def close(self):
+        if self.writer.is_alive():
+            self.writer.stop()
+            self.storage.close()
+            self.hasher.close()
+            atexit.unregister(self.close)
+
+    # Load ticket data from storage, falling back to the default tickets
+    def load_tickets(self):
+        tickets = self.storage.load_tickets()
+        if not tickets:
+            return default_tickets()
+        fixed = [ticket for ticket in tickets if ticket.discount in DISCOUNT_TEXT_FIXES]
+        for ticket in fixed:
+            ticket.discount = DISCOUNT_TEXT_FIXES[ticket.discount]
+        if fixed:
+            self.storage.save_tickets(tickets)  # Saved corrected, so customers are shown the discount that is applied
+        return tickets
+
+    # Have the writer thread save the tickets; changes made before it gets to them share one write
+    def save_tickets(self):
+        with self.tickets_lock:
+            if self.tickets_dirty:
+                return  # A save is queued already and will pick up this change
+            self.tickets_dirty = True
+        self.writer.post(self.write_tickets)
+
+    # Write the tickets as they are now (runs on the writer thread)
+    def write_tickets(self):
+        with self.tickets_lock:
+            self.tickets_dirty = False  # Changes from here on queue another save
+        self.storage.save_tickets(self.tickets)
+
+    # Change a ticket's price and save the tickets
+    def update_ticket_price(self, ticket_choice, price):
+        if price <= 0:
+            raise ValueError("Price must be positive!")
+        with self.ticket_locks[ticket_choice]:
+            self.tickets[ticket_choice].price = price
+            self.publish_change(("price", ticket_choice, price))
+        self.save_tickets()
+
+    # Register a new user if the username does not already exist
+    def register_user(self, username, password, email, phone_number, dob):
+        if username in self.users:
+            return False  # Taken already, so skip hashing the password
+        if self.index.email_taken(email):
+            raise DuplicateEmailError("Email is already registered!")
+        password_hash = self.hasher.hash(password)  # Only the salted hash is stored
+        with self.users_lock:
+            if username in self.users:
+                return False  # Return False if the username is already taken
+            if self.index.email_taken(email):
+                raise DuplicateEmailError("Email is already registered!")  # Taken while the password was hashed
+            user = User(username, password_hash, email, phone_number, dob)  # Create a new user
+            # Logged before the user can be found, so a purchase by the new user is never logged ahead of it
+            self.log_change(("register", username, password_hash, email, phone_number, dob))  # Persist the new user
+            self.users[username] = user  # Store the user in the dictionary
+            self.index.add(username, email, phone_number)
+        return True  # Return True indicating successful registration
+
+    # Login a user by validating the username and password
+    def login_user(self, username, password):
+        user = self.users.get(username)  # Retrieve user by username
+        if user is None:
+            return None  # Return None if the login fails
+        stored = user.password
+        if not self.hasher.verify(password, stored):
+            return None
+        if not is_password_hash(stored):
+            # Replace a plain-text password saved by an earlier version with its hash
+            password_hash = self.hasher.hash(password)
+            with self.user_lock(username):
+                if user.password == stored:
+                    user.password = password_hash
+                    self.log_change(("password", username, password_hash))
+        return user  # Return the user object if login is successful
+
+    # Whether the user index has been built, so searches answer without waiting
+    def index_ready(self):
+        return self.index.ready.is_set()
+
+    # Find users by exact email or phone number, or by username prefix; returns (page of usernames, number of matches)
+    def search_users(self, prefix="", email=None, phone_number=None, offset=0, limit=50):
+        return self.index.search(prefix, email, phone_number, offset, limit)
+
+    # One page of usernames for free search text: an email address, a phone number, or the start of a username
+    def user_page(self, text="", offset=0, limit=50):
+        text = text.strip()
+        if "@" in text:
+            return self.search_users(email=text, offset=offset, limit=limit)
+        if text and PHONE_FORMAT.match(text):
+            return self.search_users(phone_number=text, offset=offset, limit=limit)
+        return self.search_users(prefix=text, offset=offset, limit=limit)
+
+    # One page of a user's purchase history as display text; returns (rows, number of purchases)
+    def purchase_page(self, username, offset=0, limit=50):
+        with self.user_lock(username):
+            user = self.users.get(username)
+            if user is None:
+                return [], 0
+            history = user.purchase_history
+            return [render_purchase(purchase, self.tickets) for purchase in history.page(offset, limit)], len(history)
+
+    # Check a user's password and open a session; returns the session token, or None if the login fails
+    def open_session(self, username, password):
+        if self.login_user(username, password) is None:
+            return None
+        return self.sessions.open(username)
+
+    # Username of a live session, or None
+    def session_user(self, token):
+        return self.sessions.user(token)
+
+    # End a session
+    def close_session(self, token):
+        self.sessions.close(token)
+
+    # Add a purchased ticket to the user's purchase history, first confirming the seats held by a reservation if given.
+    # The seats are confirmed under the user's lock, so exclusive() never sees them sold without the purchase logged.
+    def add_purchase_to_user(self, username, ticket_id, quantity, price_cents, discount_bps, visit_ordinal=0, payment_code=0, reservation=None):
+        with self.user_lock(username):
+            user = self.users.get(username)  # Retrieve the user by username
+            if reservation is not None:
+                if user is None:
+                    self.inventory.release(reservation)  # No seats are sold to a user who does not exist (or was just deleted)
+                    raise ValueError(f"Unknown user: {username}")
+                if not self.inventory.confirm(reservation):
+                    raise SoldOutError("Reservation expired before the purchase was completed.")
+            if user:
+                purchase = Purchase(ticket_id, quantity, price_cents, discount_bps, visit_ordinal, payment_code)
+                band = age_band(user.dob, visit_ordinal)
+                user.add_purchase(*purchase)  # Add the ticket to the user's history
+                self.sales.add(purchase, band)  # Keep the running sales totals current
+                self.calendar.add(username, (visit_ordinal,))
+                self.log_change(("purchase", username, *purchase, band))  # Persist the purchase
+
+    # Modify the user's details (email, phone number, date of birth)
+    def modify_user_details(self, username, email=None, phone_number=None, dob=None):
+        with self.users_lock, self.user_lock(username):  # users_lock keeps two users from taking the same email
+            user = self.users.get(username)  # Retrieve the user by username
+            if user:
+                if email and self.index.email_taken(email, username):
+                    raise DuplicateEmailError("Email is already registered!")
+                old_email, old_phone = user.email, user.phone_number
+                user.update_details(email, phone_number, dob)  # Update the user's details
+                self.index.change(username, old_email, old_phone, user.email, user.phone_number)
+                self.log_change(("update", username, email, phone_number, dob))  # Persist the new details
+                return True  # Return True indicating successful update
+        return False  # Return False if the user is not found
+
+    # Delete a user account
+    def delete_user(self, username):
+        with self.users_lock, self.user_lock(username):
+            user = self.users.pop(username, None)
+            if user is None:
+                return False  # Return False if the user is not found
+            self.index.remove(username, user.email, user.phone_number)
+            self.calendar.remove(username, {purchase.visit_ordinal for purchase in user.purchase_history})
+            self.log_change(("delete", username))  # Persist the deletion
+        self.sessions.close_user(username)  # A new user with the same name must not inherit the sessions
+        return True
+
+    # Price a ticket, applying relevant discounts; returns (quantity, final price, discount)
+    def quote_ticket(self, ticket_choice, num_persons=None, visit_date=None):
+        return self.pricing.quote(ticket_choice, num_persons, visit_ordinal=checked_visit_ordinal(visit_date))
+
+    # Purchase a ticket by the user, applying relevant discounts
+    def purchase_ticket(self, username, ticket_choice, num_persons=None, visit_date=None, payment_method=None, reservation=None):
+        visit_ordinal = checked_visit_ordinal(visit_date)  # Parsed once, for the price and the stored purchase
+        quantity, final_price, discount = self.pricing.quote(ticket_choice, num_persons, visit_ordinal=visit_ordinal)
+        ticket_record = self.record_purchase(username, ticket_choice, quantity, final_price, discount, visit_ordinal, payment_method, reservation)
+        with self.ticket_locks[ticket_choice]:
+            self.tickets[ticket_choice].sold_count += quantity  # Update ticket's sold count
+        return final_price, ticket_record  # Return final price and ticket record
+
+    # Purchase many tickets at once, e.g. for a group or corporate order; either every order is applied or none is.
+    # Each order is (username, ticket_choice[, num_persons[, visit_date[, payment_method]]]).
+    def purchase_many(self, orders):
+        orders = [(*order, None, None, None)[:5] for order in orders]
+        ordinals, payment_codes = {}, {}  # Each distinct date and payment method is parsed once
+        for _, _, _, visit_date, payment_method in orders:
+            if visit_date not in ordinals:
+                ordinals[visit_date] = checked_visit_ordinal(visit_date)
+            if payment_method not in payment_codes:
+                payment_codes[payment_method] = payment_method_code(payment_method)
+        quotes = self.pricing.quote_many((ticket_choice, num_persons, ordinals[visit_date]) for _, ticket_choice, num_persons, visit_date, _ in orders)
+        purchases = []
+        usernames = []
+        seats = {}  # Seats needed per (ticket id, visit date ordinal)
+        for (username, ticket_choice, _, visit_date, payment_method), (quantity, final_price, discount) in zip(orders, quotes):
+            visit_ordinal = ordinals[visit_date]
+            payment_code = payment_codes[payment_method]
+            purchase = Purchase(ticket_choice, quantity, round(final_price * 100), round(discount * 10000), visit_ordinal, payment_code)
+            error = purchase_error(purchase)
+            if error:
+                raise ValueError(f"Order {len(purchases) + 1}: {error}")  # Before any seats are held, so nothing is applied
+            purchases.append(purchase)
+            usernames.append(username)
+            seats[(ticket_choice, visit_ordinal)] = seats.get((ticket_choice, visit_ordinal), 0) + quantity
+
+        stripes = sorted({self.user_stripe(username) for username in set(usernames)})
+        with ExitStack() as stack:
+            for stripe in stripes:  # Stripes in index order, as every other caller takes them
+                stack.enter_context(self.user_locks[stripe])
+            users = {username: self.users.get(username) for username in set(usernames)}
+            missing = [username for username, user in users.items() if user is None]
+            if missing:
+                raise ValueError(f"Unknown user: {missing[0]}")
+            reservations = []
+            for (ticket_id, visit_ordinal), quantity in seats.items():
+                reservation = self.inventory.reserve(ticket_id, visit_ordinal, quantity)
+                if reservation is None:
+                    for held in reservations:
+                        self.inventory.release(held)
+                    raise SoldOutError(f"Not enough {self.tickets[ticket_id].name} tickets left for this order.")
+                reservations.append(reservation)
+            for reservation in reservations:
+                self.inventory.confirm(reservation)
+            bands = {}  # Age band per (user, visit date), so each date of birth is parsed once per date
+            visits = {}  # Visit dates per user, for the calendar
+            entries = []
+            for username, purchase in zip(usernames, purchases):
+                key = (username, purchase.visit_ordinal)
+                if key not in bands:
+                    bands[key] = age_band(users[username].dob, purchase.visit_ordinal)
+                    visits.setdefault(username, set()).add(purchase.visit_ordinal)
+                users[username].add_purchase(*purchase)
+                self.sales.add(purchase, bands[key])
+                entries.append((username, *purchase, bands[key]))
+            self.calendar.add_many(visits)
+            self.log_change(("purchases", entries))  # One record, so a crash keeps all or none
+        for (ticket_id, _), quantity in seats.items():
+            with self.ticket_locks[ticket_id]:
+                self.tickets[ticket_id].sold_count += quantity
+        return [(purchase.price_cents / 100, render_purchase(purchase, self.tickets)) for purchase in purchases]
+
+    # Add users in bulk, e.g. from an import. Rows are (username, password or password hash, email, phone number, dob)
+    # that already passed registration_error. Returns (row index, error message) for each row that was skipped.
+    # Plain-text passwords are stored as they are, like those saved by earlier versions, and hashed on first login:
+    # hashing millions of them here would take hours.
+    def import_users(self, rows):
+        rows = list(rows)
+        accepted, rejected = [], []
+        usernames, emails = set(), set()  # Taken by earlier rows of the same batch
+        with self.users_lock:
+            for index, (username, password_hash, email, phone_number, dob) in enumerate(rows):
+                if username in usernames or username in self.users:
+                    rejected.append((index, "Username already exists!"))
+                elif normalize_email(email) in emails or self.index.email_taken(email):
+                    rejected.append((index, "Email is already registered!"))
+                else:
+                    usernames.add(username)
+                    emails.add(normalize_email(email))
+                    accepted.append((username, password_hash, email, phone_number, dob))
+            if accepted:
+                self.log_change(("users", accepted))  # One record for the whole batch, logged before any of them can buy
+            for details in accepted:
+                self.users[details[0]] = User(*details)
+                self.index.add(details[0], details[2], details[3])
+        return rejected
+
+    # Add purchase history in bulk, e.g. from an import. Rows are (username, Purchase); the purchases were made already,
+    # so seats are counted without checking capacity. Returns (row index, error message) for each row that was skipped.
+    def import_purchases(self, rows):
+        rows = list(rows)
+        rejected, entries, sold = [], [], []
+        seats = {}  # Seats sold per (ticket id, visit date ordinal)
+        stripes = sorted({self.user_stripe(username) for username, _ in rows})
+        with ExitStack() as stack:
+            for stripe in stripes:  # Stripes in index order, as every other caller takes them
+                stack.enter_context(self.user_locks[stripe])
+            users, bands = {}, {}  # Each user is looked up, and each date of birth parsed per date, once
+            visits = {}  # Visit dates per user, for the calendar
+            for index, (username, purchase) in enumerate(rows):
+                if username not in users:
+                    users[username] = self.users.get(username)
+                user = users[username]
+                if user is None:
+                    rejected.append((index, f"Unknown user: {username}"))
+                    continue
+                if purchase.ticket_id >= len(self.tickets):
+                    rejected.append((index, f"Unknown ticket id: {purchase.ticket_id}"))
+                    continue
+                key = (username, purchase.visit_ordinal)
+                if key not in bands:
+                    bands[key] = age_band(user.dob, purchase.visit_ordinal)
+                    visits.setdefault(username, set()).add(purchase.visit_ordinal)
+                user.add_purchase(*purchase)
+                sold.append((purchase, bands[key]))
+                entries.append((username, *purchase, bands[key]))
+                seats[(purchase.ticket_id, purchase.visit_ordinal)] = seats.get((purchase.ticket_id, purchase.visit_ordinal), 0) + purchase.quantity
+            self.sales.add_many(sold)
+            self.calendar.add_many(visits)
+            for (ticket_id, visit_ordinal), quantity in seats.items():
+                self.inventory.add_sold(ticket_id, visit_ordinal, quantity)
+            if entries:
+                self.log_change(("purchases", entries))  # One record for the whole batch
+        for (ticket_id, _), quantity in seats.items():
+            with self.ticket_locks[ticket_id]:
+                self.tickets[ticket_id].sold_count += quantity
+        return rejected
+
+    # Replace or add tickets in bulk, e.g. from an import. Rows are (ticket id, Ticket); sold counts are kept, and new
+    # ids must follow on from the end of the catalog. Returns (row index, error message) for each row that was skipped.
+    def import_tickets(self, rows):
+        rejected, changed = [], []
+        with self.exclusive():
+            for index, (ticket_id, ticket) in enumerate(rows):
+                if ticket_id < len(self.tickets):
+                    current = self.tickets[ticket_id]
+                    for name in ("name", "description", "price", "validity", "discount", "terms", "capacity"):
+                        setattr(current, name, getattr(ticket, name))
+                    self.pricing.table[ticket_id] = self.pricing.compile(ticket_id)  # The rules follow the ticket's name
+                elif ticket_id == len(self.tickets):
+                    self.tickets.append(ticket)
+                    self.ticket_locks.append(threading.Lock())
+                    self.pricing.table.append(self.pricing.compile(ticket_id))
+                else:
+                    rejected.append((index, f"Ticket id {ticket_id} leaves a gap after the last ticket ({len(self.tickets) - 1})"))
+                    continue
+                changed.append(ticket_id)
+            if changed:
+                self.publish_change(("tickets", [(ticket_id, copy.copy(self.tickets[ticket_id])) for ticket_id in changed]))
+        self.save_tickets()
+        return rejected
+
+    # Store a priced purchase in the user's history and return its display text
+    def record_purchase(self, username, ticket_choice, quantity, final_price, discount, visit_ordinal, payment_method, reservation=None):
+        purchase = Purchase(ticket_choice, quantity, round(final_price * 100), round(discount * 10000), visit_ordinal, payment_method_code(payment_method))
+        error = purchase_error(purchase)
+        if error:
+            raise ValueError(error)  # Checked before any seats are held, so a purchase that cannot be stored takes none
+        if reservation is None:
+            reservation = self.inventory.reserve(ticket_choice, visit_ordinal, quantity)  # Hold the seats while the sale is recorded
+            if reservation is None:
+                raise SoldOutError(f"{self.tickets[ticket_choice].name} is sold out for {date.fromordinal(visit_ordinal).isoformat() if visit_ordinal else 'that date'}.")
+        elif (reservation.ticket_id, reservation.visit_ordinal, reservation.quantity) != (ticket_choice, visit_ordinal, quantity):
+            raise ValueError("Reservation does not match the purchase.")
+        self.add_purchase_to_user(username, *purchase, reservation=reservation)  # Confirm the seats and add the purchase record to the user
+        return render_purchase(purchase, self.tickets)
+
+    # Hold seats of a ticket for a visit date; returns None if too few are left
+    def reserve_tickets(self, ticket_choice, visit_date=None, quantity=1, hold_seconds=None):
+        return self.inventory.reserve(ticket_choice, checked_visit_ordinal(visit_date), quantity, hold_seconds)
+
+    # Give back seats held by a reservation that will not be purchased
+    def release_reservation(self, reservation):
+        self.inventory.release(reservation)
+
+    # Seats of a ticket left for a visit date, or None if the ticket is unlimited
+    def seats_left(self, ticket_choice, visit_date=None):
+        return self.inventory.available(ticket_choice, checked_visit_ordinal(visit_date))
+
+# Raised when the waiting room turns a buyer away; retry_after is the suggested wait in seconds before trying again
+class AdmissionError(ValueError):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+# Raised when one buyer tries to purchase faster than their own rate limit allows
+class RateLimitedError(AdmissionError):
+    pass
+
+# TokenBucket class definition: Allows rate events per second on average and bursts of up to burst events (caller holds a lock)
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst  # Starts full
+        self.updated = now  # time.monotonic() of the last refill
+
+    # Add the tokens earned since the last refill
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Take a token if there is one; returns 0, or the seconds until one is earned
+    def take(self, now):
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    # Whether the bucket has been unused long enough to be full again, so forgetting it changes nothing
+    def idle(self, now):
+        return self.tokens + (now - self.updated) * self.rate >= self.burst
+
+# Waiter class definition: One buyer's place in the waiting room
+class Waiter:
+    __slots__ = ("position", "admitted", "left", "event")
+
+    def __init__(self, position=None, admitted=False):
+        self.position = position  # Place in the queue, counting only buyers who were queued; None if admitted on arrival
+        self.admitted = admitted  # Set once the buyer may purchase
+        self.left = False  # Set if the buyer gave up before being admitted
+        self.event = None  # threading.Event set on admission, for a thread blocked in WaitingRoom.wait
+
+# WaitingRoom class definition: First come, first served admission to the purchase path at a steady rate, for on-sale peaks.
+# Buyers over their own rate limit or arriving to a full queue are turned away at once, so excess load costs almost nothing.
+class WaitingRoom:
+    def __init__(self, rate=100, burst=None, user_rate=1, user_burst=3, max_waiting=10000, max_wait=30, max_users=100000):
+        if rate <= 0 or user_rate <= 0:
+            raise ValueError("Purchase rates must be positive; a waiting room cannot pause sales")  # Waits are worked out as queue position / rate
+        now = time.monotonic()
+        self.rate = rate  # Purchases admitted per second across all buyers
+        self.bucket = TokenBucket(rate, burst or max(rate, 1), now)
+        self.user_rate = user_rate  # Purchase attempts per second allowed to one buyer
+        self.user_burst = user_burst
+        self.users = OrderedDict()  # Username -> TokenBucket, least recently used first
+        self.max_users = max_users  # Most per-user buckets kept; idle ones are dropped first
+        self.max_waiting = max_waiting  # Most buyers queued at once
+        self.max_wait = max_wait  # Seconds a buyer may wait; arrivals who would wait longer are turned away
+        self.queue = deque()  # Waiters in arrival order; ones that left are dropped when they reach the front
+        self.positions = itertools.count(1)  # Queue positions, handed out only to buyers who are queued
+        self.served = 0  # Position of the last waiter taken off the front of the queue
+        self.waiting = 0  # Waiters queued that have not left
+        self.counts = {"admitted": 0, "queued": 0, "rate_limited": 0, "shed": 0, "timed_out": 0}  # Running totals
+        self.lock = threading.Lock()
+
+    # Rate limit bucket of a buyer (caller holds the lock)
+    def user_bucket(self, username, now):
+        bucket = self.users.get(username)
+        if bucket is not None:
+            self.users.move_to_end(username)
+            return bucket
+        while self.users and (len(self.users) >= self.max_users or next(iter(self.users.values())).idle(now)):
+            self.users.popitem(last=False)
+        bucket = self.users[username] = TokenBucket(self.user_rate, self.user_burst, now)
+        return bucket
+
+    # Admit waiters from the front of the queue while there are tokens (caller holds the lock)
+    def admit_waiting(self, now):
+        while self.queue:
+            waiter = self.queue[0]
+            if not waiter.left:
+                if self.bucket.take(now):
+                    return
+                waiter.admitted = True
+                self.waiting -= 1
+                self.counts["admitted"] += 1
+                if waiter.event is not None:
+                    waiter.event.set()
+            self.queue.popleft()
+            self.served = waiter.position
+
+    # Seconds until the waiter at a queue position is admitted (caller holds the lock, the bucket was just refilled)
+    def estimate(self, position):
+        return max(position - self.bucket.tokens, 0) / self.rate
+
+    # Join the waiting room; returns a waiter, already admitted if nobody is queued and the rate allows.
+    # Raises RateLimitedError or AdmissionError to turn the buyer away.
+    def enter(self, username=None):
+        now = time.monotonic()
+        with self.lock:
+            if username is not None:
+                delay = self.user_bucket(username, now).take(now)
+                if delay:
+                    self.counts["rate_limited"] += 1
+                    raise RateLimitedError("Too many purchase attempts; please wait a moment.", delay)
+            self.admit_waiting(now)
+            if not self.queue and not self.bucket.take(now):
+                self.counts["admitted"] += 1
+                return Waiter(admitted=True)
+            wait = self.estimate(self.waiting + 1)
+            if self.waiting >= self.max_waiting or wait > self.max_wait:
+                self.counts["shed"] += 1
+                raise AdmissionError("Too many buyers are waiting; please try again later.", wait)
+            waiter = Waiter(next(self.positions))
+            self.queue.append(waiter)
+            self.waiting += 1
+            self.counts["queued"] += 1
+            return waiter
+
+    # Seconds to sleep before asking again, or None once the waiter is admitted; a waiter still queued
+    # at the deadline (time.monotonic()) leaves and AdmissionError is raised
+    def next_delay(self, waiter, deadline):
+        now = time.monotonic()
+        with self.lock:
+            if not waiter.admitted:
+                self.admit_waiting(now)
+            if waiter.admitted:
+                return None
+            if now >= deadline:
+                self.leave_locked(waiter)
+                self.counts["timed_out"] += 1
+                raise AdmissionError("Waited too long for a turn; please try again later.", self.estimate(self.waiting + 1))
+            self.bucket.refill(now)
+            return min(max(self.estimate(waiter.position - self.served), 0.001), deadline - now)
+
+    # Block the calling thread until the waiter is admitted; raises AdmissionError after timeout seconds (max_wait by default)
+    def wait(self, waiter, timeout=None):
+        deadline = time.monotonic() + (self.max_wait if timeout is None else timeout)
+        waiter.event = threading.Event()  # Lets whoever admits the waiter wake it before its estimate
+        delay = self.next_delay(waiter, deadline)
+        while delay is not None:
+            waiter.event.wait(delay)
+            delay = self.next_delay(waiter, deadline)
+
+    # Give up a place in the queue
+    def leave(self, waiter):
+        with self.lock:
+            self.leave_locked(waiter)
+
+    # Give up a place in the queue (caller holds the lock); an admitted waiter has already used its turn
+    def leave_locked(self, waiter):
+        if not waiter.admitted and not waiter.left:
+            waiter.left = True
+            self.waiting -= 1
+
+    # Queue length, expected wait for a new arrival, and running totals
+    def status(self):
+        with self.lock:
+            now = time.monotonic()
+            self.admit_waiting(now)
+            self.bucket.refill(now)
+            return {"waiting": self.waiting, "estimated_wait": self.estimate(self.waiting + 1), "rate": self.rate, **self.counts}
+
+# PurchaseEngine class definition: Serves many concurrent buyers from a thread pool, optionally behind a waiting room
+class PurchaseEngine:
+    STOP = object()  # Queued to stop the dispatcher thread
+
+    def __init__(self, system, workers=None, waiting_room=None):
+        self.system = system  # The ticket booking system that records the sales
+        from concurrent.futures import ThreadPoolExecutor  # Imported here, as the core does not otherwise need it
+        self.executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix="purchase")
+        self.waiting_room = waiting_room  # Admits buyers at a steady rate, if given
+        self.queued = queue.Queue()  # (waiter, deadline, future, purchase) of buyers queued in the waiting room, in arrival order
+        self.dispatcher = None
+        if waiting_room is not None:
+            # One thread waits for each queued buyer's turn, so no pool thread is parked in the waiting room
+            self.dispatcher = threading.Thread(target=self.dispatch, name="purchase-dispatcher", daemon=True)
+            self.dispatcher.start()
+
+    # Queue a purchase and return a future for its (final price, ticket record) result. With a waiting room, a buyer
+    # who is turned away gets AdmissionError here rather than a future.
+    def submit(self, username, ticket_choice, num_persons=None, visit_date=None, payment_method=None):
+        purchase = (username, ticket_choice, num_persons, visit_date, payment_method)
+        if self.waiting_room is None:
+            return self.executor.submit(self.system.purchase_ticket, *purchase)
+        waiter = self.waiting_room.enter(username)
+        if waiter.admitted:
+            return self.executor.submit(self.system.purchase_ticket, *purchase)
+        from concurrent.futures import Future
+        future = Future()  # Completed once the purchase has run, or with AdmissionError if the turn never comes
+        self.queued.put((waiter, time.monotonic() + self.waiting_room.max_wait, future, purchase))
+        return future
+
+    # Hand queued buyers to the pool as their turns come, in arrival order (runs on the dispatcher thread)
+    def dispatch(self):
+        while True:
+            entry = self.queued.get()
+            if entry is self.STOP:
+                return
+            waiter, deadline, future, purchase = entry
+            if future.cancelled():
+                self.waiting_room.leave(waiter)
+                continue
+            try:
+                self.waiting_room.wait(waiter, max(deadline - time.monotonic(), 0))
+            except AdmissionError as error:
+                future.set_exception(error)
+                continue
+            if future.set_running_or_notify_cancel():
+                self.executor.submit(self.system.purchase_ticket, *purchase).add_done_callback(lambda done, future=future: self.settle(future, done))
+
+    # Pass the outcome of a purchase run on the pool to the future the buyer was given
+    @staticmethod
+    def settle(future, done):
+        error = done.exception()
+        if error is None:
+            future.set_result(done.result())
+        else:
+            future.set_exception(error)
+
+    # Wait for queued purchases to finish and for their records to be written
+    def shutdown(self):
+        if self.dispatcher is not None:
+            self.queued.put(self.STOP)  # After every buyer queued so far
+            self.dispatcher.join()
+        self.executor.shutdown(wait=True)
+        self.system.flush()
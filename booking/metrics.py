@@ -0,0 +1,463 @@
+# Opt-in instrumentation for the booking core: latency histograms, error counts, bytes written per save, lock waits
+# and Tk window build times, exported as Prometheus text, plus a sampling profiler. Nothing is measured until
+# enable() wraps the core's methods, and disable() puts the originals back, so the disabled cost is nil.
+import bisect
+import collections
+import functools
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Histogram bucket bounds: seconds for latencies and lock waits, bytes for saves
+LATENCY_BUCKETS = (0.000001, 0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BYTE_BUCKETS = tuple(1024 * 4 ** n for n in range(11))  # 1 KiB to 1 GiB
+
+# Methods timed by enable(): booking operations, storage methods per backend, and windows per class
+OPERATIONS = (
+    "register_user", "login_user", "open_session", "modify_user_details", "delete_user", "purchase_ticket", "purchase_many",
+    "reserve_tickets", "search_users", "user_page", "purchase_page", "attendance", "visitors_on", "load_users", "load_tickets",
+    "save_users", "compact", "write_tickets", "flush",
+)
+STORAGE_METHODS = ("load_users", "save_users", "load_tickets", "save_tickets", "record_changes")
+STORAGE_CLASSES = ("PickleStorage", "MappedStorage", "SQLiteStorage")
+WINDOWS = {
+    "Application": ("__init__",),
+    "RegisterWindow": ("__init__",),
+    "LoginWindow": ("__init__",),
+    "UserMenu": ("__init__", "purchase_ticket", "view_history", "account_management", "modify_details"),
+    "AdminWindow": ("__init__", "user_management", "ticket_updation", "total_tickets_sold"),
+}
+# System locks timed by enable(), as (attribute, lock label); list attributes hold one lock per user stripe or ticket
+SYSTEM_LOCKS = (("users_lock", "users"), ("user_locks", "user"), ("ticket_locks", "ticket"), ("tickets_lock", "tickets"))
+
+# Format a sample value or bucket bound the way Prometheus writes them
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+# Escape a label value for the text format
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Counter class definition: A total that only goes up
+class Counter:
+    __slots__ = ("value", "lock")
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    # Sample lines for the text format
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+# Histogram class definition: Counts of observations per bucket, with their count and sum
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "lock")
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets  # Upper bounds, ascending
+        self.counts = [0] * (len(buckets) + 1)  # Observations per bucket; the last is above every bound
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    # Sample lines for the text format, with cumulative bucket counts; none until something is observed
+    def samples(self, name, labels):
+        with self.lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        if not count:
+            return []
+        lines = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += bucket_count
+            lines.append((f"{name}_bucket", labels + (("le", format_value(bound)),), cumulative))
+        lines.append((f"{name}_sum", labels, total))
+        lines.append((f"{name}_count", labels, count))
+        return lines
+
+# MetricsRegistry class definition: Named metrics with labels, rendered in the Prometheus text format
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}  # (name, labels) -> Counter or Histogram
+        self.families = {}  # name -> (type, help)
+        self.lock = threading.Lock()
+
+    # Metric for a name and labels, created on first use
+    def get(self, kind, name, help, labels, factory):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                self.families.setdefault(name, (kind, help))
+                metric = self.metrics[key] = factory()
+            return metric
+
+    def counter(self, name, help, **labels):
+        return self.get("counter", name, help, labels, Counter)
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS, **labels):
+        return self.get("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    # Every metric in the Prometheus text exposition format
+    def render(self):
+        with self.lock:
+            metrics = sorted(self.metrics.items())
+            families = dict(self.families)
+        lines = []
+        current = None
+        for (name, labels), metric in metrics:
+            samples = metric.samples(name, labels)
+            if samples and name != current:
+                kind, help = families[name]
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                current = name
+            for sample_name, sample_labels, value in samples:
+                label_text = ",".join(f'{key}="{escape_label(label)}"' for key, label in sample_labels)
+                lines.append(f"{sample_name}{{{label_text}}} {format_value(value)}" if label_text else f"{sample_name} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    # Forget every metric
+    def clear(self):
+        with self.lock:
+            self.metrics.clear()
+            self.families.clear()
+
+REGISTRY = MetricsRegistry()  # Registry used unless another is given
+
+# TimedLock class definition: Lock wrapper that records how long each acquire waited for the lock it wraps
+class TimedLock:
+    __slots__ = ("lock", "waits")
+
+    def __init__(self, lock, waits):
+        self.lock = lock  # The wrapped lock, still shared with anything that holds it directly
+        self.waits = waits  # Histogram of wait times
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self.lock.acquire(False):
+            self.waits.observe(0.0)  # Uncontended
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self.lock.acquire(True, timeout)
+        self.waits.observe(time.perf_counter() - start)
+        return acquired
+
+    def release(self):
+        self.lock.release()
+
+    def locked(self):
+        return self.lock.locked()
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.lock.release()
+
+# Wrap a function so every call is timed into a histogram and every exception counted
+def timed(func, histogram, errors=None):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            if errors is not None:
+                errors.inc()
+            raise
+        finally:
+            histogram.observe(time.perf_counter() - start)
+
+    wrapper.__wrapped_metrics__ = func  # Original, put back by disable()
+    return wrapper
+
+# Instrumentation class definition: Methods replaced by enable() and the systems whose locks it wrapped
+class Instrumentation:
+    def __init__(self, core, registry, gui=None):
+        self.core = core  # Module holding the booking classes
+        self.gui = gui  # Module holding the Tk windows, if the GUI is running
+        self.registry = registry
+        self.patched = []  # (owner, attribute, original)
+        self.systems = []  # Systems created while enabled, whose locks are wrapped
+        self.file_metrics = {}  # (metric name, path) -> histogram, so per-file metrics skip the registry lookup
+
+    # Replace an attribute, remembering the original
+    def patch(self, owner, name, value):
+        self.patched.append((owner, name, getattr(owner, name)))
+        setattr(owner, name, value)
+
+    # Wrap a method defined on a class, if the class defines it
+    def time_method(self, cls, name, histogram, errors=None):
+        if name in cls.__dict__:
+            self.patch(cls, name, timed(cls.__dict__[name], histogram, errors))
+
+    def install(self):
+        core, registry = self.core, self.registry
+        system_class = core.TicketBookingSystem
+        for name in OPERATIONS:
+            self.time_method(
+                system_class, name,
+                registry.histogram("booking_operation_seconds", "Time spent in booking operations", operation=name),
+                registry.counter("booking_operation_errors_total", "Booking operations that raised an exception", operation=name),
+            )
+        for class_name in STORAGE_CLASSES:
+            cls = getattr(core, class_name)
+            for name in STORAGE_METHODS:
+                self.time_method(cls, name, registry.histogram("booking_storage_seconds", "Time spent in storage backend methods", backend=class_name, operation=name))
+        for class_name, names in WINDOWS.items():
+            cls = getattr(self.gui, class_name, None)
+            for name in names if cls is not None else ():
+                window = class_name if name == "__init__" else f"{class_name}.{name}"
+                self.time_method(cls, name, registry.histogram("booking_window_seconds", "Time to build a Tk window's widgets", window=window))
+        self.patch(core, "replace_atomically", self.counted_replace(core.replace_atomically))
+        self.patch(core.UserJournal, "append", self.counted_append(core.UserJournal.append))
+        self.patch(core.UserJournal, "sync", self.timed_sync(core.UserJournal.sync))
+        self.patch(core.InventorySlot, "__init__", self.timed_slot(core.InventorySlot.__init__))
+        self.patch(system_class, "__init__", self.timed_system(system_class.__init__))
+
+    # Histogram for one file, labelled with the file name
+    def file_histogram(self, name, help, buckets, path):
+        histogram = self.file_metrics.get((name, path))
+        if histogram is None:
+            histogram = self.file_metrics[(name, path)] = self.registry.histogram(name, help, buckets, file=os.path.basename(path))
+        return histogram
+
+    # Histogram of bytes written per save of one file
+    def saved_bytes(self, path):
+        return self.file_histogram("booking_save_bytes", "Bytes written per save or journal record", BYTE_BUCKETS, path)
+
+    # replace_atomically that also records the size of every file written through it
+    def counted_replace(self, replace_atomically):
+        @contextmanager
+        def counted(path):
+            with replace_atomically(path) as file:
+                yield file
+                size = file.tell()
+            self.saved_bytes(path).observe(size)
+
+        return counted
+
+    # UserJournal.append that also records the bytes each journal record took
+    def counted_append(self, append):
+        @functools.wraps(append)
+        def counted(journal, record):
+            if journal.file is not None:
+                start = journal.file.tell()
+            else:
+                start = os.path.getsize(journal.path) if os.path.exists(journal.path) else 0  # Opened for appending by this call
+            append(journal, record)
+            self.saved_bytes(journal.path).observe(journal.file.tell() - start)
+
+        return counted
+
+    # UserJournal.sync timed per journal file
+    def timed_sync(self, sync):
+        @functools.wraps(sync)
+        def timed_sync(journal):
+            start = time.perf_counter()
+            sync(journal)
+            self.file_histogram("booking_fsync_seconds", "Time spent forcing journal records to disk", LATENCY_BUCKETS, journal.path).observe(time.perf_counter() - start)
+
+        return timed_sync
+
+    # InventorySlot.__init__ that times waits for the slot's lock
+    def timed_slot(self, init):
+        waits = self.registry.histogram("booking_lock_wait_seconds", "Time spent waiting for locks", lock="inventory")
+
+        @functools.wraps(init)
+        def init_slot(slot, *args, **kwargs):
+            init(slot, *args, **kwargs)
+            slot.lock = TimedLock(slot.lock, waits)
+
+        return init_slot
+
+    # TicketBookingSystem.__init__ that times waits for the system's locks once it is built
+    def timed_system(self, init):
+        @functools.wraps(init)
+        def init_system(system, *args, **kwargs):
+            init(system, *args, **kwargs)
+            self.wrap_locks(system)
+
+        return init_system
+
+    # Swap a system's locks for timed wrappers around the same locks, so threads already using them are unaffected
+    def wrap_locks(self, system):
+        for attribute, label in SYSTEM_LOCKS:
+            waits = self.registry.histogram("booking_lock_wait_seconds", "Time spent waiting for locks", lock=label)
+            locks = getattr(system, attribute)
+            if isinstance(locks, list):
+                locks[:] = [TimedLock(lock, waits) for lock in locks]
+            else:
+                setattr(system, attribute, TimedLock(locks, waits))
+        self.systems.append(system)
+
+    # Put every original back, including the plain locks of systems created while enabled
+    def uninstall(self):
+        for owner, name, original in reversed(self.patched):
+            setattr(owner, name, original)
+        self.patched.clear()
+        unwrap = lambda lock: lock.lock if isinstance(lock, TimedLock) else lock
+        for system in self.systems:
+            for attribute, _ in SYSTEM_LOCKS:
+                locks = getattr(system, attribute)
+                if isinstance(locks, list):
+                    locks[:] = [unwrap(lock) for lock in locks]
+                else:
+                    setattr(system, attribute, unwrap(locks))
+            for slot in list(system.inventory.slots.values()):
+                slot.lock = unwrap(slot.lock)
+        self.systems.clear()
+
+# SamplingProfiler class definition: Samples every thread's stack on a timer and counts the stacks seen
+class SamplingProfiler:
+    def __init__(self, interval=0.005, max_depth=64):
+        self.interval = interval  # Seconds between samples
+        self.max_depth = max_depth  # Innermost frames kept per stack
+        self.stacks = collections.Counter()  # "thread;outer;...;inner" -> samples
+        self.thread = None
+        self.stopping = threading.Event()
+
+    @property
+    def running(self):
+        return self.thread is not None
+
+    def start(self):
+        if self.thread is None:
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.sample, name="sampling-profiler", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.stopping.set()
+            self.thread.join()
+            self.thread = None
+
+    # Start or stop sampling; returns whether it is now running
+    def toggle(self):
+        self.stop() if self.running else self.start()
+        return self.running
+
+    def sample(self):
+        own = threading.get_ident()
+        while not self.stopping.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < self.max_depth:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+    # Stacks in the collapsed format read by flame graph tools, one "stack count" line each
+    def collapsed(self):
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    # The functions most often on top of a stack, as (function, samples)
+    def top(self, limit=20):
+        functions = collections.Counter()
+        for stack, count in list(self.stacks.items()):
+            functions[stack.rsplit(";", 1)[-1]] += count
+        return functions.most_common(limit)
+
+    def clear(self):
+        self.stacks.clear()
+
+PROFILER = SamplingProfiler()  # Profiler toggled through the exporter and the service
+instrumentation = None  # Active Instrumentation while enabled
+
+# Whether enable() is in effect
+def enabled():
+    return instrumentation is not None
+
+# Start measuring the core module (booking.core unless another is given), and the windows of a GUI module, into a registry
+def enable(core=None, registry=REGISTRY, gui=None):
+    global instrumentation
+    if instrumentation is None:
+        if core is None:
+            from booking import core
+        instrumentation = Instrumentation(core, registry, gui)
+        instrumentation.install()
+    return instrumentation.registry
+
+# Stop measuring and put the original methods and locks back
+def disable():
+    global instrumentation
+    if instrumentation is not None:
+        instrumentation.uninstall()
+        instrumentation = None
+
+# Serve GET /metrics, GET /profile, GET /profile/top and POST /profile/start|stop on a daemon thread; returns the server
+def serve(host="127.0.0.1", port=9100, registry=REGISTRY, profiler=PROFILER):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    # MetricsHandler class definition: Answers scrapes and profiler requests
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                self.reply(200, registry.render(), "text/plain; version=0.0.4; charset=utf-8")
+            elif self.path == "/profile":
+                self.reply(200, profiler.collapsed())
+            elif self.path == "/profile/top":
+                self.reply(200, "".join(f"{count:8} {function}\n" for function, count in profiler.top()))
+            else:
+                self.reply(404, "Not found\n")
+
+        def do_POST(self):
+            if self.path in ("/profile/start", "/profile/stop"):
+                profiler.start() if self.path.endswith("start") else profiler.stop()
+                self.reply(200, f"profiler {'running' if profiler.running else 'stopped'}\n")
+            else:
+                self.reply(404, "Not found\n")
+
+        def reply(self, status, text, content_type="text/plain; charset=utf-8"):
+            body = text.encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass  # Scrapes every few seconds would flood stderr
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    return server
+
+# Turn metrics on when BOOKING_METRICS is set: "1" only measures, [host:]port also serves the exporter there.
+# BOOKING_PROFILE=1 starts the sampling profiler as well. Returns whether metrics are on.
+def enable_from_environment(core=None, gui=None):
+    setting = os.environ.get("BOOKING_METRICS", "")
+    if not setting or setting == "0":
+        return False
+    enable(core, gui=gui)
+    if setting != "1":
+        host, _, port = setting.rpartition(":")
+        serve(host or "127.0.0.1", int(port))
+    if os.environ.get("BOOKING_PROFILE") == "1":
+        PROFILER.start()
+    return True
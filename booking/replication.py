@@ -0,0 +1,549 @@
+# Change-log shipping to read-only replicas. A ChangePublisher numbers every change the primary TicketBookingSystem
+# makes (registrations, purchases, detail and price updates, deletions) and streams it over a local socket; each
+# replica process loads a snapshot, applies the stream to its own copy of the data and answers the reporting and
+# search queries, so heavy reads run on other cores and never take the locks the purchase path needs.
+import atexit
+import copy
+import itertools
+import multiprocessing
+import os
+import threading
+import time
+from collections import deque
+from contextlib import ExitStack
+from multiprocessing.connection import Listener, Client
+
+from booking.core import TicketBookingSystem, SalesTotals, User, PurchaseHistory, split_purchase
+
+# Calls a replica answers; everything else changes data and goes to the primary
+QUERIES = (
+    "search_users", "user_page", "purchase_page", "sales_report", "attendance", "visitors_on", "visitor_count",
+)
+
+# FeedStatus class definition: What the publisher has sent to one connected replica and what it has applied
+class FeedStatus:
+    def __init__(self, name, sent):
+        self.name = name  # Name the replica gave when it connected
+        self.sent = sent  # Last change sent
+        self.acked = sent  # Last change the replica reported as applied
+        self.connected = time.time()
+
+# ChangePublisher class definition: Numbers the primary's changes and streams them to replicas over a local socket
+class ChangePublisher:
+    ACK_INTERVAL = 0.01  # Seconds between checks for acknowledgements a replica still owes
+
+    def __init__(self, system, address=None, authkey=None, backlog=100000, heartbeat=1.0, batch_delay=0.002):
+        self.system = system  # The primary ticket booking system
+        self.authkey = authkey or os.urandom(32)  # Shared with the replicas; connections without it are refused
+        self.listener = Listener(address, authkey=self.authkey)  # A Unix socket (a named pipe on Windows) unless given
+        self.address = self.listener.address
+        self.epoch = os.urandom(8).hex()  # Names this stream, so a replica never resumes from another run's numbers
+        self.heartbeat = heartbeat  # Seconds between messages to an idle replica, which keep its lag current
+        self.batch_delay = batch_delay  # Seconds a feed waits after a change before sending, batching those that follow
+        self.condition = threading.Condition()  # Guards lsn and changes; replica feeds wait on it for new changes
+        self.lsn = 0  # Sequence number of the last change
+        self.changes = deque(maxlen=backlog)  # (lsn, publish time, record) of the latest changes, for the feeds to send
+        self.feeds = {}  # Replica name -> FeedStatus
+        self.closed = False
+        system.changes = self
+        threading.Thread(target=self.accept, name="change-publisher", daemon=True).start()
+
+    # Number a change and hand it to the feeds; submit, if given, queues it for storage in the same step
+    # (called with the locks guarding the change held)
+    def publish(self, record, submit=None):
+        with self.condition:
+            if submit is not None:
+                submit(record)
+            self.lsn += 1
+            self.changes.append((self.lsn, time.time(), record))
+            self.condition.notify_all()
+
+    # Changes numbered after lsn, or None if some of them have already left the backlog (caller holds the condition)
+    def changes_after(self, lsn):
+        count = self.lsn - lsn
+        if count > len(self.changes):
+            return None
+        batch = list(itertools.islice(reversed(self.changes), count))  # From the newest end, which is where they are
+        batch.reverse()
+        return batch
+
+    # Accept replica connections until closed
+    def accept(self):
+        while not self.closed:
+            try:
+                connection = self.listener.accept()
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                continue  # A failed handshake, or the listener closing
+            if self.closed:
+                connection.close()
+                break
+            threading.Thread(target=self.serve, args=(connection,), name="change-feed", daemon=True).start()
+
+    # Bring one replica up to date, from where it left off or from a snapshot, then stream changes to it until it goes away
+    def serve(self, connection):
+        feed = None
+        try:
+            name, epoch, applied = connection.recv()
+            with self.condition:
+                resume = epoch == self.epoch and applied <= self.lsn and self.changes_after(applied) is not None
+            if resume:
+                connection.send(("resume", self.epoch))
+                sent = applied
+            else:
+                sent = self.send_snapshot(connection)
+            feed = self.feeds[name] = FeedStatus(name, sent)
+            self.stream(connection, feed)
+        except (OSError, EOFError):
+            pass  # The replica went away; it reconnects and catches up by itself
+        finally:
+            if feed is not None and self.feeds.get(feed.name) is feed:
+                del self.feeds[feed.name]
+            connection.close()
+
+    # Send a consistent copy of the data and return the number of the last change it includes. Tickets, seat counts and
+    # sales totals are copied in one short pause of every lock; users are copied one lock stripe at a time, each with the
+    # number of the last change it includes, so sales in the other stripes carry on meanwhile.
+    def send_snapshot(self, connection):
+        system = self.system
+        with system.exclusive(), ExitStack() as stack:
+            for lock in system.ticket_locks:
+                stack.enter_context(lock)
+            base = self.lsn  # No change can be published while every lock is held
+            tickets = [copy.copy(ticket) for ticket in system.tickets]
+            sold_counts = {key: slot.sold for key, slot in list(system.inventory.slots.items()) if slot.sold}
+            sales = system.sales.state()
+        connection.send(("snapshot", self.epoch, base, tickets, sold_counts, sales))
+        with system.users_lock:
+            usernames = list(system.users)  # Every user that existed at base, unless deleted since
+        stripes = {}
+        for username in usernames:
+            stripes.setdefault(system.user_stripe(username), []).append(username)
+        for stripe, usernames in sorted(stripes.items()):
+            # users_lock keeps the stripe's users from being added or removed while they are copied
+            with system.users_lock, system.user_locks[stripe]:
+                watermark = self.lsn
+                rows = [
+                    (user.username, user.password, user.email, user.phone_number, user.dob, bytes(user.purchase_history.data))
+                    for user in map(system.users.get, usernames) if user is not None
+                ]
+            connection.send(("users", watermark, rows))
+        connection.send(("ready",))
+        return base
+
+    # Send every new change to a replica, or a heartbeat when there is none, and read back how far it has applied them
+    def stream(self, connection, feed):
+        heartbeat_due = 0  # time.monotonic() by which the next message is sent even if nothing changed
+        while True:
+            with self.condition:
+                if feed.sent == self.lsn and not self.closed:
+                    # While the replica has changes to acknowledge, wake up often to read its acknowledgements, so the
+                    # progress in status() is current rather than up to a heartbeat old
+                    self.condition.wait(self.ACK_INTERVAL if feed.acked < feed.sent else max(heartbeat_due - time.monotonic(), 0))
+                waiting = feed.sent == self.lsn and not self.closed
+            while connection.poll():
+                feed.acked = connection.recv()
+            if waiting and time.monotonic() < heartbeat_due:
+                continue
+            time.sleep(self.batch_delay)  # Let a few more changes gather, so busy periods ship larger batches
+            with self.condition:
+                if self.closed:
+                    return
+                lsn = self.lsn
+                batch = self.changes_after(feed.sent)
+            if batch is None:
+                return  # The replica fell further behind than the backlog holds; it reconnects and loads a new snapshot
+            connection.send(("changes", lsn, time.time(), batch))
+            feed.sent = lsn
+            heartbeat_due = time.monotonic() + self.heartbeat
+
+    # Sequence number, backlog and the progress of every connected replica
+    def status(self):
+        with self.condition:
+            lsn, backlog = self.lsn, len(self.changes)
+        return {
+            "lsn": lsn,
+            "backlog": backlog,
+            "feeds": [
+                {"name": feed.name, "sent": feed.sent, "applied": feed.acked, "behind": lsn - feed.acked, "connected_seconds": round(time.time() - feed.connected, 3)}
+                for feed in list(self.feeds.values())
+            ],
+        }
+
+    # Stop publishing and drop every replica connection
+    def close(self):
+        if self.closed:
+            return
+        if self.system.changes is self:
+            self.system.changes = None
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        try:
+            Client(self.address, authkey=self.authkey).close()  # Wakes the accepting thread, which closing the socket does not
+        except OSError:
+            pass
+        self.listener.close()
+
+# SnapshotStorage class definition: Storage backend of a replica; it holds a snapshot in memory and persists nothing
+class SnapshotStorage:
+    def __init__(self, users, tickets, sold_counts, sales):
+        self.users = users
+        self.tickets = tickets
+        self.sold_counts = sold_counts
+        self.sales = sales
+
+    def load_users(self):
+        return self.users
+
+    def load_tickets(self):
+        return self.tickets
+
+    def load_inventory(self):
+        return self.sold_counts
+
+    def load_sales(self):
+        return self.sales
+
+    def iter_users(self, users):
+        return iter(list(users.values()))
+
+    def user_contacts(self, users):
+        return [(user.username, user.email, user.phone_number) for user in self.iter_users(users)]
+
+    def purchase_buffers(self, users):
+        return [(user.username, bytes(user.purchase_history.data)) for user in self.iter_users(users)]
+
+    # The primary persists every change, so a replica writes nothing
+    def record_changes(self, records, users):
+        pass
+
+    def save_users(self, users):
+        pass
+
+    def save_tickets(self, tickets):
+        pass
+
+    def needs_compaction(self):
+        return False
+
+    def close(self):
+        pass
+
+# ReplicaSystem class definition: A read-only TicketBookingSystem that applies the primary's changes to a snapshot
+class ReplicaSystem(TicketBookingSystem):
+    def __init__(self, users, tickets, sold_counts, sales, watermarks=None):
+        # No hashing processes: passwords arrive hashed, and a replica never checks one
+        super().__init__(storage=SnapshotStorage(users, tickets, sold_counts, sales), kdf_workers=0)
+        self.watermarks = watermarks or {}  # Username -> last change included in the user's snapshot copy; emptied once passed
+        self.last_watermark = max(self.watermarks.values(), default=0)  # After this change, every change applies to every user
+
+    # Whether a change to a user is newer than the user's copy in the snapshot. Seat counts, sales totals and tickets
+    # were copied before any streamed change, so those parts of a change always apply.
+    def fresh(self, username, lsn):
+        return lsn > self.watermarks.get(username, 0)
+
+    # Apply a batch of (lsn, publish time, record) changes in order; runs of purchases are applied together
+    def apply_changes(self, changes):
+        purchases = []  # (lsn, username, *purchase, age band) of the purchases not yet applied
+        for lsn, _, record in changes:
+            if record[0] == "purchase":
+                purchases.append((lsn, *record[1:]))
+            elif record[0] == "purchases":
+                purchases.extend((lsn, *entry) for entry in record[1])
+            else:
+                if purchases:
+                    self.apply_purchases(purchases)
+                    purchases = []
+                self.apply_change(lsn, record)
+        if purchases:
+            self.apply_purchases(purchases)
+        if self.watermarks and changes and changes[-1][0] >= self.last_watermark:
+            self.watermarks = {}
+
+    # Apply one change other than a purchase
+    def apply_change(self, lsn, record):
+        action = record[0]
+        if action in ("register", "users"):
+            rows = [record[1:6]] if action == "register" else record[1]
+            rows = [row for row in rows if self.fresh(row[0], lsn)]
+            if rows:
+                self.import_users(rows)
+        elif action == "update":
+            if self.fresh(record[1], lsn):
+                self.modify_user_details(*record[1:5])
+        elif action == "password":
+            if self.fresh(record[1], lsn):
+                with self.user_lock(record[1]):
+                    user = self.users.get(record[1])
+                    if user:
+                        user.password = record[2]
+        elif action == "delete":
+            if self.fresh(record[1], lsn):
+                self.delete_user(record[1])
+        elif action == "seats":
+            for ticket_id, visit_ordinal, quantity in record[1]:
+                self.inventory.add_sold(ticket_id, visit_ordinal, quantity)
+                with self.ticket_locks[ticket_id]:
+                    self.tickets[ticket_id].sold_count += quantity
+        elif action == "sales":
+            with self.exclusive():
+                self.sales = SalesTotals(record[1])
+        elif action == "price":
+            self.update_ticket_price(record[1], record[2])
+        elif action == "tickets":
+            self.import_tickets(record[1])
+
+    # Apply logged purchases, given as (lsn, username, *purchase, age band), keeping the primary's age bands
+    def apply_purchases(self, entries):
+        sold, visits, seats = [], {}, {}
+        stripes = sorted({self.user_stripe(entry[1]) for entry in entries})
+        with ExitStack() as stack:
+            for stripe in stripes:  # Stripes in index order, as every other caller takes them
+                stack.enter_context(self.user_locks[stripe])
+            for lsn, username, *fields in entries:
+                purchase, band = split_purchase(fields)
+                sold.append((purchase, band))
+                key = (purchase[0], purchase[4])  # Ticket id and visit date ordinal
+                seats[key] = seats.get(key, 0) + purchase[1]
+                user = self.users.get(username) if self.fresh(username, lsn) else None
+                if user is not None:
+                    user.add_purchase(*purchase)
+                    visits.setdefault(username, set()).add(purchase[4])
+            self.sales.add_many(sold)
+            self.calendar.add_many(visits)
+            for (ticket_id, visit_ordinal), quantity in seats.items():
+                self.inventory.add_sold(ticket_id, visit_ordinal, quantity)
+        for (ticket_id, _), quantity in seats.items():
+            with self.ticket_locks[ticket_id]:
+                self.tickets[ticket_id].sold_count += quantity
+
+# Replica class definition: Follows a publisher from a replica process, keeping a ReplicaSystem current
+class Replica:
+    def __init__(self, address, authkey, name="replica", retry=1.0):
+        self.address = address  # Publisher to follow
+        self.authkey = authkey
+        self.name = name
+        self.retry = retry  # Seconds between attempts to reconnect
+        self.system = None  # ReplicaSystem built from the latest snapshot
+        self.ready = threading.Event()  # Set once the first snapshot has been loaded
+        self.progress = threading.Condition()  # Notified as changes are applied
+        self.epoch = None  # Stream the applied numbers belong to
+        self.applied = 0  # Sequence number of the last change applied
+        self.primary_lsn = 0  # Latest sequence number the primary reported
+        self.lag = 0.0  # Seconds between the primary making the last applied change and the replica applying it
+        self.snapshots = 0  # Snapshots loaded, the first one included
+        self.snapshot_seconds = 0.0  # Time the last snapshot took to receive and load
+        self.connected = False
+        self.closed = False
+        threading.Thread(target=self.follow, name="replica-follow", daemon=True).start()
+
+    # Connect to the publisher and apply its changes, reconnecting whenever the connection drops
+    def follow(self):
+        while not self.closed:
+            try:
+                connection = Client(self.address, authkey=self.authkey)
+            except (OSError, EOFError, multiprocessing.AuthenticationError):
+                time.sleep(self.retry)
+                continue
+            try:
+                self.connected = True
+                self.receive(connection)
+            except (OSError, EOFError):
+                pass
+            finally:
+                self.connected = False
+                connection.close()
+            if not self.closed:
+                time.sleep(self.retry)
+
+    # Catch up from where the last connection left off or from a new snapshot, then apply changes as they arrive
+    def receive(self, connection):
+        connection.send((self.name, self.epoch, self.applied))
+        message = connection.recv()
+        if message[0] == "snapshot":
+            self.load_snapshot(connection, *message[1:])
+        while not self.closed:
+            _, lsn, sent_at, batch = connection.recv()
+            self.system.apply_changes(batch)
+            with self.progress:
+                if batch:
+                    self.applied = batch[-1][0]
+                    self.lag = max(time.time() - batch[-1][1], 0.0)
+                elif self.applied == lsn:
+                    self.lag = 0.0  # Nothing left to apply
+                self.primary_lsn = lsn
+                self.progress.notify_all()
+            connection.send(self.applied)
+
+    # Load a snapshot sent by the publisher and swap it in for the current copy
+    def load_snapshot(self, connection, epoch, base, tickets, sold_counts, sales):
+        started = time.monotonic()
+        users, watermarks = {}, {}
+        while True:
+            message = connection.recv()
+            if message[0] == "ready":
+                break
+            _, watermark, rows = message
+            for username, password, email, phone_number, dob, history in rows:
+                user = users[username] = User(username, password, email, phone_number, dob)
+                user.purchase_history = PurchaseHistory(history)
+                watermarks[username] = watermark
+        system = ReplicaSystem(users, tickets, sold_counts, sales, watermarks)
+        previous = self.system
+        with self.progress:
+            self.system = system
+            self.epoch, self.applied, self.primary_lsn = epoch, base, base
+            self.snapshots += 1
+            self.snapshot_seconds = time.monotonic() - started
+            self.progress.notify_all()
+        self.ready.set()
+        if previous is not None:
+            previous.close()  # Queries already running on it still finish
+
+    # Wait up to timeout seconds until changes up to lsn are applied; returns whether they are
+    def wait_for(self, lsn, timeout):
+        deadline = time.monotonic() + timeout
+        with self.progress:
+            while self.applied < lsn:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self.progress.wait(remaining)
+        return True
+
+    # Answer a read-only call on the current copy, first waiting briefly for changes up to min_lsn, so a reader
+    # sees its own writes
+    def query(self, method, args, min_lsn=0, max_wait=0.5):
+        if method not in QUERIES:
+            raise AttributeError(f"A replica does not answer {method}")
+        self.ready.wait()
+        self.wait_for(min_lsn, max_wait)
+        return getattr(self.system, method)(*args)
+
+    # Replication progress and lag
+    def status(self):
+        with self.progress:
+            return {
+                "name": self.name,
+                "connected": self.connected,
+                "ready": self.ready.is_set(),
+                "indexed": self.ready.is_set() and self.system.index_ready(),
+                "applied": self.applied,
+                "primary": self.primary_lsn,
+                "behind": max(self.primary_lsn - self.applied, 0),
+                "lag_seconds": round(self.lag, 6),
+                "snapshots": self.snapshots,
+                "snapshot_seconds": round(self.snapshot_seconds, 3),
+                "users": len(self.system.users) if self.system else 0,
+            }
+
+    # Stop following the publisher and release the current copy
+    def close(self):
+        self.closed = True
+        if self.system is not None:
+            self.system.close()
+
+# Follow a publisher and answer queries from the process that started the replica (runs in the replica process)
+def run_replica(address, authkey, name, connection):
+    replica = Replica(address, authkey, name)
+    connection.send((True, None))  # Started; queries wait for the first snapshot
+    while True:
+        try:
+            method, args, min_lsn = connection.recv()
+        except EOFError:
+            method = None  # The primary went away without closing the replica
+            break
+        if method is None:
+            break
+        try:
+            result = (True, replica.status() if method == "status" else replica.query(method, args, min_lsn))
+        except Exception as error:
+            result = (False, error)
+        connection.send(result)
+    replica.close()
+    if method is None and not connection.closed:
+        try:
+            connection.send((True, None))  # Closed
+        except OSError:
+            pass
+
+# ReadReplicas class definition: Replica processes following a primary, with the primary's read-only queries spread
+# over them. Each query first waits briefly for the changes made before it, so callers read their own writes.
+class ReadReplicas:
+    def __init__(self, system, count=1, publisher=None):
+        self.owns_publisher = publisher is None  # Closed with the replicas if started here
+        self.publisher = publisher or ChangePublisher(system)
+        self.connections = []  # Pipe to each replica process
+        self.locks = []  # One call at a time per pipe
+        self.processes = []
+        self.turn = itertools.count()  # Round robin over the replicas
+        for index in range(count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_replica, name=f"replica-{index}", daemon=True,
+                args=(self.publisher.address, self.publisher.authkey, f"replica-{index}", child),
+            )
+            process.start()
+            self.connections.append(connection)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+        for connection in self.connections:
+            connection.recv()  # Wait until every replica has started
+        atexit.register(self.close)
+
+    # Call a method in one replica and return its result
+    def call(self, index, method, *args):
+        with self.locks[index]:
+            self.connections[index].send((method, args, self.publisher.lsn))
+            ok, result = self.connections[index].recv()
+        if not ok:
+            raise result
+        return result
+
+    # Call a read-only method in the next replica
+    def query(self, method, *args):
+        return self.call(next(self.turn) % len(self.connections), method, *args)
+
+    def search_users(self, prefix="", email=None, phone_number=None, offset=0, limit=50):
+        return self.query("search_users", prefix, email, phone_number, offset, limit)
+
+    def user_page(self, text="", offset=0, limit=50):
+        return self.query("user_page", text, offset, limit)
+
+    def purchase_page(self, username, offset=0, limit=50):
+        return self.query("purchase_page", username, offset, limit)
+
+    def sales_report(self, dimension):
+        return self.query("sales_report", dimension)
+
+    def attendance(self, first_date=None, days=30):
+        return self.query("attendance", first_date, days)
+
+    def visitors_on(self, visit_date, offset=0, limit=50):
+        return self.query("visitors_on", visit_date, offset, limit)
+
+    def visitor_count(self, visit_date):
+        return self.query("visitor_count", visit_date)
+
+    # Whether every replica has loaded its snapshot and indexed its users; queries made before then wait
+    def index_ready(self):
+        return all(self.call(index, "status")["indexed"] for index in range(len(self.connections)))
+
+    # The primary's sequence number and feeds, and each replica's progress and lag
+    def status(self):
+        return {"primary": self.publisher.status(), "replicas": [self.call(index, "status") for index in range(len(self.connections))]}
+
+    # Stop every replica process, then the publisher if it was started here
+    def close(self):
+        if not self.processes:
+            return
+        for index, connection in enumerate(self.connections):
+            with self.locks[index]:
+                connection.send((None, (), 0))
+                connection.recv()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        if self.owns_publisher:
+            self.publisher.close()
+        atexit.unregister(self.close)
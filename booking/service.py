@@ -0,0 +1,502 @@
+# Asynchronous HTTP/JSON service for the ticket booking system, so many clients can be served without the Tk app
+import asyncio
+import json
+import math
+import os
+import secrets
+import sys
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qsl, unquote
+
+from booking import metrics
+from booking.core import (
+    TicketBookingSystem, SQLiteStorage, SalesTotals, SoldOutError, DuplicateEmailError, AdmissionError, RateLimitedError, WaitingRoom,
+    registration_error,
+)
+
+# Reason phrases for the status codes the service sends
+STATUS_TEXT = {
+    200: "OK", 201: "Created", 400: "Bad Request", 401: "Unauthorized", 403: "Forbidden", 404: "Not Found",
+    405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error",
+    501: "Not Implemented", 503: "Service Unavailable",
+}
+
+# HTTPError class definition: Ends a request with an error status and message
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status  # HTTP status code sent to the client
+
+# Request class definition: One parsed HTTP request
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method, path, query, headers, body):
+        self.method = method
+        self.path = path  # Decoded path segments
+        self.query = query  # Query string parameters
+        self.headers = headers  # Header names in lower case
+        self.body = body
+
+    # Decode the body as a JSON object
+    def json(self):
+        try:
+            data = json.loads(self.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Request body is not valid JSON")
+        if not isinstance(data, dict):
+            raise HTTPError(400, "Request body must be a JSON object")
+        return data
+
+    # Bearer token sent with the request, if any
+    def token(self):
+        scheme, _, token = self.headers.get("authorization", "").partition(" ")
+        return token.strip() if scheme.lower() == "bearer" else None
+
+# Read a string field from a JSON object, or None if it is missing
+def text_field(data, name, required=False):
+    value = data.get(name)
+    if value is None and not required:
+        return None
+    if not isinstance(value, str):
+        raise HTTPError(400, f"{name} must be a string")
+    return value.strip()
+
+# BookingService class definition: Routes HTTP requests to a TicketBookingSystem
+class BookingService:
+    MAX_BODY = 1 << 20  # Largest request body accepted, in bytes
+    MAX_LINE = 8192  # Longest request or header line accepted, in bytes; longer lines close the connection
+
+    def __init__(self, system, admin_token=None, workers=None, keep_alive_timeout=30, waiting_room=None, replicas=None):
+        self.system = system  # The ticket booking system that does the work
+        self.waiting_room = waiting_room  # Admits purchases at a steady rate during on-sale peaks, if given
+        self.replicas = replicas  # Read replicas that answer the admin reports and searches, if given
+        self.reports = replicas or system  # Where the admin reports and searches are read from
+        self.admin_token = admin_token  # Bearer token for the admin routes; they are disabled without one
+        self.keep_alive_timeout = keep_alive_timeout  # Seconds an idle connection is kept open
+        # Calls into the system can block on locks or storage, so they run on worker threads, never on the event loop
+        self.executor = ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) + 4), thread_name_prefix="service")
+        # (method, path pattern, handler); "*" matches any one path segment, which is passed to the handler
+        self.routes = [
+            ("GET", ("tickets",), self.list_tickets),
+            ("GET", ("tickets", "*", "quote"), self.quote_ticket),
+            ("POST", ("users",), self.register_user),
+            ("POST", ("sessions",), self.login_user),
+            ("GET", ("users", "*"), self.get_user),
+            ("PATCH", ("users", "*"), self.modify_user_details),
+            ("POST", ("users", "*", "purchases"), self.purchase_ticket),
+            ("GET", ("waiting-room",), self.waiting_room_status),
+            ("GET", ("admin", "users"), self.list_users),
+            ("DELETE", ("admin", "users", "*"), self.delete_user),
+            ("PATCH", ("admin", "tickets", "*"), self.update_ticket),
+            ("GET", ("admin", "sales", "*"), self.sales_report),
+            ("GET", ("admin", "attendance"), self.attendance),
+            ("GET", ("admin", "visitors", "*"), self.visitors_on),
+            ("GET", ("admin", "replication"), self.replication_status),
+            ("GET", ("admin", "metrics"), self.metrics),
+            ("GET", ("admin", "profile"), self.profile),
+            ("POST", ("admin", "profile"), self.toggle_profiler),
+        ]
+
+    # Run a blocking call on a worker thread
+    def call(self, func, *args):
+        return asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    # Serve one connection, answering requests until the client closes it or stops keeping it alive
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), self.keep_alive_timeout)
+                except asyncio.TimeoutError:
+                    break  # Idle keep-alive connection
+                if not request_line:
+                    break
+                try:
+                    request, keep_alive = await self.read_request(request_line, reader)
+                except HTTPError as error:
+                    status, payload, keep_alive = error.status, {"error": str(error)}, False  # The stream can no longer be trusted
+                else:
+                    status, payload = await self.dispatch(request)
+                writer.write(self.response(status, payload, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass  # Client went away or sent something unreadable
+        finally:
+            writer.close()
+
+    # Read the headers and body following a request line; returns the request and whether to keep the connection
+    async def read_request(self, request_line, reader):
+        try:
+            method, target, version = request_line.decode("latin-1").split()
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        if "transfer-encoding" in headers:
+            raise HTTPError(501, "Chunked request bodies are not supported")
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length < 0 or length > self.MAX_BODY:
+            raise HTTPError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+        connection = headers.get("connection", "").lower()
+        keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+        url = urlsplit(target)
+        path = tuple(unquote(segment) for segment in url.path.split("/") if segment)
+        return Request(method.upper(), path, dict(parse_qsl(url.query)), headers, body), keep_alive
+
+    # Find the handler for a request and run it; returns (status, JSON payload)
+    async def dispatch(self, request):
+        allowed = False  # Whether the path matched a route for another method
+        for method, pattern, handler in self.routes:
+            if len(pattern) != len(request.path):
+                continue
+            if any(part != "*" and part != segment for part, segment in zip(pattern, request.path)):
+                continue
+            if method != request.method:
+                allowed = True
+                continue
+            args = [segment for part, segment in zip(pattern, request.path) if part == "*"]
+            try:
+                return await handler(request, *args)
+            except HTTPError as error:
+                return error.status, {"error": str(error)}
+            except (SoldOutError, DuplicateEmailError) as error:
+                return 409, {"error": str(error)}
+            except AdmissionError as error:
+                return 429 if isinstance(error, RateLimitedError) else 503, {"error": str(error), "retry_after": round(error.retry_after, 3)}
+            except ValueError as error:
+                return 400, {"error": str(error)}
+            except Exception:
+                traceback.print_exc()
+                return 500, {"error": "Internal server error"}
+        if allowed:
+            return 405, {"error": "Method not allowed"}
+        return 404, {"error": "Not found"}
+
+    # Encode a JSON response, or a plain text one for a string payload; a retry_after in an error also goes in a Retry-After header
+    @staticmethod
+    def response(status, payload, keep_alive):
+        retry_after = ""
+        if isinstance(payload, str):
+            body, content_type = payload.encode("utf-8"), "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body, content_type = json.dumps(payload).encode("utf-8"), "application/json"
+            if status >= 400 and isinstance(payload, dict) and "retry_after" in payload:
+                retry_after = f"Retry-After: {max(math.ceil(payload['retry_after']), 1)}\r\n"
+        head = (
+            f"HTTP/1.1 {status} {STATUS_TEXT.get(status, 'Unknown')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"{retry_after}"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        return head.encode("latin-1") + body
+
+    # Check that the request carries the session of the given user (or the admin token)
+    def authorize_user(self, request, username):
+        token = request.token()
+        if token is None:
+            raise HTTPError(401, "Login required")
+        if self.system.session_user(token) != username and not self.is_admin(token):
+            raise HTTPError(403, "Not allowed for this user")
+
+    # Check that the request carries the admin token
+    def authorize_admin(self, request):
+        if not self.is_admin(request.token()):
+            raise HTTPError(403, "Admin token required")
+
+    def is_admin(self, token):
+        return self.admin_token is not None and token is not None and secrets.compare_digest(token, self.admin_token)
+
+    # Look up a ticket id given in the path
+    def ticket_id(self, value):
+        if not value.isdigit() or int(value) >= len(self.system.tickets):
+            raise HTTPError(404, "Unknown ticket")
+        return int(value)
+
+    # Ticket details as JSON
+    @staticmethod
+    def ticket_json(ticket_id, ticket):
+        return {
+            "id": ticket_id, "name": ticket.name, "description": ticket.description, "price": ticket.price,
+            "validity": ticket.validity, "discount": ticket.discount, "terms": ticket.terms,
+            "capacity": ticket.capacity, "sold_count": ticket.sold_count,
+        }
+
+    # GET /tickets
+    async def list_tickets(self, request):
+        return 200, [self.ticket_json(ticket_id, ticket) for ticket_id, ticket in enumerate(self.system.tickets)]
+
+    # GET /tickets/<id>/quote?num_persons=&visit_date=
+    async def quote_ticket(self, request, ticket_id):
+        num_persons = request.query.get("num_persons")
+        if num_persons is not None:
+            if not num_persons.isdigit():
+                raise HTTPError(400, "num_persons must be a positive integer")
+            num_persons = int(num_persons)
+        quantity, price, discount = self.system.quote_ticket(self.ticket_id(ticket_id), num_persons, request.query.get("visit_date"))
+        return 200, {"quantity": quantity, "price": round(price, 2), "discount": discount}
+
+    # POST /users {username, password, email, phone_number, dob}
+    async def register_user(self, request):
+        data = request.json()
+        fields = [text_field(data, name, required=True) for name in ("username", "password", "email", "phone_number", "dob")]
+        error = registration_error(*fields)
+        if error:
+            raise HTTPError(400, error)
+        if not await self.call(self.system.register_user, *fields):
+            raise HTTPError(409, "Username already exists!")
+        return 201, {"username": fields[0]}
+
+    # POST /sessions {username, password}: log in and get a session token, so later calls skip the password check
+    async def login_user(self, request):
+        data = request.json()
+        username = text_field(data, "username", required=True)
+        token = await self.call(self.system.open_session, username, text_field(data, "password", required=True))
+        if token is None:
+            raise HTTPError(401, "Invalid credentials!")
+        return 200, {"token": token, "username": username}
+
+    # GET /users/<username>: account details and purchase history
+    async def get_user(self, request, username):
+        self.authorize_user(request, username)
+        details = await self.call(self.user_details, username)  # Looked up and rendered off the event loop
+        if details is None:
+            raise HTTPError(404, "User not found")
+        return 200, details
+
+    # Account details and rendered purchase history of a user, or None (runs on a worker thread)
+    def user_details(self, username):
+        user = self.system.users.get(username)
+        if user is None:
+            return None
+        return {
+            "username": user.username, "email": user.email, "phone_number": user.phone_number, "dob": user.dob,
+            "purchases": user.purchase_history.render(self.system.tickets),
+        }
+
+    # PATCH /users/<username> {email, phone_number, dob}
+    async def modify_user_details(self, request, username):
+        self.authorize_user(request, username)
+        data = request.json()
+        details = [text_field(data, name) for name in ("email", "phone_number", "dob")]
+        if not await self.call(self.system.modify_user_details, username, *details):
+            raise HTTPError(404, "User not found")
+        return 200, {"username": username}
+
+    # POST /users/<username>/purchases {ticket_id, num_persons, visit_date, payment_method}
+    async def purchase_ticket(self, request, username):
+        self.authorize_user(request, username)
+        data = request.json()
+        ticket_id = data.get("ticket_id")
+        if isinstance(ticket_id, bool) or not isinstance(ticket_id, int) or not 0 <= ticket_id < len(self.system.tickets):
+            raise HTTPError(400, "ticket_id must be a ticket number")
+        num_persons = data.get("num_persons")
+        if num_persons is not None and (isinstance(num_persons, bool) or not isinstance(num_persons, int) or num_persons < 1):
+            raise HTTPError(400, "num_persons must be a positive integer")
+        if not await self.call(self.system.users.__contains__, username):  # May query storage, so not on the event loop
+            raise HTTPError(404, "User not found")
+        visit_date = text_field(data, "visit_date")
+        if self.waiting_room is not None:
+            # Buyers of a sold-out date are answered before they take a place in the queue
+            if await self.call(self.system.seats_left, ticket_id, visit_date) == 0:
+                raise SoldOutError(f"{self.system.tickets[ticket_id].name} is sold out for {visit_date or 'that date'}.")
+            await self.admission(username)
+        price, ticket_record = await self.call(
+            self.system.purchase_ticket, username, ticket_id, num_persons, visit_date, text_field(data, "payment_method")
+        )
+        return 201, {"price": round(price, 2), "ticket": ticket_record}
+
+    # Wait in the waiting room without holding a worker thread; raises AdmissionError if the buyer is turned away
+    async def admission(self, username):
+        room = self.waiting_room
+        waiter = room.enter(username)
+        deadline = time.monotonic() + room.max_wait
+        try:
+            delay = room.next_delay(waiter, deadline)
+            while delay is not None:
+                await asyncio.sleep(delay)
+                delay = room.next_delay(waiter, deadline)
+        except asyncio.CancelledError:
+            room.leave(waiter)
+            raise
+
+    # GET /waiting-room: buyers queued for a purchase, the expected wait for a new arrival, and running totals
+    async def waiting_room_status(self, request):
+        if self.waiting_room is None:
+            raise HTTPError(404, "No waiting room; start the service with BOOKING_PURCHASE_RATE set")
+        status = self.waiting_room.status()
+        return 200, {**status, "estimated_wait": round(status["estimated_wait"], 3)}
+
+    # GET /admin/users?prefix=&email=&phone_number=&offset=&limit=
+    async def list_users(self, request):
+        self.authorize_admin(request)
+        query = request.query
+        offset, limit = query.get("offset", "0"), query.get("limit", "50")
+        if not offset.isdigit() or not limit.isdigit():
+            raise HTTPError(400, "offset and limit must be non-negative integers")
+        usernames, total = await self.call(
+            self.reports.search_users, query.get("prefix", ""), query.get("email"), query.get("phone_number"), int(offset), min(int(limit), 1000)
+        )
+        return 200, {"users": usernames, "total": total}
+
+    # DELETE /admin/users/<username>
+    async def delete_user(self, request, username):
+        self.authorize_admin(request)
+        if not await self.call(self.system.delete_user, username):
+            raise HTTPError(404, "User not found")
+        return 200, {"username": username}
+
+    # PATCH /admin/tickets/<id> {price}
+    async def update_ticket(self, request, ticket_id):
+        self.authorize_admin(request)
+        ticket_id = self.ticket_id(ticket_id)
+        price = request.json().get("price")
+        if isinstance(price, bool) or not isinstance(price, (int, float)):
+            raise HTTPError(400, "price must be a number")
+        await self.call(self.system.update_ticket_price, ticket_id, float(price))
+        return 200, self.ticket_json(ticket_id, self.system.tickets[ticket_id])
+
+    # GET /admin/sales/<dimension>: running totals per ticket, day, payment or age band
+    async def sales_report(self, request, dimension):
+        self.authorize_admin(request)
+        if dimension not in SalesTotals.DIMENSIONS:
+            raise HTTPError(404, "Unknown sales report")
+        report = await self.call(self.reports.sales_report, dimension)
+        return 200, [
+            {"key": key, "units": units, "revenue": revenue_cents / 100, "discounts": discount_cents / 100, "orders": orders}
+            for key, (units, revenue_cents, discount_cents, orders) in sorted(report.items())
+        ]
+
+    # GET /admin/attendance?from=YYYY-MM-DD&days=: seats sold per ticket and distinct visitors per visit date
+    async def attendance(self, request):
+        self.authorize_admin(request)
+        days = request.query.get("days", "30")
+        if not days.isdigit() or not 0 < int(days) <= 3660:
+            raise HTTPError(400, "days must be between 1 and 3660")
+        report = await self.call(self.reports.attendance, request.query.get("from"), int(days))
+        return 200, [
+            {"date": visit_date, "tickets": {str(ticket_id): seats for ticket_id, seats in tickets.items()}, "seats": sum(tickets.values()), "visitors": visitors}
+            for visit_date, tickets, visitors in report
+        ]
+
+    # GET /admin/visitors/<YYYY-MM-DD>?offset=&limit=
+    async def visitors_on(self, request, visit_date):
+        self.authorize_admin(request)
+        query = request.query
+        offset, limit = query.get("offset", "0"), query.get("limit", "50")
+        if not offset.isdigit() or not limit.isdigit():
+            raise HTTPError(400, "offset and limit must be non-negative integers")
+        usernames, total = await self.call(self.reports.visitors_on, visit_date, int(offset), min(int(limit), 1000))
+        return 200, {"date": visit_date, "users": usernames, "total": total}
+
+    # GET /admin/replication: the primary's change sequence number and each read replica's progress and lag
+    async def replication_status(self, request):
+        self.authorize_admin(request)
+        if self.replicas is None:
+            raise HTTPError(404, "No read replicas; start the service with BOOKING_REPLICAS set")
+        return 200, await self.call(self.replicas.status)
+
+    # GET /admin/metrics: every metric in the Prometheus text format, when metrics are enabled
+    async def metrics(self, request):
+        self.authorize_admin(request)
+        if not metrics.enabled():
+            raise HTTPError(404, "Metrics are disabled; start the service with BOOKING_METRICS=1")
+        return 200, metrics.REGISTRY.render()
+
+    # GET /admin/profile[?top=N]: sampled stacks in the collapsed flame graph format, or the N hottest functions
+    async def profile(self, request):
+        self.authorize_admin(request)
+        top = request.query.get("top")
+        if top is None:
+            return 200, metrics.PROFILER.collapsed()
+        if not top.isdigit():
+            raise HTTPError(400, "top must be a non-negative integer")
+        return 200, [{"function": function, "samples": count} for function, count in metrics.PROFILER.top(int(top))]
+
+    # POST /admin/profile {enabled, clear}: start or stop the sampling profiler
+    async def toggle_profiler(self, request):
+        self.authorize_admin(request)
+        data = request.json()
+        if not isinstance(data.get("enabled"), bool):
+            raise HTTPError(400, "enabled must be true or false")
+        if data.get("clear"):
+            metrics.PROFILER.clear()
+        await self.call(metrics.PROFILER.start if data["enabled"] else metrics.PROFILER.stop)
+        return 200, {"enabled": metrics.PROFILER.running}
+
+    # Accept connections until cancelled
+    async def serve(self, host="127.0.0.1", port=8080, ready=None):
+        server = await asyncio.start_server(self.handle_connection, host, port, limit=self.MAX_LINE, backlog=1024)
+        if ready is not None:
+            ready(server)
+        async with server:
+            await server.serve_forever()
+
+    # Stop the worker threads
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+# Run the service until interrupted, then flush the system to storage
+def run_service(system, host="127.0.0.1", port=8080, admin_token=None, waiting_room=None, replicas=None):
+    service = BookingService(system, admin_token, waiting_room=waiting_room, replicas=replicas)
+    try:
+        asyncio.run(service.serve(host, port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
+        if replicas is not None:
+            replicas.close()
+        system.close()
+
+# Start the service: python -m booking.service [--db booking.db | --shards N] [host:port]
+# Set BOOKING_PURCHASE_RATE=rate[,per-user rate] (purchases per second) to put purchases behind a waiting room, and
+# BOOKING_REPLICAS=N to answer the admin reports and searches from N read replica processes
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    storage = None  # Use the pickle files unless a database is given
+    shards = None  # Run in this process unless a shard count is given
+    if len(args) >= 2 and args[0] == "--db":
+        storage = SQLiteStorage(args[1])
+        args = args[2:]
+    elif len(args) >= 2 and args[0] == "--shards":
+        shards = int(args[1])
+        args = args[2:]
+    host, _, port = (args[0] if args else "127.0.0.1:8080").rpartition(":")
+    admin_token = os.environ.get("BOOKING_ADMIN_TOKEN")  # Admin routes are disabled unless this is set
+    metrics.enable_from_environment()  # Opt-in instrumentation, read through GET /admin/metrics
+    waiting_room = None  # Purchases go straight through unless a rate is given
+    if os.environ.get("BOOKING_PURCHASE_RATE"):
+        rates = [float(rate) for rate in os.environ["BOOKING_PURCHASE_RATE"].split(",")]
+        try:
+            waiting_room = WaitingRoom(rates[0], user_rate=rates[1] if len(rates) > 1 else 1)
+        except ValueError as error:
+            sys.exit(f"BOOKING_PURCHASE_RATE: {error}")
+    replica_count = int(os.environ.get("BOOKING_REPLICAS") or 0)  # No read replicas unless a count is given
+    if shards and replica_count:
+        sys.exit("BOOKING_REPLICAS cannot be combined with --shards; each shard already answers reads for its own users")
+    replicas = None
+    if shards:
+        from booking.sharding import ShardedBookingSystem
+        system = ShardedBookingSystem(shards)
+    else:
+        system = TicketBookingSystem(storage=storage)
+        if replica_count:
+            from booking.replication import ReadReplicas
+            replicas = ReadReplicas(system, replica_count)
+    print(f"Serving on {host or '127.0.0.1'}:{port}")
+    run_service(system, host or "127.0.0.1", int(port), admin_token, waiting_room, replicas)
@@ -0,0 +1,515 @@
+# Sharded deployment of the ticket booking system: users are split by username hash across worker processes
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+import heapq
+import itertools
+from collections.abc import Mapping
+from multiprocessing import shared_memory
+
+from booking.core import TicketBookingSystem, MappedStorage, Inventory, Reservation, PricingEngine, SessionCache, DuplicateEmailError
+from booking.core import username_hash, default_tickets, checked_visit_ordinal, normalize_email
+
+# Shard that owns a username
+def shard_of(username, shard_count):
+    return username_hash(username) % shard_count
+
+# Users file of one shard, e.g. users.pkl -> users.shard2.pkl
+def shard_file(users_file, index):
+    root, ext = os.path.splitext(users_file)
+    return f"{root}.shard{index}{ext}"
+
+# SharedCounters class definition: Seats taken per (ticket id, visit date), shared by every shard through shared memory,
+# with the holds on those seats so that any shard can expire another shard's lapsed holds
+class SharedCounters:
+    HEADER = 2  # Cells before the counters: number of counter slots, hold entries per lock stripe
+    COUNTER = 3  # Cells per counter: key (0 if empty), seats taken (sold or held), earliest expiry of its holds (ns, 0 if none)
+    HOLD = 4  # Cells per hold entry: counter slot + 1 (0 if free), seats, expiry (time.monotonic_ns()), reservation token
+
+    def __init__(self, name=None, slots=4096, locks=None, holds=16384):
+        self.locks = locks or [multiprocessing.Lock() for _ in range(16)]  # Lock stripes; the first also guards inserts
+        # Table of 64-bit integers: the header, an open-addressed table of counters, then the hold entries of each lock stripe.
+        # Everything about one counter, its holds included, is guarded by the counter's lock stripe.
+        if name is None:
+            stripe_holds = -(-holds // len(self.locks))
+            size = (self.HEADER + slots * self.COUNTER + stripe_holds * len(self.locks) * self.HOLD) * 8
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+            self.memory.buf[:] = bytes(len(self.memory.buf))
+            self.cells = self.memory.buf.cast("q")
+            self.cells[0], self.cells[1] = slots, stripe_holds
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            self.cells = self.memory.buf.cast("q")
+        self.slots, self.stripe_holds = self.cells[0], self.cells[1]
+        self.holds_start = self.HEADER + self.slots * self.COUNTER  # Cell of the first hold entry
+        self.tokens = itertools.count(1)  # Reservation tokens are unique per process; the pid tells processes apart
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    # First cell of a counter
+    def counter(self, idx):
+        return self.HEADER + idx * self.COUNTER
+
+    # Table slot of a ticket and date, added if create is set; None if absent
+    def find(self, ticket_id, visit_ordinal, create=True):
+        key = (ticket_id << 32 | visit_ordinal) + 1
+        idx = self.probe(key)
+        if self.cells[self.counter(idx)] == key:
+            return idx
+        if not create:
+            return None
+        with self.locks[0]:  # Another shard may be adding a key at the same time
+            idx = self.probe(key)
+            if self.cells[self.counter(idx)] != key:
+                self.cells[self.counter(idx)] = key
+        return idx
+
+    # Slot holding a key, or the empty slot where it would be added
+    def probe(self, key):
+        idx = key % self.slots
+        for _ in range(self.slots):
+            if self.cells[self.counter(idx)] in (key, 0):
+                return idx
+            idx = (idx + 1) % self.slots
+        raise RuntimeError("Shared seat counter table is full")
+
+    # First cells of the hold entries in a counter's lock stripe
+    def stripe_entries(self, idx):
+        first = self.holds_start + idx % len(self.locks) * self.stripe_holds * self.HOLD
+        return range(first, first + self.stripe_holds * self.HOLD, self.HOLD)
+
+    # A free hold entry in a counter's lock stripe, searched from a point picked by the token so holds spread out
+    # (caller holds the counter's lock stripe)
+    def free_entry(self, idx, token):
+        entries = self.stripe_entries(idx)
+        start = token % len(entries)
+        for i in range(len(entries)):
+            entry = entries[(start + i) % len(entries)]
+            if not self.cells[entry]:
+                return entry
+        raise RuntimeError("Shared seat hold table is full")
+
+    # Release the counter's holds that ran out, whichever shard placed them (caller holds the counter's lock stripe)
+    def expire(self, idx, now):
+        cell = self.counter(idx)
+        due = self.cells[cell + 2]
+        if not due or due > now:
+            return
+        next_due = 0
+        for entry in self.stripe_entries(idx):
+            if self.cells[entry] == idx + 1:
+                expires = self.cells[entry + 2]
+                if expires <= now:
+                    self.cells[cell + 1] -= self.cells[entry + 1]
+                    self.cells[entry] = 0
+                elif not next_due or expires < next_due:
+                    next_due = expires
+        self.cells[cell + 2] = next_due
+
+    # Seats taken for a ticket and date
+    def taken(self, ticket_id, visit_ordinal):
+        idx = self.find(ticket_id, visit_ordinal, create=False)
+        if idx is None:
+            return 0
+        cell = self.counter(idx)
+        now = time.monotonic_ns()
+        if 0 < self.cells[cell + 2] <= now:  # Some hold ran out; only then is the lock needed
+            with self.locks[idx % len(self.locks)]:
+                self.expire(idx, now)
+        return self.cells[cell + 1]
+
+    # Hold quantity seats until expires (a time.monotonic() value) if they fit within capacity;
+    # returns the hold as (entry, token), or None if the seats are not there
+    def hold(self, ticket_id, visit_ordinal, quantity, capacity, expires):
+        idx = self.find(ticket_id, visit_ordinal)
+        cell = self.counter(idx)
+        expires = int(expires * 1e9)
+        with self.locks[idx % len(self.locks)]:
+            self.expire(idx, time.monotonic_ns())
+            if self.cells[cell + 1] + quantity > capacity:
+                return None
+            token = os.getpid() << 32 | next(self.tokens) & 0xFFFFFFFF
+            entry = self.free_entry(idx, token)
+            self.cells[entry + 1], self.cells[entry + 2], self.cells[entry + 3] = quantity, expires, token
+            self.cells[entry] = idx + 1
+            self.cells[cell + 1] += quantity
+            if not self.cells[cell + 2] or expires < self.cells[cell + 2]:
+                self.cells[cell + 2] = expires
+        return entry, token
+
+    # Drop a hold that has not run out, giving its seats back unless sold is set; returns False if it already expired
+    def end_hold(self, ticket_id, visit_ordinal, hold, sold):
+        entry, token = hold
+        idx = self.find(ticket_id, visit_ordinal)
+        with self.locks[idx % len(self.locks)]:
+            self.expire(idx, time.monotonic_ns())
+            if self.cells[entry] != idx + 1 or self.cells[entry + 3] != token:
+                return False
+            self.cells[entry] = 0
+            if not sold:
+                self.cells[self.counter(idx) + 1] -= self.cells[entry + 1]
+        return True
+
+    # Add to (or, with a negative quantity, take from) the seats taken
+    def add(self, ticket_id, visit_ordinal, quantity):
+        idx = self.find(ticket_id, visit_ordinal)
+        with self.locks[idx % len(self.locks)]:
+            self.cells[self.counter(idx) + 1] += quantity
+
+    # Detach from the shared memory, and free it if this process created it
+    def close(self, unlink=False):
+        self.cells.release()
+        self.memory.close()
+        if unlink:
+            self.memory.unlink()
+
+# SharedInventory class definition: Inventory whose limited tickets are counted, and held, across every shard.
+# Holds on limited tickets live in the shared counters, so a hold that runs out frees its seats for every shard
+# as soon as any of them looks at that ticket and date.
+class SharedInventory(Inventory):
+    def __init__(self, tickets, sold_counts, counters, hold_seconds=300):
+        super().__init__(tickets, sold_counts, hold_seconds)
+        self.counters = counters  # Seats sold or held by every shard
+        for (ticket_id, visit_ordinal), sold in (sold_counts or {}).items():
+            if ticket_id < len(tickets) and tickets[ticket_id].capacity is not None:
+                counters.add(ticket_id, visit_ordinal, sold)  # This shard's share of the seats sold
+
+    def seats_taken(self, slot, ticket_id, visit_ordinal):
+        return self.counters.taken(ticket_id, visit_ordinal)
+
+    # Limited tickets are held in the shared counters; the reservation id is the shared hold
+    def reserve(self, ticket_id, visit_ordinal, quantity, hold_seconds=None):
+        capacity = self.tickets[ticket_id].capacity
+        if capacity is None:
+            return super().reserve(ticket_id, visit_ordinal, quantity, hold_seconds)
+        expires = time.monotonic() + (hold_seconds or self.hold_seconds)
+        hold = self.counters.hold(ticket_id, visit_ordinal, quantity, capacity, expires)
+        if hold is None:
+            return None
+        return Reservation(hold, ticket_id, visit_ordinal, quantity, expires)
+
+    def confirm(self, reservation):
+        if self.tickets[reservation.ticket_id].capacity is None:
+            return super().confirm(reservation)
+        if not self.counters.end_hold(reservation.ticket_id, reservation.visit_ordinal, reservation.id, sold=True):
+            return False
+        slot = self.slot(reservation.ticket_id, reservation.visit_ordinal)
+        with slot.lock:
+            slot.sold += reservation.quantity  # This shard's share, for its attendance and sold counts
+        return True
+
+    def release(self, reservation):
+        if self.tickets[reservation.ticket_id].capacity is None:
+            return super().release(reservation)
+        self.counters.end_hold(reservation.ticket_id, reservation.visit_ordinal, reservation.id, sold=False)
+
+    def add_sold(self, ticket_id, visit_ordinal, quantity):
+        super().add_sold(ticket_id, visit_ordinal, quantity)
+        if self.tickets[ticket_id].capacity is not None:
+            self.counters.add(ticket_id, visit_ordinal, quantity)
+
+# ShardSystem class definition: The booking system run by one shard process
+class ShardSystem(TicketBookingSystem):
+    def __init__(self, counters, users_file, tickets_file, compact_every=1000, pricing_rules=None):
+        self.counters = counters  # Needed by create_inventory, which the base class calls
+        # Shard processes are daemons, which cannot start a hashing pool; the shards already spread the hashing over cores
+        super().__init__(users_file, tickets_file, compact_every, pricing_rules=pricing_rules, kdf_workers=0)
+
+    def create_inventory(self, sold_counts):
+        return SharedInventory(self.tickets, sold_counts, self.counters)
+
+    # Calls made by the router that have no equivalent on TicketBookingSystem
+    def get_user(self, username):
+        return self.users.get(username)
+
+    def has_user(self, username):
+        return username in self.users
+
+    def usernames(self):
+        return list(self.users.keys())
+
+    def user_count(self):
+        return len(self.users)
+
+    def sold_counts(self):
+        return [ticket.sold_count for ticket in self.tickets]
+
+    def email_taken(self, email, username=None):
+        return self.index.email_taken(email, username)
+
+    # Rebuild this shard's sales totals; they stay in the shard, as they hold a lock and cannot be sent to the router
+    def rebuild_sales(self):
+        super().rebuild_sales()
+
+    # Change a ticket's price in this shard, saving the tickets only if asked to
+    def set_ticket_price(self, ticket_choice, price, save):
+        if save:
+            self.update_ticket_price(ticket_choice, price)
+        else:
+            with self.ticket_locks[ticket_choice]:
+                self.tickets[ticket_choice].price = price
+
+# Serve calls from the router until it disconnects (runs in the shard process)
+def run_shard(index, users_file, tickets_file, counters_name, locks, connection, compact_every, pricing_rules):
+    counters = SharedCounters(counters_name, locks=locks)
+    system = ShardSystem(counters, shard_file(users_file, index), tickets_file, compact_every, pricing_rules)
+    connection.send((True, None))  # Ready
+    method = None
+    while True:
+        try:
+            method, args = connection.recv()
+        except EOFError:
+            method = None  # The router went away without closing the shard
+            break
+        if method is None:
+            break
+        try:
+            result = (True, getattr(system, method)(*args))
+        except Exception as error:
+            result = (False, error)
+        connection.send(result)
+    system.close()
+    counters.close()
+    if method is None and not connection.closed:
+        try:
+            connection.send((True, None))  # Closed
+        except OSError:
+            pass
+
+# Whether users were saved under a users file name, as a pickle or as the data file that replaces it
+def users_saved(users_file):
+    return os.path.exists(users_file) or os.path.exists(os.path.splitext(users_file)[0] + ".dat")
+
+# Split the users of an unsharded deployment into one user data file per shard
+def partition_users(shard_count, users_file="users.pkl", tickets_file="tickets.pkl"):
+    source = MappedStorage(users_file, tickets_file)
+    users = source.load_users()
+    shards = [{} for _ in range(shard_count)]
+    for user in source.iter_users(users):
+        shards[shard_of(user.username, shard_count)][user.username] = user
+    for index, shard_users in enumerate(shards):
+        target = MappedStorage(shard_file(users_file, index), tickets_file)
+        target.save_users(shard_users)
+        target.close()
+    source.close()
+
+# ShardedUsers class definition: Read-only view of the users of every shard
+class ShardedUsers(Mapping):
+    def __init__(self, router):
+        self.router = router
+
+    def __getitem__(self, username):
+        user = self.router.call(self.router.shard_for(username), "get_user", username)
+        if user is None:
+            raise KeyError(username)
+        return user
+
+    def __contains__(self, username):
+        return self.router.call(self.router.shard_for(username), "has_user", username)
+
+    def __iter__(self):
+        for index in range(len(self.router.connections)):
+            yield from self.router.call(index, "usernames")
+
+    def __len__(self):
+        return sum(self.router.broadcast("user_count"))
+
+# ShardedBookingSystem class definition: Routes each call to the shard process that owns the user
+class ShardedBookingSystem:
+    def __init__(self, shard_count=None, users_file="users.pkl", tickets_file="tickets.pkl", compact_every=1000, pricing_rules=None, counter_slots=4096):
+        shard_count = shard_count or os.cpu_count() or 1
+        if users_saved(users_file) and not any(users_saved(shard_file(users_file, index)) for index in range(shard_count)):
+            partition_users(shard_count, users_file, tickets_file)  # First start after running unsharded
+        self.counters = SharedCounters(slots=counter_slots)  # Seats taken of limited tickets, shared by the shards
+        self.connections = []  # Pipe to each shard
+        self.locks = []  # One call at a time per pipe
+        self.processes = []
+        for index in range(shard_count):
+            connection, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_shard, name=f"shard-{index}", daemon=True,
+                args=(index, users_file, tickets_file, self.counters.name, self.counters.locks, child, compact_every, pricing_rules),
+            )
+            process.start()
+            self.connections.append(connection)
+            self.locks.append(threading.Lock())
+            self.processes.append(process)
+        for connection in self.connections:
+            connection.recv()  # Wait until every shard has loaded its users
+        self.users = ShardedUsers(self)  # Read-only view of every shard's users
+        self.tickets = self.call(0, "load_tickets") or default_tickets()  # Router copy, for quotes and listings
+        self.pricing = PricingEngine(self.tickets, pricing_rules)
+        self.sold_lock = threading.Lock()  # Guards the router's sold counts
+        self.sessions = SessionCache()  # Sessions opened through the router
+        atexit.register(self.close)
+        self.email_locks = [threading.Lock() for _ in range(64)]  # Registrations of one email go through one lock
+        for ticket, sold in zip(self.tickets, map(sum, zip(*self.broadcast("sold_counts")))):
+            ticket.sold_count = sold
+
+    # Shard that owns a username
+    def shard_for(self, username):
+        return shard_of(username, len(self.connections))
+
+    # Call a method of the system in one shard and return its result
+    def call(self, index, method, *args):
+        with self.locks[index]:
+            self.connections[index].send((method, args))
+            ok, result = self.connections[index].recv()
+        if not ok:
+            raise result
+        return result
+
+    # Call a method in every shard and return the results in shard order
+    def broadcast(self, method, *args):
+        return [self.call(index, method, *args) for index in range(len(self.connections))]
+
+    # Each shard only indexes its own users, so emails are checked in every shard under a per-email lock
+    def register_user(self, username, password, email, phone_number, dob):
+        with self.email_lock(email):
+            if any(self.broadcast("email_taken", email)):
+                raise DuplicateEmailError("Email is already registered!")
+            return self.call(self.shard_for(username), "register_user", username, password, email, phone_number, dob)
+
+    # Lock serialising changes that give a user this email
+    def email_lock(self, email):
+        return self.email_locks[hash(normalize_email(email)) % len(self.email_locks)]
+
+    def login_user(self, username, password):
+        return self.call(self.shard_for(username), "login_user", username, password)
+
+    def modify_user_details(self, username, email=None, phone_number=None, dob=None):
+        if not email:
+            return self.call(self.shard_for(username), "modify_user_details", username, email, phone_number, dob)
+        with self.email_lock(email):
+            if any(self.broadcast("email_taken", email, username)):
+                raise DuplicateEmailError("Email is already registered!")
+            return self.call(self.shard_for(username), "modify_user_details", username, email, phone_number, dob)
+
+    # Search every shard and merge the pages; returns (page of usernames, number of matches)
+    def search_users(self, prefix="", email=None, phone_number=None, offset=0, limit=50):
+        pages = self.broadcast("search_users", prefix, email, phone_number, 0, offset + limit)
+        merged = heapq.merge(*(usernames for usernames, _ in pages))
+        return list(itertools.islice(merged, offset, offset + limit)), sum(total for _, total in pages)
+
+    def delete_user(self, username):
+        deleted = self.call(self.shard_for(username), "delete_user", username)
+        self.sessions.close_user(username)
+        return deleted
+
+    # The shard checks the password; the session lives in the router so later calls need no shard
+    def open_session(self, username, password):
+        if self.login_user(username, password) is None:
+            return None
+        return self.sessions.open(username)
+
+    def session_user(self, token):
+        return self.sessions.user(token)
+
+    def close_session(self, token):
+        self.sessions.close(token)
+
+    # Quotes need no user, so the router prices them itself
+    def quote_ticket(self, ticket_choice, num_persons=None, visit_date=None):
+        return self.pricing.quote(ticket_choice, num_persons, visit_ordinal=checked_visit_ordinal(visit_date))
+
+    def purchase_ticket(self, username, ticket_choice, num_persons=None, visit_date=None, payment_method=None):
+        result = self.call(self.shard_for(username), "purchase_ticket", username, ticket_choice, num_persons, visit_date, payment_method)
+        self.count_sold(ticket_choice, num_persons)
+        return result
+
+    # Keep the router's sold count in step with a purchase a shard has made
+    def count_sold(self, ticket_choice, num_persons):
+        quantity = self.pricing.quote(ticket_choice, num_persons)[0]
+        with self.sold_lock:
+            self.tickets[ticket_choice].sold_count += quantity
+
+    # Purchase many tickets, one batch per shard. Each shard's batch is applied completely or not at all,
+    # but a batch that fails does not undo the batches of shards that already succeeded.
+    def purchase_many(self, orders):
+        batches = {}  # Shard -> [(position, order)]
+        for position, order in enumerate(orders):
+            batches.setdefault(self.shard_for(order[0]), []).append((position, order))
+        results = [None] * len(orders)
+        for index, batch in sorted(batches.items()):
+            for (position, order), result in zip(batch, self.call(index, "purchase_many", [order for _, order in batch])):
+                results[position] = result
+                self.count_sold(*(*order[1:3], None)[:2])
+        return results
+
+    # Change a ticket's price in every shard; the first shard saves the tickets
+    def update_ticket_price(self, ticket_choice, price):
+        if price <= 0:
+            raise ValueError("Price must be positive!")
+        for index in range(len(self.connections)):
+            self.call(index, "set_ticket_price", ticket_choice, price, index == 0)
+        self.tickets[ticket_choice].price = price
+
+    # Sales totals summed over every shard
+    def sales_report(self, dimension):
+        totals = {}
+        for report in self.broadcast("sales_report", dimension):
+            for key, amounts in report.items():
+                totals[key] = tuple(map(sum, zip(totals.get(key, (0, 0, 0, 0)), amounts)))
+        return totals
+
+    # Rebuild the sales totals in every shard, then pick up the sold counts, which may have grown to match them
+    def rebuild_sales(self):
+        self.broadcast("rebuild_sales")
+        with self.sold_lock:
+            for ticket, sold in zip(self.tickets, map(sum, zip(*self.broadcast("sold_counts")))):
+                ticket.sold_count = sold
+
+    # Attendance summed over every shard; each user lives in one shard, so visitor counts add up too
+    def attendance(self, first_date=None, days=30):
+        merged = {}  # Visit date -> (seats per ticket, visitors)
+        for report in self.broadcast("attendance", first_date, days):
+            for visit_date, seats, visitors in report:
+                day_seats, day_visitors = merged.get(visit_date, ({}, 0))
+                for ticket_id, sold in seats.items():
+                    day_seats[ticket_id] = day_seats.get(ticket_id, 0) + sold
+                merged[visit_date] = (day_seats, day_visitors + visitors)
+        return [(visit_date, seats, visitors) for visit_date, (seats, visitors) in sorted(merged.items())]
+
+    # Visitors of one shard after another; returns (page of usernames, number of visitors)
+    def visitors_on(self, visit_date, offset=0, limit=50):
+        totals = self.broadcast("visitor_count", visit_date)
+        page = []
+        for index, total in enumerate(totals):
+            if offset < total and len(page) < limit:
+                page.extend(self.call(index, "visitors_on", visit_date, offset, limit - len(page))[0])
+            offset = max(offset - total, 0)
+        return page, sum(totals)
+
+    def visitor_count(self, visit_date):
+        return sum(self.broadcast("visitor_count", visit_date))
+
+    # Seats left from the shared counters, without a round trip to a shard
+    def seats_left(self, ticket_choice, visit_date=None):
+        capacity = self.tickets[ticket_choice].capacity
+        if capacity is None:
+            return None
+        return max(capacity - self.counters.taken(ticket_choice, checked_visit_ordinal(visit_date)), 0)
+
+    def save_users(self):
+        self.broadcast("save_users")
+
+    def flush(self):
+        self.broadcast("flush")
+
+    # Stop every shard, flushing its changes, and free the shared counters
+    def close(self):
+        if not self.processes:
+            return
+        for index, connection in enumerate(self.connections):
+            with self.locks[index]:
+                connection.send((None, ()))
+                connection.recv()
+        for process in self.processes:
+            process.join()
+        self.processes = []
+        self.counters.close(unlink=True)
+        atexit.unregister(self.close)
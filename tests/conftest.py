@@ -0,0 +1,42 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))  # The booking package, from a checkout
+
+from booking.core import TicketBookingSystem
+
+# Open ticket booking systems on files in the test's temporary directory; they are closed after the test
+@pytest.fixture
+def open_system(tmp_path):
+    systems = []
+
+    def open_system(**kwargs):
+        kwargs.setdefault("kdf_workers", 0)  # Hash passwords on the calling thread, without a process pool
+        system = TicketBookingSystem(str(tmp_path / "users.pkl"), str(tmp_path / "tickets.pkl"), **kwargs)
+        systems.append(system)
+        return system
+
+    yield open_system
+    for system in systems:
+        system.close()
+
+# Add users u0..u(count - 1), all with the password "secret"
+def add_users(system, count):
+    password_hash = system.hasher.hash("secret")  # Hashed once; scrypt is slow on purpose
+    rejected = system.import_users([(f"u{i}", password_hash, f"u{i}@example.com", f"55500{i:05d}", "1990-01-01") for i in range(count)])
+    assert rejected == []
+
+# Everything a copy of the system must agree on: users, seats sold, ticket sold counts and sales totals
+def system_state(system):
+    system.flush()
+    return {
+        "users": {
+            username: (user.password, user.email, user.phone_number, user.dob, bytes(user.purchase_history.data))
+            for username, user in ((username, system.users[username]) for username in sorted(system.users))
+        },
+        "seats": {key: slot.sold for key, slot in system.inventory.slots.items() if slot.sold},
+        "sold_counts": [ticket.sold_count for ticket in system.tickets],
+        "sales": system.sales.state(),
+    }
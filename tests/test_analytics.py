@@ -0,0 +1,46 @@
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from booking.core import UNKNOWN_TICKET, Purchase
+from conftest import add_users
+
+np = pytest.importorskip("numpy")
+from booking import analytics  # noqa: E402  (needs NumPy)
+
+# A system with purchases on a few dates, one undated, and one legacy record of a ticket no longer in the catalog
+@pytest.fixture
+def system(open_system):
+    system = open_system()
+    add_users(system, 4)
+    for i in range(12):
+        system.purchase_ticket(f"u{i % 4}", i % 3, None, f"2030-07-0{i % 4 + 1}", "card")  # Monday 1 July to Thursday 4 July
+    system.purchase_ticket("u0", 4, 12, "2030-07-08")  # The next Monday
+    system.purchase_ticket("u1", 0)
+    system.users["u2"].add_purchase(*Purchase(UNKNOWN_TICKET, 2, 5000, 0, 741259, 0))  # As converted from a text record
+    return system
+
+def test_sales_by_ticket_keeps_unknown_tickets_apart(system):
+    sales = analytics.sales_by_ticket(analytics.load_purchases(system), len(system.tickets))
+    assert sales["units"].tolist() == [5, 4, 4, 0, 12, 0, 2]
+    report = system.sales_report("ticket")
+    assert sales["revenue"][:4].tolist() == pytest.approx([report[ticket_id][1] / 100 for ticket_id in range(3)] + [0])
+
+def test_week_and_ticket_day_breakdowns(system):
+    weeks = list(analytics.breakdown_rows(system, "week"))
+    assert [(label, units, orders) for label, _, units, _, _, orders in weeks] == [("Week of 2030-07-01", 14, 13), ("Week of 2030-07-08", 12, 1)]
+    cells = {label: (units, revenue) for label, _, units, revenue, _, _ in analytics.breakdown_rows(system, "ticket-day")}
+    assert cells["2030-07-01 Single Day Pass"] == (1, 275.0)
+    assert cells["2030-07-01 Unknown ticket"] == (2, 50.0)
+    assert cells["2030-07-08 Group Ticket (10+)"] == (12, 2112.0)
+    assert sum(units for units, _ in cells.values()) == 26  # The undated purchase is left out
+
+def test_admin_view_breakdowns_fall_back_to_daily_totals_without_numpy(system, monkeypatch):
+    from Python_Code import AdminWindow
+    admin = SimpleNamespace(system=system, reports=system)
+    lines = AdminWindow.sales_breakdowns(admin)
+    assert lines[0] == "Week of 2030-07-01 - 14 tickets, $9,134.00 (discounts $1,296.00)"
+    monkeypatch.setitem(sys.modules, "booking.analytics", None)  # As if NumPy were missing
+    monkeypatch.delattr("booking.analytics")
+    assert AdminWindow.sales_breakdowns(admin)[0] == "2030-07-01 - 3 tickets, $2,271.00"
@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+from booking import bulk
+from booking.core import TicketBookingSystem, is_password_hash
+from conftest import add_users, system_state
+
+def write_lines(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+def test_csv_users_with_rejected_rows(tmp_path, open_system):
+    system = open_system()
+    add_users(system, 1)
+    path = write_lines(tmp_path / "users.csv", [
+        "username,password,email,phone_number,dob",
+        "ann,pw1,ann@example.com,5550000101,1990-01-01",
+        "bob,pw2,not-an-email,5550000102,1990-01-01",
+        "u0,pw3,zed@example.com,5550000103,1990-01-01",  # Username taken before the import
+        "cat,pw4,ANN@example.com,5550000104,1990-01-01",  # Email taken earlier in the same file
+        "dan,pw5,dan@example.com,5550000105",  # Short row
+        "eve,pw6,eve@example.com,5550000106,1991-02-03",
+    ])
+    result = bulk.import_users(system, path)
+    assert result.records == 6 and result.imported == 2 and result.rejected == 4
+    assert result.errors == [
+        (3, "Invalid email format!"),
+        (4, "Username already exists!"),
+        (5, "Email is already registered!"),
+        (6, "All fields are required!"),
+    ]
+    assert sorted(system.users) == ["ann", "eve", "u0"]
+    assert system.search_users(email="eve@example.com") == (["eve"], 1)
+
+def test_unreadable_json_lines_are_rejected_without_stopping_the_import(tmp_path, open_system, monkeypatch):
+    monkeypatch.setattr(bulk, "CHUNK_SIZE", 2)  # Bad lines after earlier chunks were applied
+    system = open_system()
+    user = {"password": "pw", "phone_number": "5550000101", "dob": "1990-01-01"}
+    path = write_lines(tmp_path / "users.jsonl", [
+        json.dumps({**user, "username": "ann", "email": "ann@example.com"}),
+        json.dumps({**user, "username": "bob", "email": "bob@example.com"}),
+        '{"username": "cat", ',
+        "[1, 2]",
+        '"x"',
+        "",
+        json.dumps({**user, "username": "dan", "email": "dan@example.com", "extra": 1}),
+        "7",
+    ])
+    result = bulk.import_users(system, path)
+    assert (result.records, result.imported, result.rejected) == (7, 3, 4)
+    assert result.errors == [(line, "Each line must be a JSON object") for line in (3, 4, 5, 8)]
+    assert sorted(system.users) == ["ann", "bob", "dan"]
+
+def test_plain_text_passwords_are_kept_until_first_login(tmp_path, open_system):
+    system = open_system()
+    path = write_lines(tmp_path / "users.csv", ["username,password,email,phone_number,dob", "ann,pw1,ann@example.com,5550000101,1990-01-01"])
+    bulk.import_users(system, path)
+    assert system.users["ann"].password == "pw1"  # Not hashed on the way in
+    assert system.login_user("ann", "wrong") is None
+    assert system.login_user("ann", "pw1") is not None
+    assert is_password_hash(system.users["ann"].password)
+
+@pytest.mark.parametrize("extension", ["csv", "jsonl"])
+def test_export_and_import_round_trip(tmp_path, open_system, extension):
+    system = open_system()
+    add_users(system, 5)
+    for i in range(10):
+        system.purchase_ticket(f"u{i % 5}", i % 6, 11, f"2030-07-0{i % 3 + 1}", "card")
+    before = system_state(system)
+    for kind in ("users", "purchases"):
+        assert bulk.EXPORTERS[kind](system, str(tmp_path / f"{kind}.{extension}")) == (5 if kind == "users" else 10)
+    target = TicketBookingSystem(str(tmp_path / "copy.pkl"), str(tmp_path / "copy_tickets.pkl"), kdf_workers=0)
+    try:
+        for kind in ("users", "purchases"):
+            result = bulk.IMPORTERS[kind](target, str(tmp_path / f"{kind}.{extension}"))
+            assert result.rejected == 0
+        after = system_state(target)
+        assert after["users"] == before["users"]
+        assert after["seats"] == before["seats"] and after["sales"] == before["sales"]
+    finally:
+        target.close()
@@ -0,0 +1,43 @@
+import pytest
+
+from conftest import add_users
+
+@pytest.fixture
+def system(open_system):
+    system = open_system()
+    add_users(system, 20)
+    for i in range(20):
+        system.purchase_ticket(f"u{i}", 0, None, "2030-07-01")
+        if i % 2:
+            system.purchase_ticket(f"u{i}", 5, None, "2030-07-01")  # A second ticket on the same day
+        if i % 4 == 0:
+            system.purchase_ticket(f"u{i}", 4, 12, "2030-07-03")
+    system.purchase_ticket("u0", 1)  # Undated
+    return system
+
+def test_attendance_counts_seats_and_distinct_visitors(system):
+    assert system.attendance("2030-06-30", days=7) == [
+        ("2030-07-01", {0: 20, 5: 10}, 20),
+        ("2030-07-03", {4: 60}, 5),
+    ]
+    assert system.attendance("2030-07-02", days=1) == []
+
+def test_visitors_on_a_date_are_paged_in_first_seen_order(system):
+    assert system.visitors_on("2030-07-03") == (["u0", "u4", "u8", "u12", "u16"], 5)
+    page, total = system.visitors_on("2030-07-01", offset=5, limit=4)
+    assert (page, total) == (["u5", "u6", "u7", "u8"], 20)
+    assert system.visitor_count("2030-07-02") == 0
+    with pytest.raises(ValueError):
+        system.visitors_on("")
+
+def test_deleted_users_are_no_longer_visitors_but_their_seats_stay_sold(system):
+    system.delete_user("u4")
+    assert system.visitors_on("2030-07-03") == (["u0", "u8", "u12", "u16"], 4)
+    assert system.attendance("2030-07-03", days=1) == [("2030-07-03", {4: 60}, 4)]
+
+def test_calendar_is_rebuilt_from_saved_histories(system, open_system):
+    system.purchase_many([("u1", 0, None, "2030-07-03"), ("u2", 0, None, "2030-07-03")])
+    before = system.attendance("2030-07-01", days=3), system.visitors_on("2030-07-03")
+    system.close()
+    system = open_system()
+    assert (system.attendance("2030-07-01", days=3), system.visitors_on("2030-07-03")) == before
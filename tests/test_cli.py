@@ -0,0 +1,51 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from booking.cli import main
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run the command line in the test's temporary directory, where it keeps its data files; returns (status, stdout, stderr)
+@pytest.fixture
+def run(tmp_path, monkeypatch, capsys):
+    monkeypatch.chdir(tmp_path)
+
+    def run(*argv, stdin=""):
+        monkeypatch.setattr(sys, "stdin", io.StringIO(stdin))
+        status = main(list(argv))
+        out, err = capsys.readouterr()
+        return status, out, err
+
+    return run
+
+def test_register_purchase_and_report(run):
+    assert run("register", "ann", "ann@example.com", "5550000101", "1990-01-01", "--password-stdin", stdin="pw\n") == (0, "Registered ann\n", "")
+    status, out, _ = run("purchase", "ann", "4", "--persons", "11", "--date", "2030-07-01", "--payment", "card")
+    assert status == 0 and out.endswith("Total: $1936.00\n")
+    status, out, _ = run("report", "ticket", "--json")
+    assert status == 0 and json.loads(out) == [{"key": 4, "name": "Group Ticket (10+)", "units": 11, "revenue": 1936.0, "discounts": 484.0, "orders": 1}]
+    assert run("report", "attendance", "--from", "2030-07-01", "--days", "1")[1] == "2030-07-01 - 11 seats (Group Ticket (10+) 11), 1 visitors\n"
+
+def test_failures_exit_with_a_status(run):
+    assert run("register", "ann", "bad-email", "5550000101", "1990-01-01", "--password-stdin", stdin="pw\n")[:2] == (1, "")
+    status, _, err = run("purchase", "nobody", "0")
+    assert status == 1 and "User nobody not found" in err
+    status, _, err = run("purchase", "ann", "x")
+    assert status == 2 and "TICKET must be a whole number" in err
+    assert run("report", "nonsense")[0] == 2
+    assert run("--help")[0] == 0
+
+def test_core_commands_do_not_load_the_gui(tmp_path):
+    code = "import sys; from booking.cli import main; main(['report', 'tickets']); print(sorted({'tkinter', 'Python_Code', 'numpy'} & set(sys.modules)))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=tmp_path, env={**os.environ, "PYTHONPATH": ROOT}, capture_output=True, text=True, check=True)
+    assert result.stdout.splitlines()[0].startswith("0. Single Day Pass")
+    assert result.stdout.splitlines()[-1] == "[]"
+
+def test_python_m_booking_runs_the_command_line(tmp_path):
+    result = subprocess.run([sys.executable, "-m", "booking", "report", "tickets"], cwd=tmp_path, env={**os.environ, "PYTHONPATH": ROOT}, capture_output=True, text=True)
+    assert result.returncode == 0 and "VIP Experience Pass" in result.stdout
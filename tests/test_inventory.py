@@ -0,0 +1,64 @@
+import threading
+import time
+
+import pytest
+
+from booking.core import Inventory, SoldOutError, default_tickets
+from conftest import add_users
+
+VIP = 5  # The only default ticket with a capacity, 50 seats per visit date
+DAY = 741259
+
+def test_reserve_confirm_and_release():
+    inventory = Inventory(default_tickets())
+    held = inventory.reserve(VIP, DAY, 30)
+    assert inventory.available(VIP, DAY) == 20
+    assert inventory.reserve(VIP, DAY, 21) is None
+    assert inventory.reserve(VIP, DAY + 1, 50) is not None  # Each visit date has its own seats
+    assert inventory.confirm(held)
+    assert inventory.slots[(VIP, DAY)].sold == 30
+    other = inventory.reserve(VIP, DAY, 20)
+    inventory.release(other)
+    assert inventory.available(VIP, DAY) == 20
+    assert not inventory.confirm(other)  # Released seats cannot be bought
+
+def test_unlimited_tickets_never_run_out():
+    inventory = Inventory(default_tickets())
+    assert inventory.available(0, DAY) is None
+    assert inventory.reserve(0, DAY, 100000) is not None
+
+def test_expired_holds_are_released():
+    inventory = Inventory(default_tickets())
+    held = inventory.reserve(VIP, DAY, 50, hold_seconds=0.05)
+    assert inventory.available(VIP, DAY) == 0
+    time.sleep(0.1)
+    assert inventory.available(VIP, DAY) == 50
+    assert not inventory.confirm(held)
+    assert inventory.slots[(VIP, DAY)].sold == 0
+
+def test_purchase_with_an_expired_reservation_is_refused(open_system):
+    system = open_system()
+    add_users(system, 1)
+    reservation = system.reserve_tickets(VIP, "2030-07-01", 1, hold_seconds=0.05)
+    time.sleep(0.1)
+    with pytest.raises(SoldOutError, match="expired"):
+        system.purchase_ticket("u0", VIP, None, "2030-07-01", reservation=reservation)
+    assert system.seats_left(VIP, "2030-07-01") == 50
+    assert len(system.users["u0"].purchase_history) == 0
+
+def test_concurrent_reservations_never_exceed_capacity():
+    inventory = Inventory(default_tickets())
+    results = []
+    start = threading.Barrier(8)
+
+    def reserve():
+        start.wait()
+        results.extend(inventory.reserve(VIP, DAY, 1) for _ in range(20))
+
+    threads = [threading.Thread(target=reserve) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sum(result is not None for result in results) == 50
+    assert inventory.available(VIP, DAY) == 0
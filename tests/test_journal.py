@@ -0,0 +1,86 @@
+import os
+import pickle
+import subprocess
+import sys
+
+import pytest
+
+from booking.core import PickleStorage, PurchaseHistory, TicketBookingSystem
+from conftest import system_state
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Run in a child process: make changes of every kind, save the state they leave, then die without closing anything,
+# as a crash would. Only what the journal holds survives.
+CRASHING_CHILD = """
+import os, pickle, sys
+from booking.core import PickleStorage, TicketBookingSystem
+sys.path.insert(0, sys.argv[2])
+from conftest import add_users, system_state
+
+storage = PickleStorage("users.pkl", "tickets.pkl") if sys.argv[1] == "pickle" else None
+system = TicketBookingSystem("users.pkl", "tickets.pkl", storage=storage, kdf_workers=0)
+add_users(system, 6)
+for i in range(12):
+    system.purchase_ticket(f"u{i % 6}", i % 4, None, "2030-07-01", "card")
+system.purchase_ticket("u0", 5, None, "2030-07-03")
+system.purchase_ticket("u5", 5, None, "2030-07-03")
+system.purchase_ticket("u1", 4, 12, "2030-07-02", "paypal")
+system.purchase_many([("u2", 5, None, "2030-07-03"), ("u3", 0, 2, "2030-07-03", "cash")])
+system.modify_user_details("u4", email="new4@example.com")
+system.delete_user("u5")
+with open("expected.pkl", "wb") as file:
+    pickle.dump(system_state(system), file)
+os._exit(0)
+"""
+
+# Make changes in a child process that crashes after they are journaled, and return the state it saw
+def crash_after_changes(tmp_path, backend):
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    subprocess.run([sys.executable, "-c", CRASHING_CHILD, backend, os.path.join(ROOT, "tests")], cwd=tmp_path, env=env, check=True)
+    with open(tmp_path / "expected.pkl", "rb") as file:
+        return pickle.load(file)
+
+# Open the data left in tmp_path with the given storage backend
+def reopen(tmp_path, backend):
+    storage = PickleStorage(str(tmp_path / "users.pkl"), str(tmp_path / "tickets.pkl")) if backend == "pickle" else None
+    return TicketBookingSystem(str(tmp_path / "users.pkl"), str(tmp_path / "tickets.pkl"), storage=storage, kdf_workers=0)
+
+@pytest.mark.parametrize("backend", ["mapped", "pickle"])
+def test_replay_restores_changes_made_before_a_crash(tmp_path, backend):
+    expected = crash_after_changes(tmp_path, backend)
+    system = reopen(tmp_path, backend)
+    try:
+        assert system_state(system) == expected
+        assert "u5" not in system.users
+        assert system.users["u4"].email == "new4@example.com"
+        assert system.seats_left(5, "2030-07-03") == 50 - 3  # Two VIP passes bought singly and one in bulk
+    finally:
+        system.close()
+
+@pytest.mark.parametrize("backend", ["mapped", "pickle"])
+def test_replay_drops_a_torn_record(tmp_path, backend):
+    expected = crash_after_changes(tmp_path, backend)
+    journal = tmp_path / "users.journal"
+    record = pickle.dumps(("purchase", "u0", 0, 1, 27500, 0, 0, 1, "adult"))
+    with open(journal, "ab") as file:
+        file.write(record[:len(record) // 2])  # Cut off halfway through, as by a crash during the write
+    system = reopen(tmp_path, backend)
+    try:
+        assert system_state(system) == expected
+        system.purchase_ticket("u0", 0)  # Appended after the last complete record, not after the torn one
+    finally:
+        system.close()
+    system = reopen(tmp_path, backend)
+    try:
+        assert len(system.users["u0"].purchase_history) == len(PurchaseHistory(expected["users"]["u0"][4])) + 1
+    finally:
+        system.close()
+
+def test_replay_after_compaction_keeps_seats_and_sales(tmp_path, open_system):
+    expected = crash_after_changes(tmp_path, "mapped")
+    system = open_system()
+    system.compact()  # Writes a new snapshot and starts a journal carrying the seat counts and sales totals
+    system.close()
+    system = open_system()
+    assert system_state(system) == expected
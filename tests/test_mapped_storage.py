@@ -0,0 +1,43 @@
+import os
+import shutil
+
+from booking.core import MappedUserMap, PickleStorage
+from conftest import add_users, system_state
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Details and packed history of a user, for comparing copies
+def user_fields(user):
+    return (user.username, user.password, user.email, user.phone_number, user.dob, bytes(user.purchase_history.data))
+
+def test_users_pickle_is_converted_and_loaded_on_demand(tmp_path, open_system):
+    for name in ("users.pkl", "tickets.pkl"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path / name)
+    expected = PickleStorage(str(tmp_path / "users.pkl"), str(tmp_path / "tickets.pkl")).load_users()
+    system = open_system(background_builds=False)
+    assert isinstance(system.users, MappedUserMap)
+    assert (tmp_path / "users.dat").exists()
+    assert system.users.cache == {}  # Nothing decoded at startup
+    assert sorted(system.users) == sorted(expected)
+    username = next(iter(expected))
+    assert user_fields(system.users[username]) == user_fields(expected[username])
+    assert list(system.users.cache) == [username]
+
+def test_compaction_keeps_changed_unchanged_and_deleted_users(open_system):
+    system = open_system()
+    add_users(system, 50)
+    system.compact()  # Every user in the data file, none in the journal
+    for i in range(0, 50, 5):
+        system.purchase_ticket(f"u{i}", i % 4)
+    system.modify_user_details("u1", email="other1@example.com")
+    system.delete_user("u2")
+    password_hash = system.hasher.hash("secret")
+    system.import_users([("u2", password_hash, "again2@example.com", "5550000002", "1991-02-02"), ("new", password_hash, "new@example.com", "5559999999", "1992-03-03")])
+    system.compact()  # Unchanged records copied as they are, changed ones written again
+    before = system_state(system)
+    system.close()
+    system = open_system(background_builds=False)
+    assert system_state(system) == before
+    assert len(system.users) == 51
+    assert system.users["u2"].email == "again2@example.com"
+    assert len(system.users["u2"].purchase_history) == 0
@@ -0,0 +1,67 @@
+import pytest
+
+from booking import metrics
+from booking.core import TicketBookingSystem, SoldOutError
+from conftest import add_users
+
+@pytest.fixture
+def registry():
+    registry = metrics.MetricsRegistry()
+    metrics.enable(registry=registry)
+    yield registry
+    metrics.disable()
+
+# Value of one sample line of the text format, or None if it is not there
+def sample(text, line_start):
+    for line in text.splitlines():
+        if line.startswith(line_start + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return None
+
+def test_histogram_renders_cumulative_buckets():
+    registry = metrics.MetricsRegistry()
+    histogram = registry.histogram("op_seconds", "Time per op", buckets=(0.1, 1), operation="x")
+    assert registry.render() == "\n"  # Nothing until something is observed
+    for value in (0.05, 0.5, 5):
+        histogram.observe(value)
+    registry.counter("op_errors_total", "Errors", operation='a"b').inc(2)
+    assert registry.render().splitlines() == [
+        "# HELP op_errors_total Errors",
+        "# TYPE op_errors_total counter",
+        'op_errors_total{operation="a\\"b"} 2',
+        "# HELP op_seconds Time per op",
+        "# TYPE op_seconds histogram",
+        'op_seconds_bucket{operation="x",le="0.1"} 1',
+        'op_seconds_bucket{operation="x",le="1"} 2',
+        'op_seconds_bucket{operation="x",le="+Inf"} 3',
+        'op_seconds_sum{operation="x"} 5.55',
+        'op_seconds_count{operation="x"} 3',
+    ]
+
+def test_operations_errors_and_saves_are_measured(registry, open_system):
+    system = open_system()
+    add_users(system, 1)
+    for _ in range(3):
+        system.purchase_ticket("u0", 0)
+    for _ in range(50):
+        system.purchase_ticket("u0", 5, None, "2030-07-01")
+    with pytest.raises(SoldOutError):
+        system.purchase_ticket("u0", 5, None, "2030-07-01")
+    system.compact()
+    text = registry.render()
+    assert sample(text, 'booking_operation_seconds_count{operation="purchase_ticket"}') == 3 + 50 + 1
+    assert sample(text, 'booking_operation_errors_total{operation="purchase_ticket"}') == 1
+    assert sample(text, 'booking_save_bytes_count{file="users.dat"}') >= 1
+    assert sample(text, 'booking_lock_wait_seconds_count{lock="inventory"}') >= 51
+
+def test_disable_puts_the_originals_back(open_system):
+    purchase = TicketBookingSystem.purchase_ticket
+    metrics.enable(registry=metrics.MetricsRegistry())
+    system = open_system()
+    assert TicketBookingSystem.purchase_ticket is not purchase
+    assert isinstance(system.users_lock, metrics.TimedLock)
+    metrics.disable()
+    assert TicketBookingSystem.purchase_ticket is purchase
+    assert not isinstance(system.users_lock, metrics.TimedLock)
+    assert not any(isinstance(lock, metrics.TimedLock) for lock in system.user_locks)
+    assert not metrics.enabled()
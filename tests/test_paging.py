@@ -0,0 +1,23 @@
+from conftest import add_users
+
+def test_user_pages_follow_the_search_text(open_system):
+    system = open_system()
+    add_users(system, 120)
+    page, total = system.user_page("", offset=0, limit=50)
+    assert total == 120 and len(page) == 50 and page == sorted(page)
+    assert system.user_page("", offset=100, limit=50)[0] == sorted(system.users)[100:]
+    assert system.user_page("u11") == (["u11", "u110", "u111", "u112", "u113", "u114", "u115", "u116", "u117", "u118", "u119"], 11)
+    assert system.user_page(" U7@Example.com ") == (["u7"], 1)
+    assert system.user_page("5550000042") == (["u42"], 1)
+    assert system.user_page("nobody") == ([], 0)
+
+def test_purchase_history_is_read_a_page_at_a_time(open_system):
+    system = open_system()
+    add_users(system, 1)
+    for i in range(25):
+        system.purchase_ticket("u0", i % 4, None, f"2030-07-{i + 1:02d}")
+    rows, total = system.purchase_page("u0", offset=20, limit=10)
+    assert total == 25 and len(rows) == 5
+    assert rows[0] == system.purchase_page("u0", 0, 25)[0][20]
+    assert [row.split(" - ")[0] for row in rows] == [system.tickets[i % 4].name for i in range(20, 25)]
+    assert system.purchase_page("nobody") == ([], 0)
@@ -0,0 +1,29 @@
+import os
+import shutil
+
+from booking.core import is_password_hash
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_new_passwords_are_stored_hashed(open_system):
+    system = open_system()
+    system.register_user("ann", "s3cret!", "ann@example.com", "5550001111", "1990-01-01")
+    assert is_password_hash(system.users["ann"].password)
+    assert system.login_user("ann", "s3cret!") is system.users["ann"]
+    assert system.login_user("ann", "wrong") is None
+
+def test_plain_text_password_is_hashed_on_first_login(tmp_path, open_system):
+    for name in ("users.pkl", "tickets.pkl"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path / name)  # Saved by the original app, with plain-text passwords
+    system = open_system(background_builds=False)
+    assert system.users["shaikha123"].password == "12345678"
+    assert system.login_user("shaikha123", "1234567") is None
+    assert system.users["shaikha123"].password == "12345678"  # A failed login changes nothing
+    assert system.login_user("shaikha123", "12345678") is not None
+    password_hash = system.users["shaikha123"].password
+    assert is_password_hash(password_hash) and "12345678" not in password_hash
+    system.close()
+    system = open_system(background_builds=False)
+    assert system.users["shaikha123"].password == password_hash  # The hash was saved
+    assert system.login_user("shaikha123", "12345678") is not None
+    assert system.users["shaikha123"].password == password_hash
@@ -0,0 +1,69 @@
+import copy
+import os
+import shutil
+
+import pytest
+
+from booking.core import PricingEngine, default_tickets
+from conftest import add_users
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The discount chain of the original app, which the default rules replace; returns (final price, discount)
+def old_price(ticket, num_persons):
+    discount = 0
+    if ticket.name == "Two-Day Pass":
+        discount = 0.10
+    elif ticket.name == "Annual Membership":
+        discount = 0.15
+    elif ticket.name == "Group Ticket (10+)":
+        total_price = ticket.price * num_persons
+        if num_persons > 10:
+            discount = 0.20
+        return total_price * (1 - discount), discount
+    return ticket.price * (1 - discount), discount
+
+@pytest.mark.parametrize("num_persons", [1, 2, 9, 10, 11, 12, 40])
+def test_default_rules_match_the_old_discount_chain(num_persons):
+    tickets = default_tickets()
+    pricing = PricingEngine(tickets)
+    for ticket_id, ticket in enumerate(tickets):
+        quantity, final_price, discount = pricing.quote(ticket_id, num_persons)
+        old_final_price, old_discount = old_price(ticket, num_persons)
+        assert (final_price, discount) == pytest.approx((old_final_price, old_discount))
+        assert quantity == (num_persons if ticket.name == "Group Ticket (10+)" else 1)
+
+def test_group_of_ten_pays_full_price_and_eleven_get_the_discount(open_system):
+    system = open_system()
+    add_users(system, 1)
+    assert system.purchase_ticket("u0", 4, 10) == (2200, "Group Ticket (10+) (10 people) - $2200.00 USD (Discount Applied: 0%)")
+    assert system.purchase_ticket("u0", 4, 11) == (pytest.approx(1936), "Group Ticket (10+) (11 people) - $1936.00 USD (Discount Applied: 20%)")
+
+@pytest.mark.parametrize("num_persons", [None, 0, -3, 2.5, "12"])
+def test_group_size_must_be_a_positive_integer(num_persons):
+    with pytest.raises(ValueError, match="Group size"):
+        PricingEngine(default_tickets()).quote(4, num_persons)
+
+def test_rules_follow_the_ticket_name_when_the_catalog_is_reordered(open_system):
+    system = open_system()
+    tickets = default_tickets()
+    system.import_tickets([(1, copy.copy(tickets[2])), (2, copy.copy(tickets[1]))])  # Swap Two-Day Pass and Annual Membership
+    assert system.pricing.quote(1)[2] == pytest.approx(0.15)
+    assert system.pricing.quote(2)[2] == pytest.approx(0.10)
+
+def test_date_rules_apply_only_on_their_days():
+    rules = {"Single Day Pass": [{"kind": "dates", "rate": 0.25, "start": "2030-07-01", "end": "2030-07-31", "weekdays": [5, 6]}]}
+    pricing = PricingEngine(default_tickets(), rules)
+    saturday, monday = 741264, 741259  # 2030-07-06 and 2030-07-01
+    assert pricing.quote(0, visit_ordinal=saturday)[2] == 0.25
+    assert pricing.quote(0, visit_ordinal=monday)[2] == 0
+    assert pricing.quote(0, visit_ordinal=saturday + 28)[2] == 0  # August
+
+def test_stored_group_discount_text_is_corrected(tmp_path, open_system):
+    for name in ("users.pkl", "tickets.pkl"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path / name)
+    system = open_system(background_builds=False)
+    group = next(ticket for ticket in system.tickets if ticket.name == "Group Ticket (10+)")
+    assert group.discount == "20% off for groups of more than 10"
+    system.close()
+    assert [ticket.discount for ticket in open_system(background_builds=False).tickets] == [ticket.discount for ticket in system.tickets]
@@ -0,0 +1,46 @@
+import threading
+from concurrent.futures import wait
+
+from booking.core import PurchaseEngine, SoldOutError
+from conftest import add_users, system_state
+
+def test_concurrent_buyers_lose_no_sale(open_system):
+    system = open_system()
+    add_users(system, 20)
+    engine = PurchaseEngine(system, workers=8)
+    futures = [engine.submit(f"u{i % 20}", i % 4, None, "2030-07-01", "card") for i in range(2000)]
+    wait(futures)
+    engine.shutdown()
+    assert all(future.exception() is None for future in futures)
+    assert sum(len(user.purchase_history) for user in system.users.values()) == 2000
+    assert [ticket.sold_count for ticket in system.tickets] == [500, 500, 500, 500, 0, 0]
+    assert sum(units for units, *_ in system.sales_report("ticket").values()) == 2000
+
+def test_limited_ticket_is_never_oversold(open_system):
+    system = open_system()
+    add_users(system, 20)
+    engine = PurchaseEngine(system, workers=8)
+    futures = [engine.submit(f"u{i % 20}", 5, None, "2030-07-01") for i in range(80)]  # 50 VIP seats per date
+    wait(futures)
+    engine.shutdown()
+    sold_out = [future for future in futures if isinstance(future.exception(), SoldOutError)]
+    assert len(sold_out) == 30
+    assert system.tickets[5].sold_count == 50
+    assert system.seats_left(5, "2030-07-01") == 0
+    assert sum(len(user.purchase_history) for user in system.users.values()) == 50
+
+def test_purchases_from_many_threads_are_persisted(open_system):
+    system = open_system()
+    add_users(system, 20)
+    threads = [
+        threading.Thread(target=lambda t=t: [system.purchase_ticket(f"u{(t + i) % 20}", t % 4) for i in range(100)])
+        for t in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    before = system_state(system)
+    system.close()
+    assert system_state(open_system()) == before
+    assert sum(before["sold_counts"]) == 800
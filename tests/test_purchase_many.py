@@ -0,0 +1,54 @@
+import pytest
+
+from booking.core import SoldOutError
+from conftest import add_users, system_state
+
+# A failed bulk order must leave no trace: no purchases, seats sold or held, sales or journal records
+def assert_unchanged(system, before):
+    assert system_state(system) == before
+    assert all(not slot.held and not slot.holds for slot in system.inventory.slots.values())
+
+def test_applies_every_order(open_system):
+    system = open_system()
+    add_users(system, 3)
+    results = system.purchase_many([("u0", 0), ("u1", 4, 12, "2030-07-01", "card"), ("u2", 5, None, "2030-07-01")])
+    assert [price for price, _ in results] == [275, 2112, 550]
+    assert [len(system.users[f"u{i}"].purchase_history) for i in range(3)] == [1, 1, 1]
+    assert system.seats_left(5, "2030-07-01") == 49
+
+@pytest.mark.parametrize("orders, error", [
+    ([("u0", 0), ("u1", 4, 70000)], ValueError),  # More persons than one purchase record holds
+    ([("u0", 0), ("u1", 1, None, "2030-02-30")], ValueError),  # Not a real date
+    ([("u0", 0), ("nobody", 1)], ValueError),  # Unknown user, found after the orders are priced
+    ([("u0", 5, None, "2030-07-01"), ("u1", 5, None, "2030-07-01"), ("u2", 5, None, "2030-07-01")], SoldOutError),
+    ([("u1", 5, None, "2030-07-02")] + [("u2", 5, None, "2030-07-01")] * 3, SoldOutError),  # Seats held for the first date are released
+])
+def test_failed_order_applies_nothing(open_system, orders, error):
+    system = open_system()
+    add_users(system, 3)
+    for _ in range(48):
+        system.purchase_ticket("u0", 5, None, "2030-07-01")  # Two VIP seats left on that date
+    before = system_state(system)
+    with pytest.raises(error):
+        system.purchase_many(orders)
+    assert_unchanged(system, before)
+
+def test_out_of_range_order_is_rejected_before_seats_are_held(open_system):
+    system = open_system()
+    add_users(system, 2)
+    system.tickets[0].price = 2 ** 30  # Prices a single ticket beyond what a purchase record holds
+    system.pricing.table[0] = system.pricing.compile(0)
+    before = system_state(system)
+    with pytest.raises(ValueError, match="Order 2"):
+        system.purchase_many([("u0", 1), ("u1", 0)])
+    assert_unchanged(system, before)
+
+def test_failed_order_is_not_replayed(tmp_path, open_system):
+    system = open_system()
+    add_users(system, 2)
+    system.purchase_many([("u0", 0), ("u1", 1)])
+    with pytest.raises(ValueError):
+        system.purchase_many([("u0", 0), ("nobody", 1)])
+    before = system_state(system)
+    system.close()
+    assert system_state(open_system()) == before
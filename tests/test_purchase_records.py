@@ -0,0 +1,58 @@
+import pickle
+
+import pytest
+
+from booking.core import UNKNOWN_TICKET, Purchase, PurchaseHistory, Ticket, User, default_tickets, purchase_error, render_purchase
+from conftest import add_users, system_state
+
+# Purchase records as earlier versions of the app saved them
+LEGACY_RECORDS = [
+    "Single Day Pass - $275.00 USD (Discount Applied: 0%)",
+    "Two-Day Pass - $432.00 USD (Discount Applied: 10%)",
+    "Group Ticket (10+) (12 people) - $2112.00 USD (Discount Applied: 20%)",
+    "Season Pass - $99.50 USD (Discount Applied: 5%)",
+]
+
+def test_records_pack_and_unpack():
+    history = PurchaseHistory()
+    history.append(4, 12, 211200, 2000, 741259, 2)
+    history.append(0, 1, 27500, 0)
+    assert len(history) == 2
+    assert len(history.data) == 2 * PurchaseHistory.RECORD.size
+    assert history[0] == Purchase(4, 12, 211200, 2000, 741259, 2)
+    assert history[-1] == Purchase(0, 1, 27500, 0, 0, 0)
+    assert history.page(1, 10) == [history[1]]
+    assert pickle.loads(pickle.dumps(history)).data == history.data
+    with pytest.raises(IndexError):
+        history[2]
+
+def test_legacy_text_records_are_converted():
+    user = User.__new__(User)
+    user.__setstate__({"username": "old", "password": "pw", "email": "old@example.com", "phone_number": "5551234567", "dob": "1980-01-01", "purchase_history": LEGACY_RECORDS})
+    assert isinstance(user.purchase_history, PurchaseHistory)
+    assert list(user.purchase_history)[:3] == [Purchase(0, 1, 27500, 0, 0, 0), Purchase(1, 1, 43200, 1000, 0, 0), Purchase(4, 12, 211200, 2000, 0, 0)]
+    assert user.purchase_history[3].ticket_id == UNKNOWN_TICKET
+    assert user.purchase_history.render(default_tickets())[:3] == LEGACY_RECORDS[:3]  # Shown as they always were
+
+def test_user_and_ticket_have_no_instance_dict():
+    assert not hasattr(User("a", "pw", "a@example.com", "5551234567", "1990-01-01"), "__dict__")
+    assert not hasattr(Ticket("T", "", 1, "1 day", "None", ""), "__dict__")
+
+@pytest.mark.parametrize("purchase, error", [
+    (Purchase(UNKNOWN_TICKET + 1, 1, 100, 0, 0, 0), "Ticket id"),
+    (Purchase(0, 0, 100, 0, 0, 0), "Quantity"),
+    (Purchase(0, 0x10000, 100, 0, 0, 0), "Quantity"),
+    (Purchase(0, 1, 2 ** 32, 0, 0, 0), "total price"),
+    (Purchase(0, 1, 100, 10001, 0, 0), "Discount"),
+])
+def test_out_of_range_fields_are_rejected(purchase, error):
+    assert error in purchase_error(purchase)
+
+def test_oversized_group_purchase_holds_no_seats(open_system):
+    system = open_system()
+    add_users(system, 1)
+    before = system_state(system)
+    with pytest.raises(ValueError, match="Quantity"):
+        system.purchase_ticket("u0", 4, 70000)
+    assert system_state(system) == before
+    assert render_purchase(Purchase(4, 12, 211200, 2000, 0, 0), system.tickets) == LEGACY_RECORDS[2]
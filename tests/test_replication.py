@@ -0,0 +1,87 @@
+import threading
+
+import pytest
+
+from booking.replication import ChangePublisher, Replica
+from conftest import add_users, system_state
+
+# Start a publisher on the primary and an in-process replica following it; both are closed after the test
+@pytest.fixture
+def replicate():
+    started = []
+
+    def replicate(system, **publisher_options):
+        publisher = ChangePublisher(system, **publisher_options)
+        replica = Replica(publisher.address, publisher.authkey, retry=0.05)
+        started.append((publisher, replica))
+        return publisher, replica
+
+    yield replicate
+    for publisher, replica in started:
+        replica.close()
+        publisher.close()
+
+# Wait until the replica has applied every change the primary has published
+def catch_up(publisher, replica):
+    assert replica.ready.wait(10), "no snapshot loaded"
+    assert replica.wait_for(publisher.lsn, 10), "changes not applied"
+
+# Make purchases of every kind and a few user changes on the primary
+def make_changes(system, round, users=10):
+    for i in range(20):
+        system.purchase_ticket(f"u{(round * 20 + i) % users}", i % 4, None, f"2030-07-{round + 1:02d}", "card")
+    system.purchase_many([("u1", 4, 11, "2030-08-01"), ("u2", 5, None, "2030-08-01")])
+    system.modify_user_details(f"u{round}", phone_number=f"55599{round:05d}")
+
+# State of the replica's current copy, to compare with the primary's
+def replica_state(replica):
+    return system_state(replica.system)
+
+def test_replica_loads_snapshot_then_streams_changes(open_system, replicate):
+    system = open_system()
+    add_users(system, 10)
+    make_changes(system, 0)  # Made before the replica connects, so they reach it in the snapshot
+    publisher, replica = replicate(system)
+    catch_up(publisher, replica)
+    assert replica.snapshots == 1
+    assert replica_state(replica) == system_state(system)
+    make_changes(system, 1)
+    system.delete_user("u9")
+    catch_up(publisher, replica)
+    assert replica_state(replica) == system_state(system)
+    assert replica.query("sales_report", ("day",)) == system.sales_report("day")
+    assert replica.query("attendance", ("2030-07-01", 40)) == system.attendance("2030-07-01", 40)
+
+def test_changes_made_while_the_snapshot_is_sent_are_applied_once(open_system, replicate):
+    system = open_system()
+    add_users(system, 500)  # Sent in many stripes, each copied at a different point of the stream
+    make_changes(system, 0, 500)
+    stop = threading.Event()
+
+    def buy():
+        round = 1
+        while not stop.is_set() and round < 28:
+            make_changes(system, round, 500)
+            round += 1
+
+    buyer = threading.Thread(target=buy)
+    buyer.start()
+    try:
+        publisher, replica = replicate(system)
+        assert replica.ready.wait(10)
+    finally:
+        stop.set()
+        buyer.join()
+    catch_up(publisher, replica)
+    assert replica_state(replica) == system_state(system)  # Nothing lost, and no purchase counted twice
+
+def test_replica_that_falls_behind_the_backlog_reloads_a_snapshot(open_system, replicate):
+    system = open_system()
+    add_users(system, 10)
+    # A backlog of one change, and a feed that waits long enough for a burst of changes to overflow it
+    publisher, replica = replicate(system, backlog=1, batch_delay=0.2)
+    catch_up(publisher, replica)
+    make_changes(system, 0)
+    catch_up(publisher, replica)
+    assert replica.snapshots >= 2
+    assert replica_state(replica) == system_state(system)
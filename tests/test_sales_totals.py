@@ -0,0 +1,46 @@
+import pytest
+
+from booking.core import SalesTotals, TicketBookingSystem
+from conftest import add_users, system_state
+
+# Purchases across tickets, dates, payment methods and age bands
+def make_purchases(system):
+    add_users(system, 6)
+    system.modify_user_details("u5", dob="2020-05-05")  # A child
+    for i in range(30):
+        system.purchase_ticket(f"u{i % 6}", i % 4, None, f"2030-07-0{i % 5 + 1}", ("card", "paypal", "cash")[i % 3])
+    system.purchase_many([("u1", 4, 12, "2030-08-01"), ("u5", 5, None, "2030-08-01")])
+
+def test_running_totals_match_a_full_rescan(open_system):
+    system = open_system()
+    make_purchases(system)
+    rescanned = SalesTotals.from_users(system.users.values())
+    for dimension in SalesTotals.DIMENSIONS:
+        assert system.sales_report(dimension) == rescanned.report(dimension)
+    assert sum(units for units, *_ in system.sales_report("ticket").values()) == 30 + 12 + 1
+
+def test_totals_survive_restart_and_keep_deleted_users_sales(open_system):
+    system = open_system()
+    make_purchases(system)
+    system.delete_user("u0")
+    before = system_state(system)
+    system.close()
+    system = open_system()
+    assert system.sales.state() == before["sales"]
+    assert system_state(system) == before
+
+def test_data_saved_before_totals_were_kept_is_rebuilt_once(tmp_path, open_system, monkeypatch):
+    system = open_system()
+    make_purchases(system)
+    expected = system.sales.state()
+    system.compact()
+    system.close()
+    # As data from before sales totals and seat counts were stored: a snapshot with an empty journal
+    (tmp_path / "users.journal").unlink()
+    system = open_system()
+    assert system.sales.state() == expected
+    assert system.seats_left(5, "2030-08-01") == 49  # Seats in the histories count as sold
+    assert system.tickets[4].sold_count == 12
+    system.close()
+    monkeypatch.setattr(TicketBookingSystem, "rebuild_sales", lambda self: pytest.fail("sales totals rebuilt again"))
+    assert open_system().sales.state() == expected  # Stored by the rebuild
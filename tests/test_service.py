@@ -0,0 +1,79 @@
+import asyncio
+import json
+
+import pytest
+
+from booking.service import BookingService, Request
+from conftest import add_users
+
+# Send one request to the service's router; returns (status, payload)
+def call(service, method, path, body=None, token=None, query=None):
+    headers = {"authorization": f"Bearer {token}"} if token else {}
+    request = Request(method, tuple(path.strip("/").split("/")), query or {}, headers, json.dumps(body).encode() if body is not None else b"")
+    return asyncio.run(service.dispatch(request))
+
+@pytest.fixture
+def service(open_system):
+    system = open_system()
+    add_users(system, 2)
+    service = BookingService(system, admin_token="admin-secret", workers=2)
+    yield service
+    service.executor.shutdown()
+
+# Log in as a user and return the session token
+def login(service, username):
+    status, payload = call(service, "POST", "/sessions", {"username": username, "password": "secret"})
+    assert status == 200
+    return payload["token"]
+
+def test_purchase_and_read_back(service):
+    token = login(service, "u0")
+    status, payload = call(service, "POST", "/users/u0/purchases", {"ticket_id": 4, "num_persons": 11, "visit_date": "2030-07-01"}, token)
+    assert (status, payload) == (201, {"price": 1936.0, "ticket": "Group Ticket (10+) (11 people) - $1936.00 USD (Discount Applied: 20%)"})
+    status, payload = call(service, "GET", "/users/u0", token=token)
+    assert status == 200 and payload["purchases"] == ["Group Ticket (10+) (11 people) - $1936.00 USD (Discount Applied: 20%)"]
+
+@pytest.mark.parametrize("body", [
+    {"ticket_id": True},
+    {"ticket_id": False},
+    {"ticket_id": "1"},
+    {"ticket_id": 6},
+    {"ticket_id": 4, "num_persons": True},
+    {"ticket_id": 4, "num_persons": 0},
+    {"ticket_id": 4, "num_persons": 2.5},
+])
+def test_invalid_purchases_are_rejected(service, body):
+    token = login(service, "u0")
+    status, _ = call(service, "POST", "/users/u0/purchases", body, token)
+    assert status == 400
+    assert len(service.system.users["u0"].purchase_history) == 0
+
+def test_users_may_only_act_for_themselves(service):
+    token = login(service, "u0")
+    assert call(service, "POST", "/users/u1/purchases", {"ticket_id": 0})[0] == 401
+    assert call(service, "POST", "/users/u1/purchases", {"ticket_id": 0}, token)[0] == 403
+    assert call(service, "POST", "/users/u1/purchases", {"ticket_id": 0}, "admin-secret")[0] == 201
+    assert call(service, "GET", "/admin/sales/ticket", token=token)[0] == 403
+
+def test_sold_out_is_a_conflict(service):
+    token = login(service, "u0")
+    for _ in range(50):
+        assert call(service, "POST", "/users/u0/purchases", {"ticket_id": 5, "visit_date": "2030-07-01"}, token)[0] == 201
+    assert call(service, "POST", "/users/u0/purchases", {"ticket_id": 5, "visit_date": "2030-07-01"}, token)[0] == 409
+
+def test_requests_over_a_connection(service):
+    async def exchange():
+        server = await asyncio.start_server(service.handle_connection, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /tickets HTTP/1.1\r\nHost: test\r\n\r\nGET /nowhere HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        server.close()
+        await server.wait_closed()
+        return response
+
+    response = asyncio.run(exchange())
+    assert response.startswith(b"HTTP/1.1 200 OK\r\n")
+    assert b"VIP Experience Pass" in response
+    assert b"HTTP/1.1 404 Not Found\r\n" in response
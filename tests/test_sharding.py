@@ -0,0 +1,47 @@
+import time
+
+import pytest
+
+from booking.core import default_tickets
+from booking.sharding import SharedCounters, SharedInventory
+
+VIP = 5  # 50 seats per visit date
+DAY = 741259
+
+# Two shards' inventories over one set of shared counters
+@pytest.fixture
+def shards():
+    counters = SharedCounters(slots=64, holds=256)
+    yield SharedInventory(default_tickets(), None, counters), SharedInventory(default_tickets(), None, counters)
+    counters.close(unlink=True)
+
+def test_seats_are_shared_between_shards(shards):
+    first, second = shards
+    held = first.reserve(VIP, DAY, 30)
+    assert second.available(VIP, DAY) == 20
+    assert second.reserve(VIP, DAY, 21) is None
+    assert first.confirm(held)
+    first.release(second.reserve(VIP, DAY, 20))
+    assert second.available(VIP, DAY) == 20
+    assert (first.slots[(VIP, DAY)].sold, second.slots[(VIP, DAY)].sold) == (30, 0)  # Each shard counts its own sales
+
+def test_lapsed_hold_is_freed_for_another_shard(shards):
+    first, second = shards
+    held = first.reserve(VIP, DAY, 50, hold_seconds=0.05)
+    assert second.reserve(VIP, DAY, 1) is None
+    time.sleep(0.1)
+    # The first shard never looks at the slot again, yet the second gets the seats
+    assert second.available(VIP, DAY) == 50
+    assert second.confirm(second.reserve(VIP, DAY, 50))
+    assert not first.confirm(held)
+    assert first.available(VIP, DAY) == 0
+
+def test_confirmed_and_live_holds_survive_another_shards_expiry(shards):
+    first, second = shards
+    first.confirm(first.reserve(VIP, DAY, 10, hold_seconds=0.05))
+    live = first.reserve(VIP, DAY, 5)
+    second.reserve(VIP, DAY, 20, hold_seconds=0.05)
+    time.sleep(0.1)
+    assert first.available(VIP, DAY) == 35
+    assert first.confirm(live)
+    assert second.available(VIP, DAY) == 35
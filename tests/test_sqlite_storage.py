@@ -0,0 +1,33 @@
+from booking.core import SQLiteStorage, migrate_pickles_to_sqlite
+from conftest import add_users, system_state
+
+# Make purchases and user changes of every kind
+def make_changes(system):
+    add_users(system, 8)
+    for i in range(24):
+        system.purchase_ticket(f"u{i % 8}", i % 4, None, f"2030-07-0{i % 3 + 1}", "card")
+    system.purchase_ticket("u1", 4, 12, "2030-07-02", "paypal")
+    system.purchase_ticket("u2", 5, None, "2030-07-02")
+    system.purchase_many([("u3", 5, None, "2030-07-02"), ("u4", 0, None, None, "cash")])
+    system.modify_user_details("u5", email="new5@example.com", phone_number="5551234567")
+    system.delete_user("u7")
+
+def test_sqlite_round_trip(tmp_path, open_system):
+    system = open_system(storage=SQLiteStorage(str(tmp_path / "booking.db")))
+    make_changes(system)
+    before = system_state(system)
+    system.close()
+    system = open_system(storage=SQLiteStorage(str(tmp_path / "booking.db")))
+    assert system_state(system) == before
+    assert system.users["u5"].email == "new5@example.com"
+    assert "u7" not in system.users
+    assert system.seats_left(5, "2030-07-02") == 48
+
+def test_migration_from_pickles_keeps_users_seats_and_sales(tmp_path, open_system):
+    system = open_system()
+    make_changes(system)
+    before = system_state(system)
+    system.close()
+    assert migrate_pickles_to_sqlite(str(tmp_path / "booking.db"), str(tmp_path / "users.pkl"), str(tmp_path / "tickets.pkl")) == 7
+    system = open_system(storage=SQLiteStorage(str(tmp_path / "booking.db")))
+    assert system_state(system) == before
@@ -0,0 +1,73 @@
+import os
+import pickle
+import shutil
+
+import pytest
+
+from booking.core import MappedStorage, RecordSchema, StateUnpickler, Ticket, User, default_tickets
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OLD_SCHEMA = RecordSchema(("name", "text", ""), ("price", "number", 0))
+NEW_SCHEMA = RecordSchema(("name", "text", ""), ("price", "number", 0), ("capacity", "optional number", None), ("notes", "bytes", b"-"))
+
+def test_records_read_across_schema_versions():
+    assert NEW_SCHEMA.decode(OLD_SCHEMA.encode(("Day", 12.5))) == ["Day", 12.5, None, b"-"]  # Newer fields get defaults
+    assert OLD_SCHEMA.decode(NEW_SCHEMA.encode(("Day", 12.5, 40, b"x"))) == ["Day", 12.5]  # Unknown fields are skipped
+    record = NEW_SCHEMA.encode(("Ünïcode", 7, None, b"\x00\xff"))
+    assert NEW_SCHEMA.decode(record) == ["Ünïcode", 7, None, b"\x00\xff"]
+    assert NEW_SCHEMA.decode(record, limit=2) == ["Ünïcode", 7]
+    assert bytes(NEW_SCHEMA.field(record, 0, 3)) == b"\x00\xff"
+    assert NEW_SCHEMA.field(OLD_SCHEMA.encode(("Day", 1)), 0, 3) == b"-"
+
+def test_ticket_catalog_round_trips_through_the_data_file(tmp_path):
+    storage = MappedStorage(str(tmp_path / "users.pkl"), str(tmp_path / "tickets.pkl"))
+    tickets = default_tickets() + [Ticket("Night Pass", "After dark", 19.99, "1 night", "None", "18+", 0)]
+    storage.save_tickets(tickets)
+    loaded = MappedStorage(str(tmp_path / "users.pkl"), str(tmp_path / "tickets.pkl")).load_tickets()
+    fields = ("name", "description", "price", "validity", "discount", "terms", "capacity")
+    assert [tuple(getattr(ticket, field) for field in fields) for ticket in loaded] == [tuple(getattr(ticket, field) for field in fields) for ticket in tickets]
+    assert not os.path.exists(tmp_path / "tickets.pkl")
+
+def test_shipped_pickles_are_converted_once(tmp_path, open_system):
+    for name in ("users.pkl", "tickets.pkl"):
+        shutil.copy(os.path.join(ROOT, name), tmp_path / name)
+    system = open_system(background_builds=False)
+    names = [ticket.name for ticket in system.tickets]
+    assert system.users["shaikha123"].email
+    system.close()
+    assert os.path.exists(tmp_path / "users.dat") and os.path.exists(tmp_path / "tickets.dat")
+    for name in ("users.pkl", "tickets.pkl"):
+        os.remove(tmp_path / name)  # The data files are read from now on
+    system = open_system(background_builds=False)
+    assert [ticket.name for ticket in system.tickets] == names
+    assert "shaikha123" in system.users
+
+# Write an object to a pickle file and return its path
+def write_pickle(path, value):
+    with open(path, "wb") as file:
+        pickle.dump(value, file)
+    return path
+
+# Load a pickle file with the state unpickler
+def load_state(path):
+    with open(path, "rb") as file:
+        return StateUnpickler(file).load()
+
+# Pickles a call to os.system, as a tampered state file would
+class Exploit:
+    def __reduce__(self):
+        return os.system, ("echo pwned",)
+
+def test_state_files_refuse_foreign_classes(tmp_path):
+    with pytest.raises(pickle.UnpicklingError, match="posix.system|nt.system"):
+        load_state(write_pickle(tmp_path / "state.pkl", {"x": Exploit()}))
+    user = User("ann", "pw", "ann@example.com", "5550000101", "1990-01-01")
+    user.add_purchase(0, 1, 27500, 0)
+    loaded = load_state(write_pickle(tmp_path / "state.pkl", {"ann": user}))["ann"]
+    assert (loaded.email, list(loaded.purchase_history)) == ("ann@example.com", list(user.purchase_history))
+
+def test_tampered_users_file_is_not_loaded(tmp_path, open_system):
+    write_pickle(tmp_path / "users.pkl", {"x": Exploit()})
+    with pytest.raises(pickle.UnpicklingError):
+        open_system()
@@ -0,0 +1,83 @@
+import threading
+
+import pytest
+
+from conftest import add_users
+
+# Hold up the storage writer until the returned event is set, counting the batches it writes
+def block_writer(system, monkeypatch):
+    release, batches = threading.Event(), []
+    record_changes = system.storage.record_changes
+
+    def blocked(records, users):
+        release.wait(10)
+        batches.append(len(records))
+        record_changes(records, users)
+
+    monkeypatch.setattr(system.storage, "record_changes", blocked)
+    return release, batches
+
+def test_purchases_do_not_wait_for_the_disk(open_system, monkeypatch):
+    system = open_system()
+    add_users(system, 1)
+    system.flush()
+    release, batches = block_writer(system, monkeypatch)
+    for _ in range(200):
+        system.purchase_ticket("u0", 0)  # Returns while the first write is still held up
+    assert batches == []
+    release.set()
+    system.flush()
+    assert sum(batches) == 200 and len(batches) < 200  # Queued changes go to disk together
+    system.close()
+    assert len(open_system().users["u0"].purchase_history) == 200
+
+def test_storage_errors_are_raised_from_the_next_flush(open_system, monkeypatch):
+    system = open_system()
+    add_users(system, 1)
+    system.flush()
+    def disk_full(records, users):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(system.storage, "record_changes", disk_full)
+    system.purchase_ticket("u0", 0)  # The purchase itself succeeds; the write fails later
+    with pytest.raises(OSError, match="disk full"):
+        system.flush()
+    system.flush()  # Reported once
+    monkeypatch.undo()  # So the system can close cleanly
+
+def test_ticket_saves_run_on_the_writer_thread(open_system, monkeypatch):
+    system = open_system()
+    threads = []
+    save_tickets = system.storage.save_tickets
+    monkeypatch.setattr(system.storage, "save_tickets", lambda tickets: (threads.append(threading.current_thread().name), save_tickets(tickets)))
+    system.update_ticket_price(0, 300)
+    system.flush()
+    assert threads == ["storage-writer"]
+    system.close()
+    assert open_system().tickets[0].price == 300
+
+# A stand-in for the Tk root: after() callbacks are run when the test says so, on the test's thread
+class FakeRoot:
+    def __init__(self):
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+    def run_scheduled(self):
+        while self.scheduled:
+            self.scheduled.pop(0)()
+
+def test_gui_calls_run_off_the_tk_thread_and_report_back_on_it():
+    from Python_Code import BackgroundTasks
+    root = FakeRoot()
+    tasks = BackgroundTasks(root)
+    results, errors = [], []
+    tasks.run(lambda: threading.current_thread().name, on_done=lambda name: results.append((name, threading.current_thread())))
+    tasks.run(lambda: 1 / 0, on_error=errors.append)
+    tasks.shutdown()  # Both calls have finished, but no callback runs until the Tk loop polls
+    assert results == [] and tasks.pending == 2
+    root.run_scheduled()
+    assert len(results) == 1 and results[0][0].startswith("gui-task")
+    assert results[0][1] is threading.current_thread()
+    assert isinstance(errors[0], ZeroDivisionError) and tasks.pending == 0
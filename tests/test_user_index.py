@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import pytest
+
+from booking.core import DuplicateEmailError
+from conftest import add_users
+
+@pytest.fixture
+def system(open_system):
+    system = open_system()
+    add_users(system, 30)
+    return system
+
+def test_searches_follow_email_and_phone_changes(system):
+    assert system.modify_user_details("u3", email="New@Example.com", phone_number="5559999999")
+    assert system.search_users(email="u3@example.com") == ([], 0)
+    assert system.search_users(email="new@example.com") == (["u3"], 1)
+    assert system.search_users(phone_number="5550000003") == ([], 0)
+    assert system.search_users(phone_number="5559999999") == (["u3"], 1)
+    assert not system.index.email_taken("u3@example.com")
+    assert system.index.email_taken("new@example.com")
+    system.register_user("v", "secret", "u3@example.com", "5550001111", "1990-01-01")  # The old email is free again
+
+def test_blank_fields_leave_details_and_index_alone(system):
+    assert system.modify_user_details("u4", email="", phone_number="", dob="2000-02-02")
+    user = system.users["u4"]
+    assert (user.email, user.phone_number, user.dob) == ("u4@example.com", "5550000004", "2000-02-02")
+    assert system.search_users(email="u4@example.com") == (["u4"], 1)
+
+def test_taken_email_is_refused(system):
+    with pytest.raises(DuplicateEmailError):
+        system.modify_user_details("u1", email="U2@example.com")
+    assert system.users["u1"].email == "u1@example.com"
+    assert system.modify_user_details("u1", email="u1@example.com")  # A user's own email is not taken
+
+def test_deleted_users_leave_the_index(system):
+    assert system.delete_user("u12")
+    assert system.search_users(prefix="u12") == ([], 0)
+    assert system.search_users(prefix="u1") == ([f"u{i}" for i in [1, 10, 11, 13, 14, 15, 16, 17, 18, 19]], 10)
+    assert system.search_users(email="u12@example.com") == ([], 0)
+    assert system.search_users(phone_number="5550000012") == ([], 0)
+    assert not system.index.email_taken("u12@example.com")
+
+def test_index_matches_the_saved_users_after_a_restart(system, open_system):
+    system.modify_user_details("u5", email="five@example.com")
+    system.delete_user("u6")
+    system.close()
+    system = open_system()
+    assert system.search_users(email="five@example.com") == (["u5"], 1)
+    assert system.search_users(prefix="u6") == ([], 0)
+    assert system.search_users()[1] == 29
+
+def test_account_window_reads_the_user_back_after_an_update(system):
+    from Python_Code import UserMenu
+    window = SimpleNamespace(system=system, user=system.users["u7"])
+    user = UserMenu.update_details(window, "seven@example.com", "", "")
+    assert (user.email, user.phone_number) == ("seven@example.com", "5550000007")
+    assert system.search_users(email="seven@example.com") == (["u7"], 1)
+    system.delete_user("u7")
+    assert UserMenu.update_details(window, "gone@example.com", "", "") is None
@@ -0,0 +1,64 @@
+import time
+
+import pytest
+
+from booking.core import AdmissionError, RateLimitedError, WaitingRoom
+
+# A clock that only moves when told to, standing in for time.monotonic
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(time, "monotonic", clock)
+    return clock
+
+def test_buyers_admitted_on_arrival_do_not_lengthen_the_wait(clock):
+    room = WaitingRoom(rate=10, burst=5, user_rate=100, user_burst=100)
+    assert all(room.enter(f"u{i}").admitted for i in range(5))  # The burst is admitted at once
+    first, second = room.enter("a"), room.enter("b")
+    assert (first.admitted, second.admitted) == (False, False)
+    assert room.next_delay(first, clock.now + 30) == pytest.approx(0.1)  # One turn away, not six
+    assert room.next_delay(second, clock.now + 30) == pytest.approx(0.2)
+    clock.now += 0.1
+    assert room.next_delay(first, clock.now + 30) is None
+    assert room.next_delay(second, clock.now + 30) == pytest.approx(0.1)
+    clock.now += 0.1
+    assert room.next_delay(second, clock.now + 30) is None
+    assert room.status()["waiting"] == 0
+
+def test_queue_is_first_come_first_served_and_skips_leavers(clock):
+    room = WaitingRoom(rate=1, burst=1, user_rate=100, user_burst=100)
+    room.enter("early")
+    waiters = [room.enter(f"u{i}") for i in range(3)]
+    room.leave(waiters[0])
+    clock.now += 1
+    assert room.next_delay(waiters[2], clock.now + 30) is not None
+    assert room.next_delay(waiters[1], clock.now + 30) is None  # The buyer who left is passed over
+    clock.now += 1
+    assert room.next_delay(waiters[2], clock.now + 30) is None
+
+def test_buyers_are_turned_away_when_the_wait_would_be_too_long(clock):
+    room = WaitingRoom(rate=1, burst=1, user_rate=100, user_burst=100, max_waiting=100, max_wait=3)
+    room.enter("early")
+    waiters = [room.enter(f"u{i}") for i in range(3)]
+    with pytest.raises(AdmissionError) as turned_away:
+        room.enter("late")
+    assert turned_away.value.retry_after == pytest.approx(4)
+    with pytest.raises(AdmissionError, match="Waited too long"):
+        room.next_delay(waiters[2], clock.now)
+    assert room.status()["shed"] == 1 and room.status()["timed_out"] == 1
+
+def test_one_buyer_is_held_to_their_own_rate(clock):
+    room = WaitingRoom(rate=100, user_rate=1, user_burst=2)
+    room.enter("ann")
+    room.enter("ann")
+    with pytest.raises(RateLimitedError) as limited:
+        room.enter("ann")
+    assert limited.value.retry_after == pytest.approx(1)
+    assert room.enter("bob").admitted